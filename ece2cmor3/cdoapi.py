@@ -1,12 +1,40 @@
 import _thread
+import copy
 import numpy
 import logging
 import cdo
 import os
 
+from ece2cmor3 import metadata
+
 # Log object
 log = logging.getLogger(__name__)
 
+# Shared CDO wrapper instance and the process that created it
+cdo_app = None
+cdo_app_pid = None
+
+
+# Returns the CDO wrapper of the current process, creating it once instead of for every command
+def get_cdo_app():
+    global cdo_app, cdo_app_pid
+    if cdo_app is None or cdo_app_pid != os.getpid():
+        cdo_app = cdo.Cdo()
+        cdo_app_pid = os.getpid()
+    return cdo_app
+
+
+# Version of the cdo executable
+cdo_version = None
+
+
+# Returns the version of the cdo executable
+def get_cdo_version():
+    global cdo_version
+    if cdo_version is None:
+        cdo_version = str(get_cdo_app().version())
+    return cdo_version
+
 
 # Class for interfacing with the CDO python wrapper.
 class cdo_command:
@@ -74,10 +102,21 @@ class cdo_command:
     # Constructor
     def __init__(self, code=0):
         self.operators = {}
-        self.app = cdo.Cdo()
+        self.ordered_keys = None
+        self.app = get_cdo_app()
         if code > 0:
             self.add_operator(cdo_command.select_code_operator, code)
 
+    # The cdo wrapper is not pickled, commands sent to worker processes use the wrapper of that process
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.pop("app", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.app = get_cdo_app()
+
     # Adds an operator
     def add_operator(self, operator, *args):
         global log
@@ -89,11 +128,30 @@ class cdo_command:
         else:
             log.error("Unknown operator was rejected: ", operator)
 
+    # Returns the operators in command line order, the last operator is applied first
+    def get_ordered_keys(self):
+        if self.ordered_keys is not None:
+            return [k for k in self.ordered_keys if k in self.operators]
+        return cdo_command.optimize_order(
+            sorted(list(self.operators.keys()), key=lambda op: cdo_command.operator_ordering.index(op)))
+
     # Creates a command string from the given operator list
     def create_command(self):
-        keys = cdo_command.optimize_order(
-            sorted(list(self.operators.keys()), key=lambda op: cdo_command.operator_ordering.index(op)))
-        return " ".join([cdo_command.make_option(k, self.operators[k]) for k in keys])
+        return " ".join([cdo_command.make_option(k, self.operators[k]) for k in self.get_ordered_keys()])
+
+    # Returns the option strings of the command in the order they are applied
+    def get_chain(self):
+        return [cdo_command.make_option(k, self.operators[k]) for k in reversed(self.get_ordered_keys())]
+
+    # Splits the command into the commands of the operators applied after and before the first n operators
+    def split(self, n):
+        keys = self.get_ordered_keys()
+        n = min(n, len(keys))
+        outer, inner = copy.copy(self), copy.copy(self)
+        outer.ordered_keys, inner.ordered_keys = keys[:len(keys) - n], keys[len(keys) - n:]
+        outer.operators = {k: list(self.operators[k]) for k in outer.ordered_keys}
+        inner.operators = {k: list(self.operators[k]) for k in inner.ordered_keys}
+        return outer, inner
 
     def merge(self, ifiles, ofile):
         if isinstance(ifiles, str):
@@ -101,17 +159,28 @@ class cdo_command:
         return self.app.merge(input=' '.join(ifiles), output=ofile)
 
     def show_code(self, ifile):
-        return self.app.showcode(input=ifile)
+        codes = metadata.get_codes(ifile, self.read_codes)
+        if codes is None:
+            codes = self.read_codes(ifile)
+        return [" ".join([str(c) for c in codes])]
+
+    # Reads the codes in the file with cdo showcode
+    def read_codes(self, ifile):
+        output = self.app.showcode(input=ifile)
+        if isinstance(output, list):
+            output = " ".join(output)
+        return [] if not output else [int(s) for s in output.split()]
 
-    # Applies the current set of operators to the input file.
-    def apply(self, ifile, ofile=None, threads=4, grib_first=False):
+    # Applies the current set of operators to the input file. The NetCDF output is written with the given cdo data
+    # type (e.g. F32), or the default one.
+    def apply(self, ifile, ofile=None, threads=4, grib_first=False, data_type=None):
         global log
-        keys = cdo_command.optimize_order(
-            sorted(list(self.operators.keys()), key=lambda op: cdo_command.operator_ordering.index(op)))
-        option_string = "-f nc" if threads < 2 else ("-f nc -P " + str(threads))
+        keys = self.get_ordered_keys()
+        nc_options = "-f nc" if data_type is None else ("-f nc -b " + data_type)
+        option_string = nc_options if threads < 2 else (nc_options + " -P " + str(threads))
         if grib_first:
             option_string = "" if threads < 2 else ("-P " + str(threads))
-        func = getattr(self.app, keys[0], None)
+        func = getattr(self.app, keys[0], None) if any(keys) else None
         app_args = None
         if func:
             app_args = ",".join([str(a) for a in self.operators.get(keys[0], [])])
@@ -137,7 +206,7 @@ class cdo_command:
                 else:
                     f = func(input=input_string, options=option_string)
                 if grib_first:
-                    option_string = "-f nc"
+                    option_string = nc_options
                     f = self.app.copy(input=output_file, output=ofile, options=option_string)
                     try:
                         os.remove(output_file)
@@ -167,10 +236,9 @@ class cdo_command:
 
     # Applies the current set of operators and returns the netcdf variables in memory:
     def apply_cdf(self, ifile, threads=4):
-        keys = cdo_command.optimize_order(
-            sorted(list(self.operators.keys()), key=lambda op: cdo_command.operator_ordering.index(op)))
+        keys = self.get_ordered_keys()
         option_string = "" if threads < 2 else ("-P " + str(threads))
-        func = getattr(self.app, keys[0], None)
+        func = getattr(self.app, keys[0], None) if any(keys) else None
         app_args = None
         if func:
             app_args = ",".join([str(a) for a in self.operators.get(keys[0], [])])
@@ -189,6 +257,11 @@ class cdo_command:
 
     # Grid description method
     def get_grid_descr(self, ifile):
+        info_dict = metadata.get_grid_descr(ifile, self.read_grid_descr)
+        return self.read_grid_descr(ifile) if info_dict is None else info_dict
+
+    # Reads the grid description with cdo griddes
+    def read_grid_descr(self, ifile):
         global log
         int_fields = ["gridsize", "np", "xsize", "ysize"]
         real_fields = ["xfirst", "xinc", "yfirst", "yinc"]
@@ -236,6 +309,11 @@ class cdo_command:
     def get_z_axes(self, ifile, var):
         if not ifile:
             return []
+        ltypes = metadata.get_z_axes(ifile, var, self.read_z_axes)
+        return self.read_z_axes(ifile, var) if ltypes is None else ltypes
+
+    # Reads the level types of the variable with cdo showltype
+    def read_z_axes(self, ifile, var):
         select_operator = cdo_command.select_code_operator if isinstance(var, int) else cdo_command.select_var_operator
         try:
             output = self.app.showltype(input=" ".join([cdo_command.make_option(select_operator, [var]), ifile]))
@@ -250,6 +328,11 @@ class cdo_command:
     def get_levels(self, ifile, var, axis):
         if not ifile:
             return []
+        levels = metadata.get_levels(ifile, var, axis, self.read_levels)
+        return self.read_levels(ifile, var, axis) if levels is None else levels
+
+    # Reads the levels of the variable on the axis with cdo showlevel
+    def read_levels(self, ifile, var, axis):
         select_operator = cdo_command.select_code_operator if isinstance(var, int) else cdo_command.select_var_operator
         selvar_operator = cdo_command.make_option(select_operator, [var])
         selzaxis_operator = cdo_command.make_option(cdo_command.select_z_operator, [axis])
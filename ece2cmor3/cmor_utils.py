@@ -1,7 +1,7 @@
+import contextlib
 import datetime
 import math
 
-import cdo
 import cmor
 import dateutil.relativedelta
 # lpjg related
@@ -15,11 +15,13 @@ import logging
 import netCDF4
 import numpy
 import os
+import queue
 import re
 import requests
+import threading
 
 # Log object
-from ece2cmor3 import components
+from ece2cmor3 import components, cdoapi, metadata
 
 log = logging.getLogger(__name__)
 
@@ -184,13 +186,44 @@ def get_nemo_frequency(filepath, expname):
 
 
 def read_time_stamps(path):
-    command = cdo.Cdo()
+    time_stamps = metadata.get_time_stamps(path, read_cdo_time_stamps)
+    return read_cdo_time_stamps(path) if time_stamps is None else time_stamps
+
+
+# Reads the time stamps of the file with cdo showtimestamp
+def read_cdo_time_stamps(path):
+    command = cdoapi.get_cdo_app()
     time_slice_string = command.showtimestamp(input=path)
     if not any(time_slice_string):
-     return time_slice_string
-    else:
-     times = time_slice_string[0].split()
-    return [datetime.datetime.strptime(s, "%Y-%m-%dT%H:%M:%S") for s in times]
+        return time_slice_string
+    return numpy.array(time_slice_string[0].split(), dtype="datetime64[s]").tolist()
+
+
+# Returns the time stamps of the file as int64 array of seconds since 1970
+def read_time_epochs(path):
+    epochs = metadata.get_time_epochs(path)
+    if epochs is not None:
+        return epochs
+    return get_epoch_seconds(read_time_stamps(path))
+
+
+# Converts the datetimes to an int64 array of seconds since 1970
+def get_epoch_seconds(times):
+    return numpy.array(times, dtype="datetime64[s]").astype(numpy.int64)
+
+
+# Returns for every (lower, upper) bound the index of the earliest time stamp within the closed interval, or -1 if it
+# contains none
+def match_time_bounds(epochs, bounds):
+    if len(epochs) == 0:
+        return numpy.full(len(bounds), -1)
+    order = numpy.argsort(epochs, kind="stable")
+    sorted_epochs = epochs[order]
+    lower = get_epoch_seconds([b[0] for b in bounds])
+    upper = get_epoch_seconds([b[1] for b in bounds])
+    pos = numpy.minimum(numpy.searchsorted(sorted_epochs, lower, side="left"), len(order) - 1)
+    found = (sorted_epochs[pos] >= lower) & (sorted_epochs[pos] <= upper)
+    return numpy.where(found, order[pos], -1)
 
 
 def find_tm5_output(path, expname=None, varname=None, freq=None):
@@ -306,12 +339,22 @@ def netcdf2cmor(varid, ncvar, timdim=0, factor=1.0, term=0.0, psvarid=None, ncps
         ntimes = 1 if time_selection is None else len(time_selection)
     else:
         ntimes = ncvar.shape[timdim] if time_selection is None else len(time_selection)
-    size = ncvar.size / ntimes
-    chunk = int(math.floor(4.0E+9 / (8 * size)))  # Use max 4 GB of memory
+    depth = get_prefetch_depth()
+    chunk = get_time_chunk(ncvar, timdim, ntimes, nbuffers=depth + 1)
     if time_selection is not None and numpy.any(time_selection < 0):
         chunk = 1
     missval_in = getattr(ncvar, "missing_value", None)
-    for i in range(0, ntimes, chunk):
+    lock = contextlib.nullcontext()
+    if depth > 0 and use_netcdf_lock():
+        lock = netcdf_lock
+        ncvar = locked_variable(ncvar)
+        ncpsvar = None if ncpsvar is None else locked_variable(ncpsvar)
+
+    # Missing value flags of the chunks, only used by the thread reading the chunks and released with the variable
+    scratch = mask_buffer()
+
+    # Reads and converts the time steps from i to the next chunk, returns None for unsupported array structures
+    def read_chunk(i):
         imax = min(i + chunk, ntimes)
         time_slice = slice(i, imax, 1)
         if time_selection is not None:
@@ -324,29 +367,29 @@ def netcdf2cmor(varid, ncvar, timdim=0, factor=1.0, term=0.0, psvarid=None, ncps
         vals = None
         if ndims == 1:
             if timdim < 0:
-                vals = apply_mask(ncvar[:], factor, term, None, missval_in, missval)
+                vals = apply_mask(ncvar[:], factor, term, None, missval_in, missval, scratch)
             elif timdim == 0:
-                vals = apply_mask(ncvar[time_slice], factor, term, None, missval_in, missval)
+                vals = apply_mask(ncvar[time_slice], factor, term, None, missval_in, missval, scratch)
         elif ndims == 2:
             if timdim < 0:
                 if swaplatlon:
-                    vals = (apply_mask(ncvar[:, :], factor, term, mask, missval_in, missval)).transpose()
+                    vals = (apply_mask(ncvar[:, :], factor, term, mask, missval_in, missval, scratch)).transpose()
                 else:
-                    vals = apply_mask(ncvar[:, :], factor, term, mask, missval_in, missval)
+                    vals = apply_mask(ncvar[:, :], factor, term, mask, missval_in, missval, scratch)
             elif timdim == 0:
                 if time_slice is None:
                     vals = numpy.transpose(numpy.full((1,) + ncvar.shape[1:], missval), axes=[1, 0])
                 else:
                     vals = numpy.transpose(apply_mask(ncvar[time_slice, :], factor, term, None, missval_in,
-                                                      missval), axes=[1, 0])
+                                                      missval, scratch), axes=[1, 0])
             elif timdim == 1:
                 if time_slice is None:
                     vals = numpy.full(ncvar.shape[:-1] + (1,), missval)
                 else:
-                    vals = apply_mask(ncvar[:, time_slice], factor, term, None, missval_in, missval)
+                    vals = apply_mask(ncvar[:, time_slice], factor, term, None, missval_in, missval, scratch)
         elif ndims == 3:
             if timdim < 0:
-                vals = numpy.transpose(apply_mask(ncvar[:, :, :], factor, term, mask, missval_in, missval),
+                vals = numpy.transpose(apply_mask(ncvar[:, :, :], factor, term, mask, missval_in, missval, scratch),
                                        axes=[2, 1, 0] if swaplatlon else [1, 2, 0])
             elif timdim == 0:
                 if time_slice is None:
@@ -354,7 +397,7 @@ def netcdf2cmor(varid, ncvar, timdim=0, factor=1.0, term=0.0, psvarid=None, ncps
                                            axes=[2, 1, 0] if swaplatlon else [1, 2, 0])
                 else:
                     vals = numpy.transpose(apply_mask(ncvar[time_slice, :, :], factor, term, mask,
-                                                      missval_in, missval),
+                                                      missval_in, missval, scratch),
                                            axes=[2, 1, 0] if swaplatlon else [1, 2, 0])
             elif timdim == 2:
                 if mask is not None:
@@ -364,11 +407,11 @@ def netcdf2cmor(varid, ncvar, timdim=0, factor=1.0, term=0.0, psvarid=None, ncps
                                            axes=[1, 0, 2] if swaplatlon else [0, 1, 2])
                 else:
                     vals = numpy.transpose(apply_mask(ncvar[:, :, time_slice], factor, term, None, missval_in,
-                                                      missval),
+                                                      missval, scratch),
                                            axes=[1, 0, 2] if swaplatlon else [0, 1, 2])
             else:
                 log.error("Unsupported array structure with 3 dimensions and time dimension index 1")
-                return
+                return None
         elif ndims == 4:
             if timdim == 0:
                 if time_slice is None:
@@ -376,7 +419,7 @@ def netcdf2cmor(varid, ncvar, timdim=0, factor=1.0, term=0.0, psvarid=None, ncps
                                            axes=[3, 2, 1, 0] if swaplatlon else [2, 3, 1, 0])
                 else:
                     vals = numpy.transpose(apply_mask(ncvar[time_slice, :, :, :], factor, term, mask, missval_in,
-                                                      missval),
+                                                      missval, scratch),
                                            axes=[3, 2, 1, 0] if swaplatlon else [2, 3, 1, 0])
             elif timdim == 3:
                 if mask is not None:
@@ -386,11 +429,11 @@ def netcdf2cmor(varid, ncvar, timdim=0, factor=1.0, term=0.0, psvarid=None, ncps
                                            axes=[1, 0, 2, 3] if swaplatlon else [0, 1, 2, 3])
                 else:
                     vals = numpy.transpose(apply_mask(ncvar[:, :, :, time_slice], factor, term, mask, missval_in,
-                                                      missval),
+                                                      missval, scratch),
                                            axes=[1, 0, 2, 3] if swaplatlon else [0, 1, 2, 3])
             else:
                 log.error("Unsupported array structure with 4 dimensions and time dimension index %d" % timdim)
-                return
+                return None
         elif ndims == 5:
             if timdim == 0:
                 if time_slice is None:
@@ -398,7 +441,7 @@ def netcdf2cmor(varid, ncvar, timdim=0, factor=1.0, term=0.0, psvarid=None, ncps
                                            axes=[4, 3, 2, 1, 0] if swaplatlon else [3, 4, 2, 1, 0])
                 else:
                     vals = numpy.transpose(apply_mask(ncvar[time_slice, :, :, :, :], factor, term, mask, missval_in,
-                                                      missval),
+                                                      missval, scratch),
                                            axes=[4, 3, 2, 1, 0] if swaplatlon else [3, 4, 2, 1, 0])
             elif timdim == 4:
                 if mask is not None:
@@ -408,23 +451,21 @@ def netcdf2cmor(varid, ncvar, timdim=0, factor=1.0, term=0.0, psvarid=None, ncps
                                            axes=[1, 0, 2, 3, 4] if swaplatlon else [0, 1, 2, 3, 4])
                 else:
                     vals = numpy.transpose(apply_mask(ncvar[:, :, :, :, time_slice], factor, term, mask, missval_in,
-                                                      missval),
+                                                      missval, scratch),
                                            axes=[1, 0, 2, 3, 4] if swaplatlon else [0, 1, 2, 3, 4])
             else:
                 log.error("Unsupported array structure with 4 dimensions and time dimension index %d" % timdim)
-                return
+                return None
         else:
             log.error("Cmorizing arrays of rank %d is not supported" % ndims)
-            return
+            return None
         if fliplat and (ndims > 1 or timdim < 0):
             vals = numpy.flipud(vals)
         if timdim < 0 and ntimes > 1:
             vals = numpy.repeat(vals, repeats=(imax - i), axis=ndims - 1)
         ntimes_passed = 0 if ((timdim < 0 and ntimes == 1) or force_fx) else (imax - i)
-        cmor.write(varid, vals, ntimes_passed=ntimes_passed)
-        del vals
+        spvals = None
         if psvarid is not None and ncpsvar is not None:
-            spvals = None
             if len(ncpsvar.shape) == 3:
                 if time_slice is None:
                     spvals = numpy.transpose(numpy.full((1,) + ncpsvar.shape[1:], missval),
@@ -437,22 +478,191 @@ def netcdf2cmor(varid, ncvar, timdim=0, factor=1.0, term=0.0, psvarid=None, ncps
                                              axes=[2, 1, 0] if swaplatlon else [2, 1, 0])
                 else:
                     spvals = numpy.transpose(ncpsvar[time_slice, 0, :, :], axes=[2, 1, 0] if swaplatlon else [1, 2, 0])
+            if spvals is not None and fliplat:
+                spvals = numpy.flipud(spvals)
+        return get_contiguous(vals), get_contiguous(spvals), ntimes_passed
+
+    for result in prefetch(read_chunk, list(range(0, ntimes, chunk)), depth):
+        if result is None:
+            return
+        vals, spvals, ntimes_passed = result
+        with lock:
+            cmor.write(varid, vals, ntimes_passed=ntimes_passed)
             if spvals is not None:
-                if fliplat:
-                    spvals = numpy.flipud(spvals)
                 cmor.write(psvarid, spvals, ntimes_passed=ntimes_passed, store_with=varid)
-                del spvals
+        del vals, spvals, result
+
+
+# Memory budget in bytes shared by all concurrent netcdf2cmor calls. Set by the --membudget option, otherwise read
+# from the ECE2CMOR3_MEMORY_BUDGET environment variable.
+memory_budget = None
+
+# Number of processes calling netcdf2cmor concurrently, each of them gets an equal share of the memory budget
+concurrent_writers = 1
+
+memory_units = {'K': 1.0E+3, 'M': 1.0E+6, 'G': 1.0E+9, 'T': 1.0E+12}
+
+
+# Parses a memory size in bytes, with an optional K, M, G or T suffix
+def parse_memory_size(size):
+    size = str(size).strip().upper().rstrip('B')
+    factor = memory_units.get(size[-1:], None)
+    if factor is None:
+        return float(size)
+    return float(size[:-1]) * factor
+
+
+# Returns the memory budget in bytes, 4 GB by default
+def get_memory_budget():
+    global log
+    if memory_budget is not None:
+        return memory_budget
+    env_val = os.environ.get("ECE2CMOR3_MEMORY_BUDGET", "")
+    if env_val:
+        try:
+            return parse_memory_size(env_val)
+        except ValueError:
+            log.error("Could not interpret environment variable ECE2CMOR3_MEMORY_BUDGET with value %s as memory size" %
+                      env_val)
+    return 4.0E+9
+
+
+# Returns the number of time steps read per netcdf2cmor chunk, fitting the read buffer and the array passed to cmor in
+# the share of the memory budget of a single writer, divided over nbuffers chunks held at the same time. The chunk is
+# aligned with the netcdf chunking of the time axis.
+def get_time_chunk(ncvar, timdim, ntimes, nbuffers=1):
+    itemsize = numpy.dtype(getattr(ncvar, "dtype", numpy.float64)).itemsize
+    step_size = 2 * itemsize * ncvar.size / max(1, ntimes)
+    budget = get_memory_budget() / max(1, concurrent_writers) / max(1, nbuffers)
+    chunk = max(1, int(math.floor(budget / step_size)))
+    chunking = ncvar.chunking() if timdim >= 0 and hasattr(ncvar, "chunking") else None
+    if isinstance(chunking, list) and chunking[timdim] > 1 and chunk >= chunking[timdim]:
+        chunk -= chunk % chunking[timdim]
+    return chunk
+
+
+# Lock serializing the netcdf reads of the prefetch thread and the cmor writes, the netcdf library not being thread-safe
+netcdf_lock = threading.Lock()
+
+
+# Number of chunks read ahead by the netcdf2cmor prefetch thread, 0 disables prefetching
+def get_prefetch_depth():
+    global log
+    env_val = os.environ.get("ECE2CMOR3_PREFETCH_DEPTH", "1")
+    try:
+        return max(0, int(env_val))
+    except ValueError:
+        log.error("Could not interpret environment variable ECE2CMOR3_PREFETCH_DEPTH with value %s as integer" %
+                  env_val)
+    return 1
+
+
+# Whether to serialize netcdf reads and cmor writes, only to be disabled for thread-safe netcdf and hdf5 libraries
+def use_netcdf_lock():
+    return str(os.environ.get("ECE2CMOR3_NETCDF_LOCK", "True")).lower() != "false"
+
+
+# Wrapper of a netcdf variable reading its data while holding the netcdf lock
+class locked_variable(object):
+
+    def __init__(self, variable):
+        self.variable = variable
+
+    def __getattr__(self, name):
+        return getattr(self.variable, name)
+
+    def __getitem__(self, item):
+        with netcdf_lock:
+            return self.variable[item]
+
+
+# Returns a C-contiguous copy of transposed or flipped arrays, leaving masked arrays untouched
+def get_contiguous(array):
+    if array is None or numpy.ma.isMaskedArray(array):
+        return array
+    return numpy.ascontiguousarray(array)
+
+
+# Yields func(item) for all items, computed by a background thread running up to depth items ahead of the consumer
+def prefetch(func, items, depth):
+    if depth <= 0 or len(items) < 2:
+        for item in items:
+            yield func(item)
+        return
+    results = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in items:
+                if stop.is_set():
+                    return
+                results.put((True, func(item)))
+        except Exception as e:
+            results.put((False, e))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        for _ in items:
+            success, result = results.get()
+            if not success:
+                raise result
+            yield result
+    finally:
+        stop.set()
+        while thread.is_alive():
+            try:
+                results.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        thread.join()
+
+
+# Boolean scratch buffer for the missing value flags in apply_mask, reused across the chunks of a variable. A buffer
+# must not be shared between threads.
+class mask_buffer(object):
+
+    def __init__(self):
+        self.buffer = None
+
+    # Returns a view of the buffer with the given shape, growing the buffer when necessary
+    def get(self, shape):
+        size = int(numpy.prod(shape))
+        if self.buffer is None or self.buffer.size < size:
+            self.buffer = None
+            self.buffer = numpy.empty(size, dtype=bool)
+        return self.buffer[:size].reshape(shape)
 
 
-# Replaces missing values and applies the mask to the 2 trailing dimensions of the input array
-def apply_mask(array, factor, term, mask, missval_in, missval_out):
+# Replaces missing values and applies the mask to the 2 trailing dimensions of the input array. Floating point arrays
+# are converted in place, with a boolean buffer as the only full-size temporary, taken from the scratch mask_buffer if
+# given.
+def apply_mask(array, factor, term, mask, missval_in, missval_out, scratch=None):
     new_miss_val = array.dtype.type(missval_out)
+    data = numpy.ma.getdata(array)
+    if not numpy.issubdtype(data.dtype, numpy.floating) or not data.flags.writeable:
+        if missval_in is not None:
+            array[array == missval_in] = new_miss_val
+        if mask is not None:
+            numpy.putmask(array, numpy.broadcast_to(numpy.logical_not(mask), array.shape), new_miss_val)
+        if factor != 1.0 or term != 0.0:
+            numpy.putmask(array, array != new_miss_val, numpy.float32(factor * array + term))
+        return array
+    invalid = numpy.empty(data.shape, dtype=bool) if scratch is None else scratch.get(data.shape)
     if missval_in is not None:
-        array[array == missval_in] = new_miss_val
+        numpy.equal(data, missval_in, out=invalid)
+        numpy.copyto(data, new_miss_val, where=invalid)
     if mask is not None:
-        numpy.putmask(array, numpy.broadcast_to(numpy.logical_not(mask), array.shape), new_miss_val)
+        numpy.copyto(data, new_miss_val, where=numpy.logical_not(mask))
     if factor != 1.0 or term != 0.0:
-        numpy.putmask(array, array != new_miss_val, numpy.float32(factor * array + term))
+        numpy.equal(data, new_miss_val, out=invalid)
+        with numpy.errstate(over="ignore", invalid="ignore"):
+            if factor != 1.0:
+                numpy.multiply(data, data.dtype.type(factor), out=data)
+            if term != 0.0:
+                numpy.add(data, data.dtype.type(term), out=data)
+        numpy.copyto(data, new_miss_val, where=invalid)
     return array
 
 
@@ -4,6 +4,7 @@ import time
 import argparse
 import datetime
 import dateutil
+import json
 import logging
 import os
 import sys
@@ -42,6 +43,9 @@ def main(args=None):
                         help="Reference date for output time axes")
     parser.add_argument("--npp", metavar="N", type=int, default=8, help="Number of parallel tasks (only relevant for "
                                                                         "IFS cmorization")
+    parser.add_argument("--membudget", metavar="SIZE", type=str, default=None,
+                        help="Memory budget (e.g. 16G) shared by the parallel tasks for reading model output, "
+                             "by default the ECE2CMOR3_MEMORY_BUDGET environment variable or 4G")
     parser.add_argument("--log", action="store_true", default=False, help="Write to log file")
     parser.add_argument("--flatdir", action="store_true", default=False, help="Do not create sub-directories in "
                                                                                     "output folder")
@@ -56,6 +60,9 @@ def main(args=None):
                         choices=["preserve", "replace", "append"])
     parser.add_argument("--skip_alevel_vars", action="store_true", default=False, help="Prevent loading atmospheric "
                                                                                        "model-level variables")
+    parser.add_argument("--plan", metavar="FILE", type=str, nargs='?', const='-', default=None,
+                        help="Write the IFS post-processing plan (json) to FILE or standard output and exit without "
+                             "processing")
     parser.add_argument("-V", "--version", action="version",
                         version="%(prog)s {version}".format(version=__version__.version))
     # Deprecated arguments, only for backward compatibility
@@ -100,6 +107,13 @@ def main(args=None):
         log.fatal("Your metadata file %s cannot be found." % args.meta)
         sys.exit(' Exiting ece2cmor.')
 
+    if args.membudget is not None:
+        try:
+            cmor_utils.memory_budget = cmor_utils.parse_memory_size(args.membudget)
+        except ValueError:
+            log.fatal("Your memory budget %s could not be interpreted as a memory size." % args.membudget)
+            sys.exit(' Exiting ece2cmor.')
+
     modedict = {"preserve": ece2cmorlib.PRESERVE, "append": ece2cmorlib.APPEND, "replace": ece2cmorlib.REPLACE}
 
     # Initialize ece2cmor:
@@ -133,6 +147,18 @@ def main(args=None):
 
     refdate = datetime.datetime.combine(dateutil.parser.parse(args.refd), datetime.datetime.min.time())
 
+    if args.plan is not None:
+        plan = ece2cmorlib.plan_ifs_tasks(args.datadir, args.exp, refdate=refdate, tempdir=args.tmpdir) \
+            if "ifs" in active_components else {}
+        if args.plan == '-':
+            json.dump(plan, sys.stdout, indent=2)
+            sys.stdout.write('\n')
+        else:
+            with open(args.plan, 'w') as ofile:
+                json.dump(plan, ofile, indent=2)
+        ece2cmorlib.finalize()
+        return
+
     if "ifs" in active_components:
         ece2cmorlib.perform_ifs_tasks(args.datadir, args.exp,
                                       refdate=refdate,
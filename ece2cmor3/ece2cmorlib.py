@@ -231,6 +231,31 @@ def perform_ifs_tasks(datadir, expname,
     ifs2cmor.execute(ifs_tasks, nthreads=taskthreads)
 
 
+# Plans the IFS post-processing without executing it, returning the filtered files and cdo commands per task. The
+# grib indices and inspections created for the planning are removed afterwards.
+def plan_ifs_tasks(datadir, expname, refdate=None, tempdir="/tmp/ece2cmor"):
+    global log, tasks, table_dir, prefix, masks
+    validate_setup_settings()
+    validate_run_settings(datadir, expname)
+    ifs_tasks = [t for t in tasks if t.source.model_component() == "ifs"]
+    log.info("Planning %d IFS tasks from %d input tasks" % (len(ifs_tasks), len(tasks)))
+    if len(ifs_tasks) == 0:
+        return {}
+    tableroot = os.path.join(table_dir, prefix)
+    if enable_masks:
+        ifs2cmor.masks = {k: masks[k] for k in masks if masks[k]["source"].model_component() == "ifs"}
+    else:
+        ifs2cmor.masks = {}
+    ifs2cmor.scripts = {k: v for k, v in list(scripts.items()) if v["component"] == "ifs"}
+    if (not ifs2cmor.initialize(datadir, expname, tableroot, refdate if refdate else datetime.datetime(1850, 1, 1),
+                                tempdir=tempdir, autofilter=True, keepcache=False)):
+        return {}
+    try:
+        return ifs2cmor.plan(ifs_tasks)
+    finally:
+        ifs2cmor.clean_plan_data()
+
+
 # Performs a NEMO cmorization processing:
 def perform_nemo_tasks(datadir, expname, refdate):
     global log, tasks, table_dir, prefix
@@ -1,5 +1,7 @@
+import io
 import os
 import csv
+import mmap
 import subprocess
 
 import gribapi
@@ -23,6 +25,9 @@ level_key = "level"
 
 test_mode = False
 
+# Whether messages are copied in-kernel, disabled after the first failing copy
+copy_file_range_enabled = hasattr(os, "copy_file_range")
+
 
 # Module initializer function
 def initialize():
@@ -34,14 +39,51 @@ def initialize():
         os.environ["GRIB_API_PYTHON_NO_TYPE_CHECKS"] = "1"
 
 
+# Controls whether the model output is read through the memory-mapped reader
+def use_mmap():
+    return str(os.environ.get("ECE2CMOR3_GRIB_MMAP", "False")).lower() == "true"
+
+
 # Factory method
 def create_grib_file(file_object_):
     if test_mode:
         return csv_grib_mock(file_object_)
+    elif use_mmap():
+        return mmap_grib_file(file_object_)
     else:
         return ecmwf_grib_api(file_object_)
 
 
+# Copies the raw bytes of a message from the input to the output file without decoding it. Outputs not opened in
+# append mode, or buffered writers over such outputs, receive the bytes by an in-kernel copy at their file offset after
+# their buffer is flushed, other outputs by a plain write.
+def copy_message(file_object_in, offset, length, file_object_out):
+    global copy_file_range_enabled
+    if test_mode:
+        file_object_in.seek(offset)
+        file_object_out.write(file_object_in.readline())
+        return
+    in_fd = file_object_in.fileno()
+    copied = 0
+    raw = file_object_out.raw if isinstance(file_object_out, io.BufferedWriter) else file_object_out
+    if copy_file_range_enabled and isinstance(raw, io.FileIO) and 'a' not in raw.mode:
+        file_object_out.flush()
+        out_fd = raw.fileno()
+        try:
+            while copied < length:
+                n = os.copy_file_range(in_fd, out_fd, length - copied, offset + copied)
+                if n == 0:
+                    break
+                copied += n
+        except OSError:
+            copy_file_range_enabled = False
+        if raw is not file_object_out:
+            # Synchronizes the position of the buffered writer with the advanced file offset
+            file_object_out.seek(0, os.SEEK_CUR)
+    if copied < length:
+        file_object_out.write(os.pread(in_fd, length - copied, offset + copied))
+
+
 # Interface for grib file object
 class grib_file(object):
 
@@ -51,6 +93,9 @@ class grib_file(object):
     def read_next(self, headers_only=False):
         pass
 
+    def read_at(self, offset, length):
+        pass
+
     def write(self, file_object_):
         pass
 
@@ -60,6 +105,12 @@ class grib_file(object):
     def get_field(self, name):
         pass
 
+    def get_offset(self):
+        pass
+
+    def get_length(self):
+        pass
+
     def release(self):
         pass
 
@@ -78,6 +129,11 @@ class ecmwf_grib_api(grib_file):
         self.record = gribapi.grib_new_from_file(self.file_object, headers_only=headers_only)
         return self.record is not None
 
+    def read_at(self, offset, length):
+        self.file_object.seek(offset)
+        self.record = gribapi.grib_new_from_message(self.file_object.read(length))
+        return self.record is not None
+
     def write(self, file_object_):
         gribapi.grib_write(self.record, file_object_)
 
@@ -87,6 +143,12 @@ class ecmwf_grib_api(grib_file):
     def get_field(self, name):
         return gribapi.grib_get_long(self.record, name)
 
+    def get_offset(self):
+        return gribapi.grib_get_long(self.record, "offset")
+
+    def get_length(self):
+        return gribapi.grib_get_long(self.record, "totalLength")
+
     def release(self):
         gribapi.grib_release(self.record)
 
@@ -94,6 +156,100 @@ class ecmwf_grib_api(grib_file):
         return self.record is None
 
 
+# Memory-mapped implementation of grib file interface: message boundaries are found by scanning the mapped file and
+# the GRIB1 section 1 keys are decoded from the buffer. A grib api handle is only created for other keys, for GRIB2
+# messages and for modifications.
+class mmap_grib_file(grib_file):
+    # GRIB1 level types coding a layer by top and bottom octets, the level key refers to the top
+    layer_types = [101, 104, 106, 108, 110, 112, 114, 116, 120, 121, 128, 141]
+
+    def __init__(self, file_object_):
+        super(mmap_grib_file, self).__init__(file_object_)
+        size = os.fstat(file_object_.fileno()).st_size
+        self.buffer = mmap.mmap(file_object_.fileno(), 0, access=mmap.ACCESS_READ) if size > 0 else b""
+        self.offset, self.length, self.next_offset = 0, 0, 0
+        self.fields = {}
+        self.record = None
+
+    def read_next(self, headers_only=False):
+        self.release()
+        start = self.buffer.find(b"GRIB", self.next_offset)
+        if start < 0:
+            self.fields = None
+            return False
+        self.offset = start
+        self.length = self.message_length(start)
+        self.next_offset = start + self.length
+        self.fields = self.decode_section1(start)
+        return True
+
+    def read_at(self, offset, length):
+        self.release()
+        if self.buffer[offset:offset + 4] != b"GRIB":
+            self.fields = None
+            return False
+        self.offset, self.length, self.next_offset = offset, length, offset + length
+        self.fields = self.decode_section1(offset)
+        return True
+
+    # Total message length from section 0, falling back to the end marker for large GRIB1 messages
+    def message_length(self, start):
+        if self.buffer[start + 7] == 2:
+            return int.from_bytes(self.buffer[start + 8:start + 16], "big")
+        length = int.from_bytes(self.buffer[start + 4:start + 7], "big")
+        if length & 0x800000 == 0 and self.buffer[start + length - 4:start + length] == b"7777":
+            return length
+        end = self.buffer.find(b"GRIB", start + 8)
+        while end >= 0 and self.buffer[end - 4:end] != b"7777":
+            end = self.buffer.find(b"GRIB", end + 4)
+        return (len(self.buffer) if end < 0 else end) - start
+
+    # Decodes the header keys from the GRIB1 product definition section
+    def decode_section1(self, start):
+        if self.buffer[start + 7] != 1:
+            return {}
+        sec1 = self.buffer[start + 8:start + 36]
+        levtype = sec1[9]
+        level = sec1[10] if levtype in mmap_grib_file.layer_types else (sec1[10] << 8) + sec1[11]
+        year = (sec1[24] - 1) * 100 + sec1[12]
+        return {table_key: sec1[3], param_key: sec1[8], levtype_key: levtype, level_key: level,
+                date_key: year * 10 ** 4 + sec1[13] * 10 ** 2 + sec1[14], time_key: sec1[15] * 100 + sec1[16]}
+
+    def load(self):
+        if self.record is None:
+            self.record = gribapi.grib_new_from_message(self.buffer[self.offset:self.offset + self.length])
+        return self.record
+
+    def write(self, file_object_):
+        if self.record is None:
+            file_object_.write(self.buffer[self.offset:self.offset + self.length])
+        else:
+            gribapi.grib_write(self.record, file_object_)
+
+    def set_field(self, name, value):
+        gribapi.grib_set(self.load(), name, value)
+        self.fields = {}
+
+    def get_field(self, name):
+        if name in self.fields:
+            return self.fields[name]
+        return gribapi.grib_get_long(self.load(), name)
+
+    def get_offset(self):
+        return self.offset
+
+    def get_length(self):
+        return self.length
+
+    def release(self):
+        if self.record is not None:
+            gribapi.grib_release(self.record)
+            self.record = None
+
+    def eof(self):
+        return self.fields is None
+
+
 # CSV header-only implementation of grib file interface for testing purposes
 class csv_grib_mock(grib_file):
     columns = [date_key, time_key, param_key, levtype_key, level_key]
@@ -101,12 +257,19 @@ class csv_grib_mock(grib_file):
     def __init__(self, file_object_):
         super(csv_grib_mock, self).__init__(file_object_)
         self.row = []
-        self.reader = csv.reader(file_object_, delimiter=',')
+        self.offset, self.length = 0, 0
 
     def read_next(self, headers_only=False):
-        self.row = next(self.reader, [])
+        self.offset = self.file_object.tell()
+        line = self.file_object.readline()
+        self.length = len(line)
+        self.row = next(csv.reader([line], delimiter=','), [])
         return any(self.row)
 
+    def read_at(self, offset, length):
+        self.file_object.seek(offset)
+        return self.read_next()
+
     def write(self, file_object_):
         writer = csv.writer(file_object_)
         writer.writerow(self.row)
@@ -121,6 +284,12 @@ class csv_grib_mock(grib_file):
             return 128
         return int(self.row[csv_grib_mock.columns.index(name)])
 
+    def get_offset(self):
+        return self.offset
+
+    def get_length(self):
+        return self.length
+
     def release(self):
         self.row = []
 
@@ -1,14 +1,19 @@
+import calendar
+import collections
 import datetime
+import hashlib
+import io
 import json
 import logging
 import os
 import re
+import multiprocessing
 import resource
-import threading
+import shutil
 
 import numpy
 
-from ece2cmor3 import cmor_target, cmor_source, cmor_task, cmor_utils, grib_file, cdoapi
+from ece2cmor3 import cmor_target, cmor_source, cmor_task, cmor_utils, grib_file, grib_index, cdoapi
 
 # Log object.
 log = logging.getLogger(__name__)
@@ -27,12 +32,33 @@ fxvars = []
 record_keys = {}
 starttimes = {}
 
+# Kinds of fields selected per month in the skip plan
+all_fields = 0
+accumulated_fields = 1
+instant_fields = 2
+
+# Shifted dates and times per (shift in hours, year and month), for all whole hours of the month
+time_shift_tables = {}
+
+# Write buffer size of the filter output files
+file_buffer_size = 1024 * 1024
+
+# Directory of the caches that outlive the leg (first day inspections), assigned by ifs2cmor
+cache_dir = None
+
+
+# Controls whether the merged copy of the filtered files of a task is skipped. The per-code files are still written,
+# the post-processing command of the task merges them on the fly instead of reading a merged grib file.
+def skip_merged_copy():
+    return str(os.environ.get("ECE2CMOR3_IFS_SKIP_MERGED_COPY", "False")).lower() == "true"
+
 
 # Initializes the module, looks up previous month files and inspects the first
-# day in the input files to set up an administration of the fields.
-def initialize(gpfiles, shfiles, ini_gpfile, ini_shfile, prev_files, tmpdir):
+# day in the input files to set up an administration of the fields. The grib indices are stored in indexdir and the
+# inspections in cachedir, both defaulting to tmpdir.
+def initialize(gpfiles, shfiles, ini_gpfile, ini_shfile, prev_files, tmpdir, indexdir=None, cachedir=None):
     global gridpoint_files, spectral_files, ini_gridpoint_file, ini_spectral_file, preceding_files, temp_dir, \
-        varsfreq, accum_codes, record_keys
+        cache_dir, varsfreq, accum_codes, record_keys
     grib_file.initialize()
     gridpoint_files = gpfiles
     spectral_files = shfiles
@@ -40,6 +66,8 @@ def initialize(gpfiles, shfiles, ini_gpfile, ini_shfile, prev_files, tmpdir):
     ini_spectral_file = ini_shfile
     preceding_files = prev_files
     temp_dir = tmpdir
+    cache_dir = cachedir
+    grib_index.index_dir = tmpdir if indexdir is None else indexdir
 
     accum_codes = load_accum_codes(
         os.path.join(os.path.dirname(os.path.abspath(__file__)), "resources", "grib_codes.json"))
@@ -48,23 +76,148 @@ def initialize(gpfiles, shfiles, ini_gpfile, ini_shfile, prev_files, tmpdir):
     gpfile = gridpoint_files[gpdate] if any(gridpoint_files) else None
     shfile = spectral_files[shdate] if any(spectral_files) else None
     if gpfile is not None:
-        with open(gpfile) as gpf:
-            freqs, records = inspect_day(grib_file.create_grib_file(gpf), grid=cmor_source.ifs_grid.point)
-            varsfreq.update(freqs)
-            record_keys[cmor_source.ifs_grid.point] = records
-            update_sp_key(gpfile)
+        freqs, records = inspect_file(gpfile, grid=cmor_source.ifs_grid.point)
+        varsfreq.update(freqs)
+        record_keys[cmor_source.ifs_grid.point] = records
+        update_sp_key(gpfile)
     if shfile is not None:
-        with open(shfile) as shf:
-            freqs, records = inspect_day(grib_file.create_grib_file(shf), grid=cmor_source.ifs_grid.spec)
-            varsfreq.update(freqs)
-            record_keys[cmor_source.ifs_grid.spec] = records
-            update_sp_key(shfile)
+        freqs, records = inspect_file(shfile, grid=cmor_source.ifs_grid.spec)
+        varsfreq.update(freqs)
+        record_keys[cmor_source.ifs_grid.spec] = records
+        update_sp_key(shfile)
     if ini_gpfile is not None:
-        with open(ini_gpfile) as gpf:
-            fxvars.extend(inspect_hr(grib_file.create_grib_file(gpf), grid=cmor_source.ifs_grid.point))
+        fxvars.extend(inspect_file(ini_gpfile, grid=cmor_source.ifs_grid.point, initial=True))
     if ini_shfile is not None:
-        with open(ini_shfile) as shf:
-            fxvars.extend(inspect_hr(grib_file.create_grib_file(shf), grid=cmor_source.ifs_grid.spec))
+        fxvars.extend(inspect_file(ini_shfile, grid=cmor_source.ifs_grid.spec, initial=True))
+
+
+# File mode for reading the model output
+def read_mode():
+    return 'r' if grib_file.test_mode else 'rb'
+
+
+# Creates a grib file iterator over the indexed messages of the opened file. If the routing table is given, only
+# the messages in the skip plan are visited.
+def open_grib_file(file_object, routes=None, grid=None, months=None):
+    entries = grib_index.get_index(file_object.name)
+    if routes is None:
+        return grib_index.create_indexed_grib_file(file_object, entries.tolist())
+    return grib_index.create_indexed_grib_file(file_object, select_index_entries(entries, routes, grid, months))
+
+
+# Creates the skip plan of a grib file: the index entries of messages that are routed to any output file. If months
+# is given, it maps the selected months to the kinds of fields to keep (accumulated_fields, instant_fields or
+# all_fields). Runs of other messages are jumped over by byte offset without reading their headers.
+def select_index_entries(entries, routes, grid, months=None):
+    if len(entries) == 0:
+        return []
+    cols = [grib_index.key_columns[k] for k in [grib_file.param_key, grib_file.table_key, grib_file.levtype_key,
+                                                 grib_file.level_key]]
+    fields, inverse = numpy.unique(entries[:, cols], axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    keys = [make_record_key(*(tuple(f) + (grid,))) for f in fields.tolist()]
+    keep = numpy.array([any(get_routes(routes, k + (grid,))) for k in keys])[inverse]
+    if months is not None:
+        accum = numpy.array([(k[0], k[1]) in accum_codes for k in keys])[inverse]
+        entry_months = (entries[:, grib_index.key_columns[grib_file.date_key]] % 10 ** 4) // 10 ** 2
+        in_months = numpy.zeros(len(entries), dtype=bool)
+        for month, kind in months.items():
+            selection = entry_months == month
+            if kind == accumulated_fields:
+                selection &= accum
+            elif kind == instant_fields:
+                selection &= ~accum
+            in_months |= selection
+        keep &= in_months
+    return entries[keep].tolist()
+
+
+# Inspects the first day of the file, or the first time point for initial state files. Results are cached on disk
+# and reused for files with the same header layout, e.g. the output of the next leg.
+def inspect_file(path, grid, initial=False):
+    cache_path = get_inspection_cache_path(path, grid, initial)
+    result = load_inspection(cache_path, initial)
+    if result is not None:
+        log.info("Reusing first day inspection of grib file %s" % path)
+        return result
+    with open(path, read_mode()) as fin:
+        if initial:
+            result = inspect_hr(open_grib_file(fin), grid=grid)
+        else:
+            result = inspect_day(open_grib_file(fin), grid=grid)
+    save_inspection(cache_path, result, initial)
+    return result
+
+
+# Directory of the first day inspection cache, configured by the ECE2CMOR3_IFS_INSPECT_CACHE environment variable
+def get_inspection_cache_dir():
+    return os.environ.get("ECE2CMOR3_IFS_INSPECT_CACHE", "") or (temp_dir if cache_dir is None else cache_dir)
+
+
+# Returns the cache file path for the inspection, keyed by the fingerprint of the inspected file. The key is computed
+# without indexing the file, so a rerun on unchanged output skips the scan of the first day.
+def get_inspection_cache_path(path, grid, initial):
+    inspection_dir = get_inspection_cache_dir()
+    if inspection_dir is None:
+        return None
+    key = ':'.join([get_fingerprint(path), str(grid), "ini" if initial else "day"])
+    return os.path.join(inspection_dir, '.'.join(["inspect", hashlib.md5(key.encode("utf-8")).hexdigest(), "json"]))
+
+
+# Number of leading messages whose headers enter the inspection fingerprint
+fingerprint_messages = 64
+
+
+# Hashes the size and modification time of the file with the header keys of its leading messages, which are read
+# directly from the file
+def get_fingerprint(path):
+    stat = os.stat(path)
+    header = [str(stat.st_size), str(stat.st_mtime_ns)]
+    with open(path, read_mode()) as fin:
+        gribfile = grib_file.create_grib_file(fin)
+        for i in range(fingerprint_messages):
+            if not gribfile.read_next(headers_only=True):
+                break
+            header.append(','.join([str(gribfile.get_field(k)) for k in [grib_file.date_key, grib_file.time_key,
+                                                                         grib_file.param_key, grib_file.table_key,
+                                                                         grib_file.levtype_key,
+                                                                         grib_file.level_key]]))
+            gribfile.release()
+    return hashlib.md5(':'.join(header).encode("utf-8")).hexdigest()
+
+
+# Reads a cached inspection result, returns None if it does not exist
+def load_inspection(cache_path, initial):
+    if cache_path is None or not os.path.isfile(cache_path):
+        return None
+    try:
+        with open(cache_path) as fin:
+            data = json.load(fin)
+        if initial:
+            return [tuple(k) for k in data["fxvars"]]
+        return {tuple(k[:-1]): k[-1] for k in data["varsfreq"]}, [tuple(k) for k in data["record_keys"]]
+    except (IOError, ValueError, KeyError) as e:
+        log.warning("Could not read inspection cache %s, reason: %s" % (cache_path, str(e)))
+    return None
+
+
+# Writes the inspection result to the cache
+def save_inspection(cache_path, result, initial):
+    if cache_path is None:
+        return
+    if initial:
+        data = {"fxvars": [[int(v) for v in k] for k in result]}
+    else:
+        freqs, records = result
+        data = {"varsfreq": [[int(v) for v in k] + [int(f)] for k, f in freqs.items()],
+                "record_keys": [[int(v) for v in k] for k in records]}
+    try:
+        tmp_path = cache_path + ".tmp"
+        with open(tmp_path, 'w') as fout:
+            json.dump(data, fout)
+        os.replace(tmp_path, cache_path)
+    except (IOError, OSError) as e:
+        log.warning("Could not write inspection cache %s, reason: %s" % (cache_path, str(e)))
 
 
 # Fix for finding the surface pressure, necessary to store 3d model level fields
@@ -160,9 +313,13 @@ def inspect_day(gribfile, grid):
 
 # Creates a key (code + table + level type + level) for a grib message iterator
 def get_record_key(gribfile, gridtype):
-    codevar, codetab = grib_tuple_from_ints(gribfile.get_field(grib_file.param_key),
-                                            gribfile.get_field(grib_file.table_key))
-    levtype, level = gribfile.get_field(grib_file.levtype_key), gribfile.get_field(grib_file.level_key)
+    return make_record_key(gribfile.get_field(grib_file.param_key), gribfile.get_field(grib_file.table_key),
+                           gribfile.get_field(grib_file.levtype_key), gribfile.get_field(grib_file.level_key), gridtype)
+
+
+# Creates a key (code + table + level type + level) from the grib header fields
+def make_record_key(param, table, levtype, level, gridtype):
+    codevar, codetab = grib_tuple_from_ints(param, table)
     if levtype == grib_file.pressure_level_hPa_code:
         level *= 100
         levtype = grib_file.pressure_level_Pa_code
@@ -269,20 +426,22 @@ def mkfname(key):
 def cluster_files(valid_tasks, varstasks):
     task2files, task2freqs = {}, {}
     varsfx = set()
+    hybrid_freqs = {}
+    for k, freq in varsfreq.items():
+        hybrid_freqs.setdefault(k[:3], set()).add(freq)
     for task in valid_tasks:
         task2files[task] = set()
         task2freqs[task] = set()
-        for key, tsklist in varstasks.items():
-            if task in tsklist:
-                task2files[task].add('.'.join([str(key[0]), str(key[1]), str(key[2])]))
-                if key[3] == -1:
-                    task2freqs[task].update([varsfreq[k] for k in list(varsfreq.keys()) if
-                                             (k[0], k[1], k[2]) == (key[0], key[1], key[2])])
-                else:
-                    if key in varsfreq:
-                        task2freqs[task].add(varsfreq[key])
-                    elif key in fxvars:
-                        varsfx.add(key)
+    for key, tsklist in varstasks.items():
+        for task in set(tsklist):
+            task2files[task].add('.'.join([str(key[0]), str(key[1]), str(key[2])]))
+            if key[3] == -1:
+                task2freqs[task].update(hybrid_freqs.get(key[:3], set()))
+            else:
+                if key in varsfreq:
+                    task2freqs[task].add(varsfreq[key])
+                elif key in fxvars:
+                    varsfx.add(key)
     for task, fnames in task2files.items():
         codes = {(int(f.split('.')[0]), int(f.split('.')[1])): f for f in sorted(list(fnames))}
         cum_file = '_'.join([codes[k] for k in codes if k in accum_codes])
@@ -306,18 +465,50 @@ def cluster_files(valid_tasks, varstasks):
     return task2files, task2freqs, varsfx, varsfiles
 
 
+# Compiles the routing table from record keys to the tuple of (output file, frequency) sinks. Model level wildcard
+# keys are expanded over the levels found in the first day, messages on other model levels are routed through the
+# (code, table, level type) entry.
+def build_routes(keys2files):
+    routes, hybrid_sinks = {}, {}
+    for key, fileset in keys2files.items():
+        if key[2] == grib_file.hybrid_level_code:
+            hybrid_sinks.setdefault(key[:3], set()).update(fileset)
+        elif any(fileset):
+            routes[key] = tuple(sorted(fileset))
+    grids = [cmor_source.ifs_grid.point, cmor_source.ifs_grid.spec]
+    for prefix, fileset in hybrid_sinks.items():
+        if not any(fileset):
+            continue
+        sinks = tuple(sorted(fileset))
+        routes[prefix] = sinks
+        for key in varsfreq:
+            if key[:3] == prefix:
+                routes.update({key[:4] + (grid,): sinks for grid in grids})
+    return routes
+
+
+# Returns the output file sinks of the given record key
+def get_routes(routes, key):
+    sinks = routes.get(key, None)
+    if sinks is None and key[2] == grib_file.hybrid_level_code:
+        sinks = routes.get(key[:3], None)
+    return () if sinks is None else sinks
+
+
 # Main execution loop
-def execute(tasks, filter_files=True, multi_threaded=False):
+def execute(tasks, filter_files=True, multi_threaded=False, nprocs=2):
     valid_fx_tasks = execute_tasks([t for t in tasks if cmor_target.get_freq(t.target) == 0], filter_files,
                                    multi_threaded=False, once=True)
     valid_other_tasks = execute_tasks([t for t in tasks if cmor_target.get_freq(t.target) != 0], filter_files,
-                                      multi_threaded=multi_threaded, once=False)
+                                      multi_threaded=multi_threaded, once=False, nprocs=nprocs)
     return valid_fx_tasks + valid_other_tasks
 
 
-def filter_fx_variables(gribfile, keys2files, gridtype, startdate, handles=None):
+def filter_fx_variables(gribfile, routes, gridtype, startdate, fxkeys, handles=None):
     timestamp = -1
     keys = set()
+    # Only the requested fx keys are registered, not the model levels the routing table was expanded with
+    routed_keys = set([k[0:4] for k in fxkeys])
     while gribfile.read_next() and (handles is None or any(handles.keys())):
         t = gribfile.get_field(grib_file.time_key)
         key = get_record_key(gribfile, gridtype)
@@ -328,14 +519,14 @@ def filter_fx_variables(gribfile, keys2files, gridtype, startdate, handles=None)
             timestamp = t
 # This file may be processed twice: once for the fx-fields and once for the dynamic fields.
 # We add only the written fx-fields to the key set here.
-        if any([k[0:4] == key for k in list(keys2files.keys())]):
+        if key in routed_keys:
             keys.add(key)
-        write_record(gribfile, key + (gridtype,), keys2files, shift=0, handles=handles, once=True, setdate=startdate)
+        write_record(gribfile, key + (gridtype,), routes, shift=0, handles=handles, once=True, setdate=startdate)
         gribfile.release()
     return keys, timestamp
 
 
-def execute_tasks(tasks, filter_files=True, multi_threaded=False, once=False):
+def execute_tasks(tasks, filter_files=True, multi_threaded=False, once=False, nprocs=2):
     valid_tasks, varstasks = validate_tasks(tasks)
     if not any(valid_tasks):
         return []
@@ -345,53 +536,52 @@ def execute_tasks(tasks, filter_files=True, multi_threaded=False, once=False):
         keys_gp, timestamp_gp = set(), -1
         keys_sp, timestamp_sp = set(), -1
         filehandles = open_files(keys2files)
-        fxkeys2files = {k: keys2files[k] for k in fxkeys}
+        routes = build_routes(keys2files)
+        fxroutes = build_routes({k: keys2files[k] for k in fxkeys})
         if any(gridpoint_files):
             gridpoint_start_date = sorted(gridpoint_files.keys())[0]
             first_gridpoint_file = preceding_files[gridpoint_files[gridpoint_start_date]]
             if ini_gridpoint_file != first_gridpoint_file and ini_gridpoint_file is not None:
-                with open(str(ini_gridpoint_file), 'r') as fin:
-                    keys_gp, timestamp_gp = filter_fx_variables(grib_file.create_grib_file(fin), fxkeys2files, grids[0],
-                                                                gridpoint_start_date, filehandles)
+                with open(str(ini_gridpoint_file), read_mode()) as fin:
+                    keys_gp, timestamp_gp = filter_fx_variables(open_grib_file(fin, fxroutes, grids[0]),
+                                                                fxroutes, grids[0], gridpoint_start_date, fxkeys,
+                                                                filehandles)
         elif ini_gridpoint_file is not None:
-            with open(str(ini_gridpoint_file), 'r') as fin:
-                keys_gp, timestamp_gp = filter_fx_variables(grib_file.create_grib_file(fin), fxkeys2files, grids[0],
-                                                            None, filehandles)
+            with open(str(ini_gridpoint_file), read_mode()) as fin:
+                keys_gp, timestamp_gp = filter_fx_variables(open_grib_file(fin, fxroutes, grids[0]),
+                                                            fxroutes, grids[0], None, fxkeys, filehandles)
         if any(spectral_files):
             spectral_start_date = sorted(spectral_files.keys())[0]
             first_spectral_file = preceding_files[spectral_files[spectral_start_date]]
             if ini_spectral_file != first_spectral_file and ini_spectral_file is not None:
-                with open(str(ini_spectral_file), 'r') as fin:
-                    keys_sp, timestamp_sp = filter_fx_variables(grib_file.create_grib_file(fin), fxkeys2files, grids[1],
-                                                                spectral_start_date, filehandles)
+                with open(str(ini_spectral_file), read_mode()) as fin:
+                    keys_sp, timestamp_sp = filter_fx_variables(open_grib_file(fin, fxroutes, grids[1]),
+                                                                fxroutes, grids[1], spectral_start_date, fxkeys,
+                                                                filehandles)
         elif ini_spectral_file is not None:
-            with open(str(ini_spectral_file), 'r') as fin:
-                keys_sp, timestamp_sp = filter_fx_variables(grib_file.create_grib_file(fin), fxkeys2files, grids[1],
-                                                            None, filehandles)
+            with open(str(ini_spectral_file), read_mode()) as fin:
+                keys_sp, timestamp_sp = filter_fx_variables(open_grib_file(fin, fxroutes, grids[1]),
+                                                            fxroutes, grids[1], None, fxkeys, filehandles)
         if multi_threaded:
-            threads = []
-            for file_list, grid, keys, timestamp in zip([gridpoint_files, spectral_files], grids, [keys_gp, keys_sp],
-                                                        [timestamp_gp, timestamp_sp]):
-                thread = threading.Thread(target=filter_grib_files, 
-                                          args=(file_list, keys2files, grid, filehandles, 0, 0, once, keys, timestamp))
-                threads.append(thread)
-                thread.start()
-            threads[0].join()
-            threads[1].join()
+            filter_grib_files_parallel([gridpoint_files, spectral_files], keys2files, grids, filehandles,
+                                       [keys_gp, keys_sp], [timestamp_gp, timestamp_sp], nprocs)
         else:
             for file_list, grid, keys, timestamp in zip([gridpoint_files, spectral_files], grids, [keys_gp, keys_sp], [timestamp_gp, timestamp_sp]):
-                filter_grib_files(file_list, keys2files, grid, filehandles, month=0, year=0, once=once, prev_keys=keys, prev_timestamp=timestamp)
-        for handle in list(filehandles.values()):
-            handle.close()
+                filter_grib_files(file_list, routes, grid, filehandles, month=0, year=0, once=once, prev_keys=keys, prev_timestamp=timestamp)
+        filehandles.close()
     for task in task2files:
         if task.status != cmor_task.status_failed:
             file_list = task2files[task]
-            filter_output = os.path.join(temp_dir, file_list[0])
+            filter_output = [os.path.join(temp_dir, file_list[0])]
             if len(file_list) > 1:
-                filter_output = os.path.join(temp_dir, '_'.join(file_list))
-                if not os.path.isfile(filter_output):
-                    cdoapi.cdo_command().merge([os.path.join(temp_dir, f) for f in file_list], filter_output)
-            setattr(task, cmor_task.filter_output_key, [filter_output])
+                # Script tasks receive a single filtered file
+                if skip_merged_copy() and getattr(task, cmor_task.postproc_script_key, None) is None:
+                    filter_output = [os.path.join(temp_dir, f) for f in file_list]
+                else:
+                    filter_output = [os.path.join(temp_dir, '_'.join(file_list))]
+                    if not os.path.isfile(filter_output[0]):
+                        cdoapi.cdo_command().merge([os.path.join(temp_dir, f) for f in file_list], filter_output[0])
+            setattr(task, cmor_task.filter_output_key, filter_output)
     for task in task2freqs:
         if task.status != cmor_task.status_failed:
             setattr(task, cmor_task.output_frequency_key, task2freqs[task])
@@ -465,45 +655,109 @@ def open_files(vars2files):
     files = set()
     for fileset in list(vars2files.values()):
         files.update(set([t[0] for t in fileset]))
-    numreq = len(files)
-    softlim = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
-    if numreq > softlim + 1:
+    return file_pool({f: os.path.join(temp_dir, f) for f in files}, get_max_open_files(len(files)))
+
+
+# Returns the maximal number of simultaneously opened output files. The soft limit on open files is raised when
+# needed, and the ECE2CMOR3_IFS_MAX_OPEN_FILES environment variable caps the number.
+def get_max_open_files(numreq):
+    reserved = 64
+    softlim, hardlim = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if numreq + reserved > softlim:
+        newlim = numreq + reserved if hardlim == resource.RLIM_INFINITY else min(numreq + reserved, hardlim)
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (newlim, hardlim))
+            softlim = newlim
+        except (ValueError, OSError) as e:
+            log.warning("Could not raise the limit on open files to %d, reason: %s" % (newlim, str(e)))
+    result = max(1, softlim - reserved)
+    env_val = os.environ.get("ECE2CMOR3_IFS_MAX_OPEN_FILES", None)
+    if env_val:
         try:
-            resource.setrlimit(resource.RLIMIT_NOFILE, (numreq + 1, -1))
+            result = min(result, max(1, int(env_val)))
         except ValueError:
-            return {}
-    byte_mode = 'w' if grib_file.test_mode else 'wb'
-    return {f: open(os.path.join(temp_dir, f), byte_mode) for f in files}
+            log.error("Could not interpret environment variable ECE2CMOR3_IFS_MAX_OPEN_FILES with value %s as "
+                      "integer" % env_val)
+    return result
 
 
-def build_fast_forward_cache(keys2files, grid):
-    result = {}
-    i = 0
-    prev_key = (-1, -1, -1, -1, -1)
-    if grid not in record_keys:
-        return {}
-    for key in record_keys[grid]:
-        if key[:4] != prev_key[:4]: # flush
-            if i > 1:
-                result[prev_key] = i
-            prev_key = key
-            i = 0
-        if key[3] == grib_file.hybrid_level_code:
-            comp_key = key[1:4] + (-1, grid,)
-            if comp_key not in keys2files:
-                i += 1
-            else:
-                i = 0
+# Pool of output file handles. At most max_open files are kept open, the least recently used file is closed when
+# another one is needed and reopened at its end on its next write. Files are truncated when the pool is created. Grib
+# outputs are buffered writers over files opened without O_APPEND, so that unmodified messages can be copied in-kernel
+# at the file offset after flushing the buffer.
+class file_pool(object):
+
+    def __init__(self, paths, max_open, buffer_size=None):
+        self.paths = dict(paths)
+        self.max_open = max(1, max_open)
+        self.buffer_size = file_buffer_size if buffer_size is None else buffer_size
+        self.handles = collections.OrderedDict()
+        self.hits, self.misses, self.evictions = 0, 0, 0
+        for path in self.paths.values():
+            open(path, 'w' if grib_file.test_mode else 'wb').close()
+
+    # Returns the opened file handle for the given output file
+    def get(self, name, default=None):
+        if name not in self.paths:
+            return default
+        handle = self.handles.get(name, None)
+        if handle is not None:
+            self.handles.move_to_end(name)
+            self.hits += 1
+            return handle
+        self.misses += 1
+        while len(self.handles) >= self.max_open:
+            self.handles.popitem(last=False)[1].close()
+            self.evictions += 1
+        if grib_file.test_mode:
+            handle = open(self.paths[name], 'r+', self.buffer_size)
         else:
-            i = 0
-    return result
+            handle = io.BufferedWriter(io.FileIO(self.paths[name], 'r+'), self.buffer_size)
+        handle.seek(0, os.SEEK_END)
+        self.handles[name] = handle
+        return handle
+
+    def keys(self):
+        return self.paths.keys()
+
+    def values(self):
+        return list(self.handles.values())
+
+    def flush(self):
+        for handle in self.handles.values():
+            handle.flush()
+
+    # Closes all files and logs the handle usage statistics
+    def close(self):
+        for handle in self.handles.values():
+            handle.close()
+        self.handles.clear()
+        log.info("File pool of %d files with at most %d open: %d hits, %d misses, %d evictions" %
+                 (len(self.paths), self.max_open, self.hits, self.misses, self.evictions))
+
+    def __getitem__(self, name):
+        if name not in self.paths:
+            raise KeyError(name)
+        return self.get(name)
+
+    # Removing a file closes it and excludes it from further writing
+    def __delitem__(self, name):
+        handle = self.handles.pop(name, None)
+        if handle is not None:
+            handle.close()
+        del self.paths[name]
+
+    def __contains__(self, name):
+        return name in self.paths
+
+    def __len__(self):
+        return len(self.paths)
 
 
 # Processes month of grib data, including 0-hour fields in the previous month file.
-def filter_grib_files(file_list, keys2files, grid, handles=None, month=0, year=0, once=False, prev_keys=(),
+def filter_grib_files(file_list, routes, grid, handles=None, month=0, year=0, once=False, prev_keys=(),
                       prev_timestamp=-1):
     dates = sorted(file_list.keys())
-    cache = None if once else build_fast_forward_cache(keys2files, grid)
     keys, timestamp = prev_keys, prev_timestamp
     for i in range(len(dates)):
         date = dates[i]
@@ -513,112 +767,172 @@ def filter_grib_files(file_list, keys2files, grid, handles=None, month=0, year=0
         prev_grib_file = preceding_files[cur_grib_file]
         prev_chained = i > 0 and (os.path.realpath(prev_grib_file) == os.path.realpath(file_list[dates[i - 1]][1]))
         if prev_grib_file is not None and not prev_chained:
-            with open(prev_grib_file, 'r') as fin:
+            with open(prev_grib_file, read_mode()) as fin:
                 log.info("Filtering grib file %s..." % os.path.abspath(prev_grib_file))
-                keys, timestamp = proc_initial_month(date.month, grib_file.create_grib_file(fin), keys2files,
-                                                     grid, handles, keys, timestamp, once)
+                gribfile = open_grib_file(fin, routes, grid, months={date.month: instant_fields})
+                keys, timestamp = proc_initial_month(date.month, gribfile, routes, grid, handles, keys, timestamp,
+                                                     once)
         next_chained = i < len(dates) - 1 and (os.path.realpath(cur_grib_file) ==
                                                os.path.realpath(file_list[dates[i + 1]][0]))
-        with open(cur_grib_file, 'r') as fin:
+        with open(cur_grib_file, read_mode()) as fin:
             log.info("Filtering grib file %s..." % os.path.abspath(cur_grib_file))
             if next_chained:
-                keys, timestamp = proc_grib_file(grib_file.create_grib_file(fin), keys2files, grid, handles, keys,
-                                                 timestamp, once, cache)
+                keys, timestamp = proc_grib_file(open_grib_file(fin, routes, grid), routes, grid, handles,
+                                                 keys, timestamp, once)
             else:
-                proc_final_month(date.month, grib_file.create_grib_file(fin), keys2files, grid, handles, keys,
-                                 timestamp, once, cache)
+                gribfile = open_grib_file(fin, routes, grid, months={date.month: all_fields,
+                                                                     date.month % 12 + 1: accumulated_fields})
+                proc_final_month(date.month, gribfile, routes, grid, handles, keys, timestamp, once)
+
+
+# Filters the monthly files in a pool of processes. The work is split by month file and by disjoint groups of
+# output files, every worker writes to its own shard files which are appended to the output in time order.
+def filter_grib_files_parallel(file_lists, keys2files, grids, handles, prev_keys, prev_timestamps, nprocs):
+    nfiles = sum([len(file_list) for file_list in file_lists])
+    if nfiles == 0:
+        return
+    ngroups = max(1, -(-nprocs // nfiles))
+    groups = group_output_files(keys2files, ngroups)
+    groups_routes = [build_routes({k: set([v for v in fset if v[0] in group]) for k, fset in keys2files.items()})
+                     for group in groups]
+    jobs = []
+    for file_list, grid, keys, timestamp in zip(file_lists, grids, prev_keys, prev_timestamps):
+        dates = sorted(file_list.keys())
+        for date in dates:
+            for group, group_routes in zip(groups, groups_routes):
+                if not any(group_routes):
+                    continue
+                first = (date == dates[0])
+                jobs.append((file_list, grid, date, group, group_routes, keys if first else set(),
+                             timestamp if first else -1))
+    # The indices are built once here, the forked workers inherit them instead of each scanning the same files
+    for file_list in file_lists:
+        for path in file_list.values():
+            for index_path in [path, preceding_files.get(path, None)]:
+                if index_path is not None and os.path.isfile(index_path):
+                    grib_index.get_index(index_path)
+    handles.flush()
+    log.info("Filtering %d month files in %d jobs using %d processes..." % (nfiles, len(jobs), nprocs))
+    pool = multiprocessing.Pool(processes=min(nprocs, len(jobs)))
+    try:
+        shards = pool.map(filter_worker, jobs)
+    finally:
+        pool.close()
+        pool.join()
+    shard_list = sorted(zip([(job[2], job[1]) for job in jobs], shards), key=lambda s: s[0])
+    for order, shard_files in shard_list:
+        for fname, shard in shard_files.items():
+            shard_path = os.path.join(temp_dir, shard)
+            with open(shard_path, read_mode()) as fin:
+                if fname in handles:
+                    shutil.copyfileobj(fin, handles[fname], 16 * 1024 * 1024)
+                else:
+                    with open(os.path.join(temp_dir, fname), 'a' if grib_file.test_mode else 'ab') as fout:
+                        shutil.copyfileobj(fin, fout, 16 * 1024 * 1024)
+            os.remove(shard_path)
+
+
+# Worker function filtering a single month file into shards for a group of output files
+def filter_worker(job):
+    file_list, grid, date, fnames, routes, prev_keys, prev_timestamp = job
+    shards = {f: '.'.join([f, "shard", str(grid), "%04d%02d" % (date.year, date.month)]) for f in fnames}
+    handles = file_pool({f: os.path.join(temp_dir, shards[f]) for f in fnames}, get_max_open_files(len(fnames)))
+    try:
+        filter_grib_files(file_list, routes, grid, handles, month=date.month, year=date.year, once=False,
+                          prev_keys=set(prev_keys), prev_timestamp=prev_timestamp)
+    finally:
+        handles.close()
+    return shards
+
+
+# Distributes the output files over groups with approximately equal numbers of routed records
+def group_output_files(keys2files, ngroups):
+    counts = {}
+    for key, fileset in keys2files.items():
+        weight = 1
+        if key[3] == -1:
+            weight = max(1, len([k for k in varsfreq if k[:3] == key[:3]]))
+        for f in fileset:
+            counts[f[0]] = counts.get(f[0], 0) + weight
+    groups, loads = [[] for _ in range(ngroups)], [0] * ngroups
+    for f in sorted(counts.keys(), key=lambda x: (-counts[x], x)):
+        i = loads.index(min(loads))
+        groups[i].append(f)
+        loads[i] += counts[f]
+    return [g for g in groups if any(g)]
 
 
 # Function writing data from previous monthly file, writing the 0-hour fields
-def proc_initial_month(month, gribfile, keys2files, gridtype, handles, prev_keys=(), prev_timestamp=-1, once=False,
-                       ff_cache=None):
+def proc_initial_month(month, gribfile, routes, gridtype, handles, prev_keys=(), prev_timestamp=-1, once=False):
     timestamp = prev_timestamp
     keys = prev_keys
-    fast_forward_count = 0
-    while gribfile.read_next(headers_only=(fast_forward_count > 0)) and (handles is None or any(handles.keys())):
-        key, fast_forward_count, cycle, timestamp = next_record(gribfile, fast_forward_count, timestamp, gridtype,
-                                                                ff_cache, keys)
+    while gribfile.read_next() and (handles is None or any(handles.keys())):
+        key, cycle, timestamp = next_record(gribfile, timestamp, gridtype, keys)
         if cycle:
             gribfile.release()
             continue
         date = gribfile.get_field(grib_file.date_key)
         if (date % 10 ** 4) // 10 ** 2 == month:
             if (key[0], key[1]) not in accum_codes:
-                write_record(gribfile, key + (gridtype,), keys2files, handles=handles, once=once, setdate=None)
+                write_record(gribfile, key + (gridtype,), routes, handles=handles, once=once, setdate=None)
         gribfile.release()
     return keys, timestamp
 
 
 # Function writing data from previous monthly file, writing the 0-hour fields
-def proc_grib_file(gribfile, keys2files, gridtype, handles, prev_keys=(), prev_timestamp=-1, once=False, ff_cache=None):
+def proc_grib_file(gribfile, routes, gridtype, handles, prev_keys=(), prev_timestamp=-1, once=False):
     timestamp = prev_timestamp
     keys = prev_keys
-    fast_forward_count = 0
-    while gribfile.read_next(headers_only=(fast_forward_count > 0)) and (handles is None or any(handles.keys())):
-        key, fast_forward_count, cycle, timestamp = next_record(gribfile, fast_forward_count, timestamp, gridtype,
-                                                                ff_cache, keys)
+    while gribfile.read_next() and (handles is None or any(handles.keys())):
+        key, cycle, timestamp = next_record(gribfile, timestamp, gridtype, keys)
         if cycle:
             gribfile.release()
             continue
-        write_record(gribfile, key + (gridtype,), keys2files, shift=-1 if (key[0], key[1]) in accum_codes else 0,
+        write_record(gribfile, key + (gridtype,), routes, shift=-1 if (key[0], key[1]) in accum_codes else 0,
                      handles=handles, once=once, setdate=None)
         gribfile.release()
     return keys, timestamp
 
 
 # Function writing data from previous monthly file, writing the 0-hour fields
-def proc_final_month(month, gribfile, keys2files, gridtype, handles, prev_keys=(), prev_timestamp=-1, once=False,
-                     ff_cache=None):
+def proc_final_month(month, gribfile, routes, gridtype, handles, prev_keys=(), prev_timestamp=-1, once=False):
     timestamp = prev_timestamp
     keys = prev_keys
-    fast_forward_count = 0
-    while gribfile.read_next(headers_only=(fast_forward_count > 0)) and (handles is None or any(handles.keys())):
-        key, fast_forward_count, cycle, timestamp = next_record(gribfile, fast_forward_count, timestamp, gridtype,
-                                                                ff_cache, keys)
+    while gribfile.read_next() and (handles is None or any(handles.keys())):
+        key, cycle, timestamp = next_record(gribfile, timestamp, gridtype, keys)
         if cycle:
             gribfile.release()
             continue
         date = gribfile.get_field(grib_file.date_key)
         mon = (date % 10 ** 4) // 10 ** 2
         if mon == month:
-            write_record(gribfile, key + (gridtype,), keys2files, shift=-1 if (key[0], key[1]) in accum_codes else 0,
+            write_record(gribfile, key + (gridtype,), routes, shift=-1 if (key[0], key[1]) in accum_codes else 0,
                          handles=handles, once=once, setdate=None)
         elif mon == month % 12 + 1:
             if (key[0], key[1]) in accum_codes:
-                write_record(gribfile, key + (gridtype,), keys2files, shift=-1, handles=handles, once=once,
+                write_record(gribfile, key + (gridtype,), routes, shift=-1, handles=handles, once=once,
                              setdate=None)
         gribfile.release()
     return keys, timestamp
 
 
-def next_record(gribfile, ffwd_count, prev_time, gridtype, ffwd_cache, keys_cache):
-    if ffwd_count > 0:
-        return None, ffwd_count - 1, True, -1
+# Reads the key of the current record and detects repeated records. Records are compared by date and time, with
+# the skip plan only routed messages are read and consecutive records of a daily field have the same time.
+def next_record(gribfile, prev_time, gridtype, keys_cache):
     key = get_record_key(gribfile, gridtype)
-    t = gribfile.get_field(grib_file.time_key)
-    new_ffwd_count = ffwd_cache.get((t,) + key, 0) if ffwd_cache is not None else 0
-    if new_ffwd_count > 0:
-        return key, new_ffwd_count - 1, True, t
+    t = (gribfile.get_field(grib_file.date_key), gribfile.get_field(grib_file.time_key))
     if t == prev_time and key in keys_cache:
-        return key, new_ffwd_count, True, t
+        return key, True, t
     if t != prev_time:
         keys_cache.clear()
     keys_cache.add(key)
-    return key, new_ffwd_count, False, t
+    return key, False, t
 
 
 # Writes the grib messages
-def write_record(gribfile, key, keys2files, shift=0, handles=None, once=False, setdate=None):
+def write_record(gribfile, key, routes, shift=0, handles=None, once=False, setdate=None):
     global starttimes
-    var_infos = set()
-    if key[2] == grib_file.hybrid_level_code:
-        for k, v in list(keys2files.items()):
-            if k[:3] == key[:3]:
-                var_infos.update(v)
-    else:
-        f = keys2files.get(key, None)
-        if f is not None:
-            var_infos.update(f)
+    var_infos = get_routes(routes, key)
     if not any(var_infos):
         return
     if setdate is not None:
@@ -627,12 +941,10 @@ def write_record(gribfile, key, keys2files, shift=0, handles=None, once=False, s
     timestamp = gribfile.get_field(grib_file.time_key)
     if shift != 0 and setdate is None:
         freq = varsfreq.get(key, 0)
-        shifttime = timestamp + shift * freq * 100
-        if shifttime < 0 or shifttime >= 2400:
-            newdate, hours = fix_date_time(gribfile.get_field(grib_file.date_key), shifttime // 100)
+        date = gribfile.get_field(grib_file.date_key)
+        newdate, timestamp = shift_date_time(date, timestamp, int(shift * freq))
+        if newdate != date:
             gribfile.set_field(grib_file.date_key, newdate)
-            shifttime = 100 * hours
-        timestamp = int(shifttime)
         gribfile.set_field(grib_file.time_key, timestamp)
     if key[1] == 126 and key[0] in [40, 41, 42]:
         gribfile.set_field(grib_file.levtype_key, grib_file.pressure_level_hPa_code)
@@ -655,13 +967,46 @@ def write_record(gribfile, key, keys2files, shift=0, handles=None, once=False, s
                 del handles[var_info[0]]
         else:
             if handles is None:
-                with open(os.path.join(temp_dir, var_info[0]), 'a') as ofile:
+                with open(os.path.join(temp_dir, var_info[0]), 'a' if grib_file.test_mode else 'ab') as ofile:
                     gribfile.write(ofile)
             else:
                 if not once:
                     log.error("Unexpected missing file handle encountered for code %s" % str(var_info[0]))
 
 
+# Shifts the date and time (hhmm) by the given number of hours, looking up the month shift table
+def shift_date_time(date, time, hours):
+    table_key = (hours, date // 10 ** 2)
+    table = time_shift_tables.get(table_key, None)
+    if table is None:
+        table = build_time_shift_table(date // 10 ** 4, (date % 10 ** 4) // 10 ** 2, hours)
+        time_shift_tables[table_key] = table
+    result = table.get((date, time), None)
+    if result is not None:
+        return result
+    shifttime = time + hours * 100
+    if shifttime < 0 or shifttime >= 2400:
+        newdate, newhours = fix_date_time(date, shifttime // 100)
+        return newdate, 100 * newhours
+    return date, shifttime
+
+
+# Creates the table of shifted dates and times for all whole hours of the month
+def build_time_shift_table(year, month, hours):
+    first_day = datetime.date(year, month, 1).toordinal()
+    shifted_dates = {}
+    table = {}
+    for day in range(calendar.monthrange(year, month)[1]):
+        date = year * 10 ** 4 + month * 10 ** 2 + day + 1
+        for hour in range(24):
+            days, newhour = divmod(hour + hours, 24)
+            if day + days not in shifted_dates:
+                newdate = datetime.date.fromordinal(first_day + day + days)
+                shifted_dates[day + days] = newdate.year * 10 ** 4 + newdate.month * 10 ** 2 + newdate.day
+            table[(date, 100 * hour)] = (shifted_dates[day + days], 100 * newhour)
+    return table
+
+
 # Converts 24 hours into extra days
 def fix_date_time(date, time):
     timestamp = datetime.datetime(year=date // 10 ** 4, month=(date % 10 ** 4) // 10 ** 2,
@@ -0,0 +1,165 @@
+import hashlib
+import logging
+import os
+import tempfile
+import zipfile
+
+import numpy
+
+from ece2cmor3 import grib_file
+
+# Log object.
+log = logging.getLogger(__name__)
+
+# Index columns: byte offset and length of the message, followed by the header keys
+offset_column = 0
+length_column = 1
+key_columns = {grib_file.date_key: 2, grib_file.time_key: 3, grib_file.param_key: 4, grib_file.table_key: 5,
+               grib_file.levtype_key: 6, grib_file.level_key: 7}
+num_columns = 8
+
+# Directory where the index files are stored, assigned by grib_filter
+index_dir = None
+
+# Indices loaded during the current execution, per file path
+indices = {}
+
+
+# Returns the message index of the given grib file, loading it from disk or scanning the file when necessary
+def get_index(path):
+    global indices
+    key = os.path.realpath(path)
+    stat = get_file_stat(key)
+    if key in indices and numpy.array_equal(indices[key][0], stat):
+        return indices[key][1]
+    entries = load_index(key, stat)
+    if entries is None:
+        entries = build_index(key)
+        save_index(key, stat, entries)
+    indices[key] = (stat, entries)
+    return entries
+
+
+# Returns the size and modification time of the file, used to invalidate its index
+def get_file_stat(path):
+    stat = os.stat(path)
+    return numpy.array([stat.st_size, stat.st_mtime_ns], dtype=numpy.int64)
+
+
+# Returns the path of the index file for the given grib file
+def get_index_path(path):
+    if index_dir is None:
+        return None
+    digest = hashlib.md5(path.encode("utf-8")).hexdigest()[:8]
+    return os.path.join(index_dir, '.'.join([os.path.basename(path), digest, "idx", "npz"]))
+
+
+# Scans all message headers in the file and returns the index array
+def build_index(path):
+    log.info("Indexing grib file %s..." % path)
+    rows = []
+    with open(path, 'r' if grib_file.test_mode else 'rb') as fin:
+        gribfile = grib_file.create_grib_file(fin)
+        while gribfile.read_next(headers_only=True):
+            row = [0] * num_columns
+            row[offset_column], row[length_column] = gribfile.get_offset(), gribfile.get_length()
+            for name, column in key_columns.items():
+                row[column] = gribfile.get_field(name)
+            rows.append(row)
+            gribfile.release()
+    return numpy.array(rows, dtype=numpy.int64).reshape(len(rows), num_columns)
+
+
+# Reads the index from disk, returns None if it is missing or outdated
+def load_index(path, stat):
+    index_path = get_index_path(path)
+    if index_path is None or not os.path.isfile(index_path):
+        return None
+    try:
+        with numpy.load(index_path) as data:
+            if numpy.array_equal(data["stat"], stat):
+                return data["entries"]
+    except (IOError, OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile) as e:
+        log.warning("Could not read grib index %s, rebuilding it, reason: %s" % (index_path, str(e)))
+    return None
+
+
+# Writes the index to the index directory, through a temporary file unique to the process so that concurrent writers
+# never clobber each other
+def save_index(path, stat, entries):
+    index_path = get_index_path(path)
+    if index_path is None:
+        return
+    tmp_path = None
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(index_path), prefix=os.path.basename(index_path),
+                                        suffix=".tmp")
+        with os.fdopen(fd, 'wb') as fout:
+            numpy.savez(fout, stat=stat, entries=entries)
+        os.rename(tmp_path, index_path)
+    except (IOError, OSError) as e:
+        log.warning("Could not write grib index %s, reason: %s" % (index_path, str(e)))
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+# Factory method
+def create_indexed_grib_file(file_object_, entries):
+    return indexed_grib_file(file_object_, entries)
+
+
+# Grib file implementation iterating over index entries: header keys are served from the index, the message itself
+# is only read when it needs to be modified or written.
+class indexed_grib_file(grib_file.grib_file):
+
+    def __init__(self, file_object_, entries):
+        super(indexed_grib_file, self).__init__(file_object_)
+        self.reader = grib_file.create_grib_file(file_object_)
+        self.entries = entries
+        self.pos = -1
+        self.loaded = False
+
+    def read_next(self, headers_only=False):
+        self.release()
+        self.pos += 1
+        return self.pos < len(self.entries)
+
+    def load(self):
+        if not self.loaded:
+            entry = self.entries[self.pos]
+            self.loaded = self.reader.read_at(int(entry[offset_column]), int(entry[length_column]))
+            if not self.loaded:
+                log.error("Could not read grib message at offset %d in %s" % (entry[offset_column],
+                                                                              self.file_object.name))
+        return self.loaded
+
+    # Unmodified messages are copied byte-wise from the input file
+    def write(self, file_object_):
+        if self.loaded:
+            self.reader.write(file_object_)
+        else:
+            grib_file.copy_message(self.file_object, self.get_offset(), self.get_length(), file_object_)
+
+    def set_field(self, name, value):
+        if self.load():
+            self.reader.set_field(name, value)
+
+    def get_field(self, name):
+        if not self.loaded and name in key_columns:
+            return int(self.entries[self.pos][key_columns[name]])
+        self.load()
+        return self.reader.get_field(name)
+
+    def get_offset(self):
+        return int(self.entries[self.pos][offset_column])
+
+    def get_length(self):
+        return int(self.entries[self.pos][length_column])
+
+    def release(self):
+        if self.loaded:
+            self.reader.release()
+            self.loaded = False
+
+    def eof(self):
+        return self.pos >= len(self.entries)
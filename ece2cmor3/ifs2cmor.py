@@ -1,14 +1,19 @@
 import cmor
+import copy
 import glob
+import json
 import logging
 import multiprocessing
 import subprocess
 import netCDF4
 import numpy
 import os
+import shutil
+import time
 
 from datetime import datetime, timedelta
-from ece2cmor3 import grib_filter, grib_file, cdoapi, cmor_source, cmor_target, cmor_task, cmor_utils, postproc
+from ece2cmor3 import grib_filter, grib_file, grib_index, cdoapi, cmor_source, cmor_target, cmor_task, cmor_utils, \
+    metadata, postproc
 
 timeshift = timedelta(0)
 # Apply timeshift for instance in case you want manually to add a shift for the piControl:
@@ -40,6 +45,9 @@ start_date_ = None
 # Fast storage temporary path
 temp_dir_ = None
 
+# Directory of the caches kept across legs
+cache_dir_ = None
+
 # Reference date, times will be converted to hours since refdate
 ref_date_ = None
 
@@ -63,6 +71,34 @@ def use_2d_grid():
     return str(os.environ.get("ECE2CMOR3_IFS_GRID_2D", "False")).lower() == "true"
 
 
+# Controls whether post-processing commands share their common leading operators
+def share_cdo_commands():
+    return str(os.environ.get("ECE2CMOR3_IFS_SHARED_CDO", "False")).lower() == "true"
+
+
+# Controls whether tasks differing only in their grib codes are post-processed in a single cdo call
+def batch_cdo_commands():
+    return str(os.environ.get("ECE2CMOR3_IFS_BATCH_CDO", "False")).lower() == "true"
+
+
+# Returns the file recording the durations of the post-processing and cmorization tasks
+def get_task_times_path():
+    return os.environ.get("ECE2CMOR3_IFS_TASK_TIMES", "") or os.path.join(cache_dir_, "ifs_task_times.json")
+
+
+# Returns the directory of the caches kept across legs (first day inspections and task times), configured by the
+# ECE2CMOR3_IFS_CACHE_DIR environment variable and defaulting to a directory per experiment next to the work directory
+def get_cache_dir(parent_dir):
+    return os.environ.get("ECE2CMOR3_IFS_CACHE_DIR", "") or os.path.join(parent_dir, '-'.join([exp_name_, "ifs",
+                                                                                                "cache"]))
+
+
+# Returns the directory of the caches that are only valid for the current leg (grib indices and cdo metadata),
+# removed on cleanup
+def get_leg_cache_dir():
+    return os.path.join(temp_dir_, "cache")
+
+
 # Controls whether to clean up the IFS temporary data
 def cleanup_tmpdir():
     return str(os.environ.get("ECE2CMOR3_IFS_CLEANUP", "True")).lower() != "false"
@@ -91,10 +127,10 @@ def get_output_freq(task):
 #        return grib_filter.read_source_frequency(getattr(task, cmor_task.filter_output_key))
 
 
-# Initializes the processing loop.
-def initialize(path, expname, tableroot, refdate, tempdir=None, autofilter=True):
+# Initializes the processing loop. Without keepcache, the caches kept across legs are replaced by the leg cache.
+def initialize(path, expname, tableroot, refdate, tempdir=None, autofilter=True, keepcache=True):
     global log, exp_name_, table_root_, ifs_gridpoint_files_, ifs_spectral_files_, ifs_init_spectral_file_, \
-        ifs_init_gridpoint_file_, temp_dir_, ref_date_, start_date_, auto_filter_
+        ifs_init_gridpoint_file_, temp_dir_, cache_dir_, ref_date_, start_date_, auto_filter_
 
     exp_name_ = expname
     table_root_ = tableroot
@@ -106,12 +142,16 @@ def initialize(path, expname, tableroot, refdate, tempdir=None, autofilter=True)
     start_date_ = datetime.combine(min(ifs_gridpoint_files_.keys()), datetime.min.time()) - timeshift
     dirname = '-'.join([exp_name_, "ifs", start_date_.isoformat().split('-')[0]])
     temp_dir_ = os.path.join(tmpdir_parent, dirname)
-    if not os.path.exists(temp_dir_):
-        os.makedirs(temp_dir_)
+    leg_cache_dir = get_leg_cache_dir()
+    cache_dir_ = get_cache_dir(tmpdir_parent) if keepcache else leg_cache_dir
+    for d in [temp_dir_, cache_dir_, leg_cache_dir]:
+        if not os.path.exists(d):
+            os.makedirs(d)
+    metadata.cache_dir = leg_cache_dir
     if auto_filter_:
         ini_gpf = None if ifs_init_gridpoint_file_ == list(ifs_gridpoint_files_.values())[0] else ifs_init_gridpoint_file_
         grib_filter.initialize(ifs_gridpoint_files_, ifs_spectral_files_, ini_gpf, ifs_init_spectral_file_,
-                               ifs_preceding_files_, temp_dir_)
+                               ifs_preceding_files_, temp_dir_, indexdir=leg_cache_dir, cachedir=cache_dir_)
     return True
 
 
@@ -273,7 +313,7 @@ def execute(tasks, nthreads=1):
     # Do filtering
     if auto_filter_:
         tasks_todo = tasks_no_filter + grib_filter.execute(tasks_to_filter, filter_files=do_post_process(),
-                                                           multi_threaded=(nthreads > 1))
+                                                           multi_threaded=(nthreads > 1), nprocs=nthreads)
     else:
         tasks_todo = tasks_no_filter
         for task in tasks_to_filter:
@@ -297,20 +337,216 @@ def execute(tasks, nthreads=1):
     for task in list(set(tasks_todo).intersection(mask_tasks)):
         read_mask(task.target.variable, getattr(task, cmor_task.output_path_key))
     proctasks = list(set(tasks_todo).intersection(regular_tasks + fx_tasks))
+    shared_files = []
+    fused_groups = []
+    if do_post_process():
+        fused_groups = postproc.plan_fused_reductions(proctasks, temp_dir_)
+    fused_tasks = set([t for input_files, code, tasklist in fused_groups for t, cmd in tasklist])
+    unfused_tasks = [t for t in proctasks if t not in fused_tasks]
+    cmor_utils.concurrent_writers = np
+    mapper = map
+    if np != 1:
+        pool = multiprocessing.Pool(processes=np)
+        mapper = pool.imap_unordered
+    if do_post_process() and batch_cdo_commands():
+        shared_files.extend(postproc.batch_commands(unfused_tasks, temp_dir_, mapper))
+    shared_commands = []
+    if do_post_process() and share_cdo_commands():
+        shared_commands = postproc.plan_shared_commands(unfused_tasks, temp_dir_)
+    core_budget = postproc.get_core_budget()
+    if do_post_process() and core_budget is not None and np > 1:
+        postproc.plan_threads(proctasks, np, core_budget)
+    task_times_path = get_task_times_path()
+    task_times = load_task_times(task_times_path)
+    proctasks, costs = order_tasks(proctasks, task_times)
+    postproc.apply_fused_reductions(fused_groups, temp_dir_, mapper)
+    shared_files.extend(postproc.apply_shared_commands(shared_commands, mapper))
     if np == 1:
-        for task in proctasks:
-            cmor_worker(task)
+        results = map(timed_cmor_worker, proctasks)
     else:
-        pool = multiprocessing.Pool(processes=np)
-        pool.map(cmor_worker, proctasks)
+        results = pool.imap_unordered(timed_cmor_worker, proctasks, chunksize=1)
+    keys = dict([(get_task_key(t), t) for t in proctasks])
+    for i, (key, duration) in enumerate(results):
+        log.info("Finished task %d/%d, %s, in %.1f seconds" % (i + 1, len(proctasks), key, duration))
+        task_times[key] = {"cost": costs.get(keys[key], None), "duration": duration}
+    if np != 1:
+        pool.close()
+        pool.join()
         for task in proctasks:
             setattr(task, cmor_task.output_path_key, postproc.get_output_path(task, temp_dir_))
+    save_task_times(task_times_path, task_times)
     for job in jobs:
         job.join()
     if cleanup_tmpdir():
+        for path in shared_files:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
         clean_tmp_data(tasks_todo)
 
 
+# Approximate number of hours covered by the frequencies without fixed time step
+plan_freq_hours = {"mon": 730, "monPt": 730, "monC": 730, "yr": 8760, "yrPt": 8760, "dec": 87600}
+
+
+# Ratio of the output to the input volume of a field: cdo and the in-process reductions write NetCDF in single
+# precision (32 bits per value), while IFS packs its grib output with 16 bits per value
+plan_output_factor = 32 / 16
+
+
+# Computes the filtering and post-processing workload of the tasks without executing anything. Returns a dictionary
+# with the filtered files, the cdo commands per task with their estimated input and output volumes, and the tasks that
+# are not supported. The planning works on copies of the tasks and their targets, which may be modified or dismissed.
+def plan(tasks):
+    global log
+    tasks = [copy.copy(t) for t in tasks]
+    for task in tasks:
+        task.target = copy.copy(task.target)
+    supported_tasks = [t for t in filter_tasks(tasks) if t.status == cmor_task.status_initialized]
+    mask_tasks = get_mask_tasks(supported_tasks)
+    script_tasks_no_filter = [t for t in supported_tasks if validate_script_task(t) == "false"]
+    req_ps_tasks, extra_ps_tasks = get_sp_tasks(supported_tasks)
+    tasks_to_filter = mask_tasks + extra_ps_tasks + [t for t in supported_tasks if t not in script_tasks_no_filter]
+    valid_tasks, varstasks = grib_filter.validate_tasks(tasks_to_filter)
+    task2files, task2freqs, fxkeys, keys2files = grib_filter.cluster_files(valid_tasks, varstasks)
+    routes = grib_filter.build_routes(keys2files)
+    inputs = {cmor_source.ifs_grid.point: [ifs_gridpoint_files_[k] for k in sorted(ifs_gridpoint_files_.keys())],
+              cmor_source.ifs_grid.spec: [ifs_spectral_files_[k] for k in sorted(ifs_spectral_files_.keys())]}
+    input_bytes, key_sizes, file_bytes, timestamps = 0, {}, {}, set()
+    columns = [grib_index.key_columns[k] for k in [grib_file.param_key, grib_file.table_key, grib_file.levtype_key,
+                                                   grib_file.level_key]]
+    for grid, paths in inputs.items():
+        for path in paths:
+            input_bytes += os.path.getsize(path)
+            entries = grib_index.get_index(path)
+            if entries.shape[0] == 0:
+                continue
+            keys, inverse = numpy.unique(entries[:, columns], axis=0, return_inverse=True)
+            inverse = inverse.flatten()
+            sizes = numpy.bincount(inverse, weights=entries[:, grib_index.length_column])
+            counts = numpy.bincount(inverse)
+            for key, size, count in zip(keys.tolist(), sizes.tolist(), counts.tolist()):
+                key = grib_filter.make_record_key(key[0], key[1], key[2], key[3], grid) + (grid,)
+                total, n = key_sizes.get(key, (0, 0))
+                key_sizes[key] = (total + int(size), n + count)
+                for filename, freq in grib_filter.get_routes(routes, key):
+                    file_bytes[filename] = file_bytes.get(filename, 0) + int(size)
+            if grid == cmor_source.ifs_grid.point:
+                timestamps.update((entries[:, grib_index.key_columns[grib_file.date_key]] * 10000 +
+                                   entries[:, grib_index.key_columns[grib_file.time_key]]).tolist())
+    leg_hours = get_plan_hours(sorted(timestamps))
+    task_plans = []
+    for task in valid_tasks:
+        if task.status == cmor_task.status_failed or task not in task2files:
+            continue
+        filenames = task2files[task]
+        bytes_read = int(sum([file_bytes.get(f, 0) for f in filenames]))
+        script = getattr(task, cmor_task.postproc_script_key, None)
+        command_string = None
+        if script is None:
+            # Commands are created pointing at the model output, from which the level types are read
+            setattr(task, cmor_task.filter_output_key, inputs[task.source.grid_id()][:1])
+            setattr(task, cmor_task.output_frequency_key, task2freqs[task])
+            command = postproc.create_command(task)
+            if task.status == cmor_task.status_failed:
+                continue
+            command_string = command.create_command()
+        codes = [(c.var_id, c.tab_id) for c in task.source.get_root_codes()]
+        field_sizes = [v for k, v in key_sizes.items() if k[:2] == codes[0] and k[4] == task.source.grid_id()]
+        field_bytes = plan_output_factor * sum([v[0] for v in field_sizes]) / max(1, sum([v[1] for v in field_sizes]))
+        zaxis, levels = cmor_target.get_z_axis(task.target)
+        if levels == [-1]:
+            levels = set([k[3] for k in key_sizes if k[:3] == codes[0] + (grib_file.hybrid_level_code,)])
+        target_hours = plan_freq_hours.get(task.target.frequency, cmor_target.get_freq(task.target))
+        steps = 1 if target_hours <= 0 else max(1, leg_hours // target_hours)
+        task_plans.append({"variable": task.target.variable, "table": task.target.table,
+                           "filtered_files": filenames, "frequency": int(task2freqs[task]), "command": command_string,
+                           "script": script, "bytes_read": bytes_read,
+                           "estimated_output_bytes": int(steps * max(1, len(levels)) * field_bytes)})
+    failed_tasks = [t for t in tasks + tasks_to_filter if t.status == cmor_task.status_failed]
+    unsupported = [{"variable": t.target.variable, "table": t.target.table} for i, t in enumerate(failed_tasks)
+                   if t not in failed_tasks[:i]]
+    return {"input": {"files": sum([len(v) for v in inputs.values()]), "bytes": input_bytes},
+            "filtered_files": [{"name": f, "bytes": file_bytes.get(f, 0)} for f in sorted(set(
+                [f for files in task2files.values() for f in files]))],
+            "tasks": task_plans,
+            "unsupported": unsupported,
+            "totals": {"filtered_bytes": sum(file_bytes.values()),
+                       "cdo_commands": len([p for p in task_plans if p["command"] is not None]),
+                       "bytes_read": sum([p["bytes_read"] for p in task_plans]),
+                       "estimated_output_bytes": sum([p["estimated_output_bytes"] for p in task_plans])}}
+
+
+# Returns the number of hours covered by the sorted time stamps (in yyyymmddhhmm integers), including the last step
+def get_plan_hours(timestamps):
+    if len(timestamps) < 2:
+        return 0
+    times = [datetime.strptime("%012d" % t, "%Y%m%d%H%M") for t in timestamps[:2] + timestamps[-1:]]
+    return int(((times[2] - times[0]) + (times[1] - times[0])).total_seconds() // 3600)
+
+
+# Orders the tasks longest-first. Durations recorded in earlier runs are used where available, the estimated costs of
+# the other tasks are scaled to durations by the recorded tasks. Returns the ordered tasks and their estimated costs.
+def order_tasks(tasks, task_times):
+    costs = {}
+    if do_post_process():
+        for task in tasks:
+            cost = postproc.estimate_cost(task)
+            if cost is not None:
+                costs[task] = cost
+    recorded = [task_times[k] for k in [get_task_key(t) for t in tasks] if k in task_times]
+    recorded = [r for r in recorded if r.get("cost", None) and r.get("duration", None) is not None]
+    scale = sum([r["duration"] for r in recorded]) / sum([r["cost"] for r in recorded]) if any(recorded) else None
+
+    def expected_duration(task):
+        if scale is None:
+            return costs.get(task, 0.)
+        record = task_times.get(get_task_key(task), None)
+        if record is not None and record.get("duration", None) is not None:
+            return record["duration"]
+        return scale * costs.get(task, 0.)
+
+    return sorted(tasks, key=expected_duration, reverse=True), costs
+
+
+# Returns the key of the task in the recorded durations
+def get_task_key(task):
+    return task.target.variable + " in " + task.target.table
+
+
+# Loads the task durations recorded in earlier runs
+def load_task_times(path):
+    if not os.path.isfile(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        log.warning("Could not read task durations from %s: %s" % (path, str(e)))
+        return {}
+
+
+# Saves the recorded task durations for ordering the tasks in the next run
+def save_task_times(path, task_times):
+    tmp_path = '.'.join([path, str(os.getpid()), "tmp"])
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(task_times, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        log.warning("Could not write task durations to %s: %s" % (path, str(e)))
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+# Worker function for parallel cmorization returning the task key and duration
+def timed_cmor_worker(task):
+    start = time.time()
+    cmor_worker(task)
+    return get_task_key(task), time.time() - start
+
+
 # Worker function for parallel cmorization
 def cmor_worker(task):
     if task.status in [cmor_task.status_failed, cmor_task.status_cmorized, cmor_task.status_finished]:
@@ -470,6 +706,7 @@ def clean_tmp_data(tasks):
                         os.remove(dp)
                     except OSError:
                         pass
+    shutil.rmtree(get_leg_cache_dir(), ignore_errors=True)
     if not any(os.listdir(temp_dir_)):
         os.rmdir(temp_dir_)
         temp_dir_ = os.getcwd()
@@ -477,6 +714,15 @@ def clean_tmp_data(tasks):
         log.warning("Skipped removal of nonempty work directory %s" % temp_dir_)
 
 
+# Removes the leg cache of a planning run, with the grib indices and inspections, and the work directory if it is empty
+def clean_plan_data():
+    global temp_dir_
+    shutil.rmtree(get_leg_cache_dir(), ignore_errors=True)
+    if os.path.isdir(temp_dir_) and not any(os.listdir(temp_dir_)):
+        os.rmdir(temp_dir_)
+        temp_dir_ = os.getcwd()
+
+
 # Creates a sub-list of tasks that we believe we can successfully process
 def filter_tasks(tasks):
     global log
@@ -618,6 +864,18 @@ def define_cmor_axes(task):
     create_depth_axes(task)
 
 
+# Returns the variables of the task in the post-processed file, preferably by code, since batched files contain the
+# variables of several tasks
+def get_code_variables(ncvars, task):
+    codestr = str(task.source.get_grib_code().var_id)
+    varlist = [v for v in ncvars if str(getattr(ncvars[v], "code", None)) == codestr]
+    if len(varlist) == 0:
+        varlist = [v for v in ncvars if str(v) == "var" + codestr]
+    if len(varlist) == 0:
+        varlist = [v for v in ncvars if str(v).lower() == task.target.variable]
+    return varlist
+
+
 # Executes a single task
 def execute_netcdf_task(task):
     global log
@@ -658,12 +916,7 @@ def execute_netcdf_task(task):
     try:
         ncvars = dataset.variables
         dataset.set_auto_mask(False)
-        codestr = str(task.source.get_grib_code().var_id)
-        varlist = [v for v in ncvars if str(getattr(ncvars[v], "code", None)) == codestr]
-        if len(varlist) == 0:
-            varlist = [v for v in ncvars if str(v) == "var" + codestr]
-        if len(varlist) == 0:
-            varlist = [v for v in ncvars if str(v).lower() == task.target.variable]
+        varlist = get_code_variables(ncvars, task)
         if task.target.variable == "areacella":
             varlist = ["cell_area"]
         if len(varlist) == 0:
@@ -695,18 +948,12 @@ def execute_netcdf_task(task):
             index += 1
 
         time_selection = None
-        time_stamps = cmor_utils.read_time_stamps(filepath)
-        if any(time_stamps) and len(t_bnds) > 0:
-            time_slice_map = []
-            for bnd in t_bnds:
-                candidates = [t for t in time_stamps if bnd[0] <= t <= bnd[1]]
-                if any(candidates):
-                    time_slice_map.append(time_stamps.index(candidates[0]))
-                else:
-                    log.warning("For variable %s in table %s, no valid time point could be found at %s...inserting "
-                                "missing values" % (task.target.variable, task.target.table, str(bnd[0])))
-                    time_slice_map.append(-1)
-            time_selection = numpy.array(time_slice_map)
+        time_stamps = cmor_utils.read_time_epochs(filepath)
+        if len(time_stamps) > 0 and len(t_bnds) > 0:
+            time_selection = cmor_utils.match_time_bounds(time_stamps, t_bnds)
+            for index in numpy.flatnonzero(time_selection < 0):
+                log.warning("For variable %s in table %s, no valid time point could be found at %s...inserting "
+                            "missing values" % (task.target.variable, task.target.table, str(t_bnds[index][0])))
 
         #mask = getattr(task.target, cmor_target.mask_key, None)
         mask = None
@@ -0,0 +1,251 @@
+import datetime
+import hashlib
+import logging
+import os
+import pickle
+
+import netCDF4
+import numpy
+
+from ece2cmor3 import grib_file, grib_index
+
+# Log object.
+log = logging.getLogger(__name__)
+
+# Query results per file path, stored together with the file size and modification time
+cache = {}
+
+# Directory of the disk cache shared by the worker processes, no disk cache is used when None
+cache_dir = None
+
+# Grib level types selected by the cdo z-axis names, with the factors converting the levels to cdo units
+zaxis_level_types = {"pressure": {grib_file.pressure_level_hPa_code: 100.0, 99: 1.0,
+                                  grib_file.pressure_level_Pa_code: 1.0},
+                     "height": {grib_file.height_level_code: 1.0},
+                     "hybrid": {grib_file.hybrid_level_code: 1.0},
+                     "surface": {grib_file.surface_level_code: 1.0}}
+
+netcdf_format = "netcdf"
+grib_format = "grib"
+
+
+# Returns the time stamps of the file like cdo showtimestamp, or None if the file cannot be inspected in-process and
+# no fallback is given
+def get_time_stamps(path, fallback=None):
+    return query(path, "timestamps", (), read_time_stamps, fallback)
+
+
+# Returns the time stamps of the file as int64 seconds since 1970, or None if the file cannot be inspected in-process
+def get_time_epochs(path):
+    return query(path, "epochs", (), read_time_epochs)
+
+
+# Returns the grid description of the file like cdo griddes, or None if the file cannot be inspected in-process and
+# no fallback is given
+def get_grid_descr(path, fallback=None):
+    return query(path, "griddes", (), read_grid_descr, fallback)
+
+
+# Returns the level types of the grib code like cdo showltype, or None if the file cannot be inspected in-process and
+# no fallback is given
+def get_z_axes(path, code, fallback=None):
+    return query(path, "ltypes", (code,), read_z_axes, fallback)
+
+
+# Returns the levels of the grib code on the cdo z-axis like cdo showlevel, or None if the file cannot be inspected
+# in-process and no fallback is given
+def get_levels(path, code, axis, fallback=None):
+    return query(path, "levels", (code, axis), read_levels, fallback)
+
+
+# Returns the grib codes in the file like cdo showcode, or None if the file cannot be inspected in-process and no
+# fallback is given
+def get_codes(path, fallback=None):
+    return query(path, "codes", (), read_codes, fallback)
+
+
+# Looks up the query result in the memory and disk caches, or computes it for supported files. When the file cannot
+# be inspected in-process, the result of fallback(path, *args) is cached instead.
+def query(path, name, args, func, fallback=None):
+    if not isinstance(path, str) or not os.path.isfile(path):
+        return None
+    key = (os.path.realpath(path), name) + args
+    stat = os.stat(path)
+    file_stat = (stat.st_size, stat.st_mtime_ns)
+    if key in cache and cache[key][0] == file_stat:
+        return cache[key][1]
+    result = load_entry(key, file_stat)
+    if result is None:
+        result = read_entry(path, name, args, func)
+        if result is None and fallback is not None:
+            result = fallback(path, *args)
+            if result is None or len(result) == 0:
+                return result
+        if result is None:
+            return None
+        save_entry(key, file_stat, result)
+    cache[key] = (file_stat, result)
+    return result
+
+
+# Computes the query result in-process, returns None if the file is not supported
+def read_entry(path, name, args, func):
+    file_format = get_format(path)
+    if file_format is None:
+        return None
+    try:
+        return func(path, file_format, *args)
+    except Exception as e:
+        log.warning("Could not read %s of file %s in-process, reason: %s" % (name, path, str(e)))
+    return None
+
+
+# Returns the path of the disk cache entry for the query key
+def get_entry_path(key):
+    if cache_dir is None:
+        return None
+    digest = hashlib.md5(repr(key).encode("utf-8")).hexdigest()[:12]
+    return os.path.join(cache_dir, '.'.join([os.path.basename(key[0]), key[1], digest, "pkl"]))
+
+
+# Reads a query result from the disk cache, returns None if it is missing or outdated
+def load_entry(key, file_stat):
+    entry_path = get_entry_path(key)
+    if entry_path is None or not os.path.isfile(entry_path):
+        return None
+    try:
+        with open(entry_path, 'rb') as fin:
+            entry_key, entry_stat, result = pickle.load(fin)
+    except (IOError, EOFError, ValueError, pickle.UnpicklingError) as e:
+        log.warning("Could not read metadata cache %s, reason: %s" % (entry_path, str(e)))
+        return None
+    if entry_key != key or entry_stat != file_stat:
+        return None
+    return result
+
+
+# Writes a query result to the disk cache, where other processes can pick it up
+def save_entry(key, file_stat, result):
+    entry_path = get_entry_path(key)
+    if entry_path is None:
+        return
+    tmp_path = '.'.join([entry_path, str(os.getpid()), "tmp"])
+    try:
+        with open(tmp_path, 'wb') as fout:
+            pickle.dump((key, file_stat, result), fout)
+        os.replace(tmp_path, entry_path)
+    except (IOError, OSError, pickle.PicklingError) as e:
+        log.warning("Could not write metadata cache %s, reason: %s" % (entry_path, str(e)))
+
+
+# Determines the file format from its leading bytes
+def get_format(path):
+    with open(path, 'rb') as f:
+        magic = f.read(4)
+    if magic[:3] == b"CDF" or magic == b"\x89HDF":
+        return netcdf_format
+    if magic == b"GRIB" or grib_file.test_mode:
+        return grib_format
+    return None
+
+
+def read_time_stamps(path, file_format):
+    if file_format == grib_format:
+        entries = get_grib_entries(path)
+        date_col = grib_index.key_columns[grib_file.date_key]
+        time_col = grib_index.key_columns[grib_file.time_key]
+        stamps = entries[:, date_col] * 10 ** 4 + entries[:, time_col]
+        unique_stamps, first = numpy.unique(stamps, return_index=True)
+        result = []
+        for stamp in unique_stamps[numpy.argsort(first)].tolist():
+            date, time = stamp // 10 ** 4, stamp % 10 ** 4
+            result.append(datetime.datetime(year=date // 10 ** 4, month=(date % 10 ** 4) // 10 ** 2,
+                                            day=date % 10 ** 2, hour=time // 100, minute=time % 100))
+        return result
+    with netCDF4.Dataset(path, 'r') as ds:
+        timevar = find_variable(ds, "time", "T")
+        if timevar is None or timevar.size == 0:
+            return []
+        times = netCDF4.num2date(timevar[:], units=timevar.units, calendar=getattr(timevar, "calendar", "standard"),
+                                 only_use_cftime_datetimes=False, only_use_python_datetimes=True)
+        return [round_seconds(t) for t in times]
+
+
+def read_time_epochs(path, file_format):
+    time_stamps = get_time_stamps(path)
+    return None if time_stamps is None else numpy.array(time_stamps, dtype="datetime64[s]").astype(numpy.int64)
+
+
+def read_grid_descr(path, file_format):
+    if file_format != netcdf_format:
+        return None
+    with netCDF4.Dataset(path, 'r') as ds:
+        latvar, lonvar = find_variable(ds, "latitude", "Y"), find_variable(ds, "longitude", "X")
+        if latvar is None or lonvar is None or len(latvar.shape) != 1 or len(lonvar.shape) != 1:
+            return None
+        yvals, xvals = numpy.array(latvar[:], dtype=numpy.float64), numpy.array(lonvar[:], dtype=numpy.float64)
+    ny, nx = len(yvals), len(xvals)
+    result = {"gridsize": nx * ny, "xsize": nx, "ysize": ny, "xvals": xvals, "yvals": yvals}
+    if ny > 1 and numpy.allclose(numpy.sort(yvals), get_gaussian_latitudes(ny), atol=1.e-3):
+        result["gridtype"] = "gaussian"
+        result["np"] = ny // 2
+    elif ny > 1 and numpy.allclose(numpy.diff(yvals), yvals[1] - yvals[0]):
+        result["gridtype"] = "lonlat"
+    else:
+        return None
+    return result
+
+
+def read_z_axes(path, file_format, code):
+    if file_format != grib_format or not isinstance(code, int):
+        return None
+    entries = get_grib_entries(path)
+    levtypes = entries[entries[:, grib_index.key_columns[grib_file.param_key]] == code,
+                       grib_index.key_columns[grib_file.levtype_key]]
+    unique_types, first = numpy.unique(levtypes, return_index=True)
+    return unique_types[numpy.argsort(first)].tolist()
+
+
+def read_levels(path, file_format, code, axis):
+    if file_format != grib_format or not isinstance(code, int) or axis not in zaxis_level_types:
+        return None
+    entries = get_grib_entries(path)
+    selected = entries[entries[:, grib_index.key_columns[grib_file.param_key]] == code]
+    result = []
+    for levtype, level in selected[:, [grib_index.key_columns[grib_file.levtype_key],
+                                       grib_index.key_columns[grib_file.level_key]]].tolist():
+        factor = zaxis_level_types[axis].get(levtype, None)
+        if factor is not None and level * factor not in result:
+            result.append(level * factor)
+    return result
+
+
+def read_codes(path, file_format):
+    if file_format == grib_format:
+        params = get_grib_entries(path)[:, grib_index.key_columns[grib_file.param_key]]
+        unique_params, first = numpy.unique(params, return_index=True)
+        return unique_params[numpy.argsort(first)].tolist()
+    with netCDF4.Dataset(path, 'r') as ds:
+        return [int(getattr(v, "code")) for v in ds.variables.values() if hasattr(v, "code")]
+
+
+# Returns the message index of the grib file
+def get_grib_entries(path):
+    return grib_index.get_index(path)
+
+
+# Finds the coordinate variable by standard name or axis attribute
+def find_variable(ds, standard_name, axis):
+    for v in ds.variables.values():
+        if getattr(v, "standard_name", None) == standard_name or getattr(v, "axis", None) == axis:
+            return v
+    return None
+
+
+# Returns the latitudes of the gaussian grid with the given number of latitudes, in increasing order
+def get_gaussian_latitudes(ny):
+    return numpy.degrees(numpy.arcsin(numpy.polynomial.legendre.leggauss(ny)[0]))
+
+
+def round_seconds(t):
+    return (t + datetime.timedelta(microseconds=500000)).replace(microsecond=0)
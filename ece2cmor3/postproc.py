@@ -1,8 +1,12 @@
+import copy
+import hashlib
 import logging
+import multiprocessing
 import threading
 import re
 import queue
 import os
+import shutil
 
 from ece2cmor3 import cmor_task
 
@@ -10,6 +14,7 @@ from . import grib_file
 from . import cdoapi
 from . import cmor_source
 from . import cmor_target
+from . import reduction
 
 # Log object
 log = logging.getLogger(__name__)
@@ -17,6 +22,16 @@ log = logging.getLogger(__name__)
 # Threading parameters
 cdo_threads = 4
 
+# Core budget shared by the cdo commands of the worker pool: the number of cores, the pool size and the shared array of
+# used cores, running commands and pending tasks
+core_budget = None
+pool_size = 1
+thread_state = None
+
+# Cost factors of operators that are expensive per input field
+costly_operators = {cdoapi.cdo_command.spectral_operator: 4.0, cdoapi.cdo_command.ml2pl_operator: 3.0,
+                    cdoapi.cdo_command.ml2hl_operator: 3.0}
+
 # Flags to control whether to execute cdo.
 skip = 1
 append = 2
@@ -26,6 +41,15 @@ modes = [skip, append, recreate]
 # Mode for post-processing
 mode = 3
 
+# Operators worth materializing when they are shared by several commands
+shared_operators = [cdoapi.cdo_command.spectral_operator, cdoapi.cdo_command.gridtype_operator,
+                    cdoapi.cdo_command.ml2pl_operator, cdoapi.cdo_command.ml2hl_operator,
+                    cdoapi.cdo_command.timselmean_operator, cdoapi.cdo_command.timselmin_operator,
+                    cdoapi.cdo_command.timselmax_operator] + \
+                   [t + o for t in [cdoapi.cdo_command.year, cdoapi.cdo_command.month, cdoapi.cdo_command.day]
+                    for o in [cdoapi.cdo_command.mean, cdoapi.cdo_command.min, cdoapi.cdo_command.max,
+                              cdoapi.cdo_command.sum]]
+
 
 # Post-processes a task
 def post_process(task, path, do_postprocess):
@@ -42,6 +66,218 @@ def post_process(task, path, do_postprocess):
         setattr(task, cmor_task.output_path_key, output_path)
 
 
+# Plans the post-processing commands of the tasks as a tree of operator chains per input file. Shared leading parts
+# of the chains containing expensive operators are to be executed once, after which the tasks apply their remaining
+# operators to the stored intermediate result. Returns the shared commands as tuples of the intermediate file, the
+# command, the input files, the number of shared operators and the tasks.
+def plan_shared_commands(tasks, path):
+    global mode, cdo_threads
+    if mode == skip or path is None:
+        return []
+    chains = {}
+    for task in tasks:
+        if task.status != cmor_task.status_initialized or not any(getattr(task, cmor_task.filter_output_key, [])):
+            continue
+        if mode == append and os.path.exists(get_output_path(task, path)):
+            continue
+        # Commands are created for a copy, since creating a command may alter the task
+        task_copy = copy.copy(task)
+        command = create_command(task_copy)
+        if task_copy.status == cmor_task.status_failed:
+            continue
+        keys = command.get_ordered_keys()
+        chain = tuple(zip(reversed(keys), command.get_chain()))
+        chains[task] = (get_input_string(getattr(task, cmor_task.filter_output_key)), chain, command)
+    counts = {}
+    for input_string, chain, command in chains.values():
+        for n in range(1, len(chain) + 1):
+            counts[(input_string, chain[:n])] = counts.get((input_string, chain[:n]), 0) + 1
+    prefixes = {}
+    for task, (input_string, chain, command) in chains.items():
+        for n in range(len(chain), 0, -1):
+            if counts[(input_string, chain[:n])] > 1 and any([k in shared_operators for k, o in chain[:n]]):
+                prefixes.setdefault((input_string, chain[:n]), []).append(task)
+                break
+    result = []
+    for (input_string, chain), tasklist in prefixes.items():
+        digest = hashlib.md5(' '.join([input_string] + [o for k, o in chain]).encode("utf-8")).hexdigest()
+        prefix_path = os.path.join(path, "prefix_" + digest[:16] + ".nc")
+        inner = chains[tasklist[0]][2].split(len(chain))[1]
+        result.append((prefix_path, inner, getattr(tasklist[0], cmor_task.filter_output_key), len(chain), tasklist))
+    return result
+
+
+# Executes the shared commands with the map function, e.g. of the worker pool, and lets the tasks of the successful
+# ones continue from the intermediate file. Returns the list of intermediate files.
+def apply_shared_commands(shared_commands, mapper=map):
+    global log
+    jobs = [(prefix_path, command, input_files) for prefix_path, command, input_files, n, tasks in shared_commands]
+    succeeded = set(mapper(apply_shared_command, jobs))
+    result = []
+    for prefix_path, command, input_files, n, tasklist in shared_commands:
+        if prefix_path not in succeeded:
+            log.warning("Shared cdo command %s failed, tasks will execute their full command" %
+                        command.create_command())
+            continue
+        for task in tasklist:
+            setattr(task, "cdo_prefix", (prefix_path, n))
+        result.append(prefix_path)
+    return result
+
+
+# Worker function executing a shared command into a single precision NetCDF intermediate file, returns the file or
+# None if the command failed
+def apply_shared_command(job):
+    global log
+    prefix_path, command, input_files = job
+    log.info("Executing shared cdo command %s on %s" % (command.create_command(), get_input_string(input_files)))
+    if apply_cached(command, input_files, prefix_path, data_type="F32") is None or not os.path.isfile(prefix_path):
+        return None
+    return prefix_path
+
+
+# Operators that make a command specific to its task
+task_operators = [cdoapi.cdo_command.expression_operator, cdoapi.cdo_command.add_expression_operator,
+                  cdoapi.cdo_command.post_expr_operator, cdoapi.cdo_command.post_addexpr_operator,
+                  cdoapi.cdo_command.set_code_operator, cdoapi.cdo_command.area_operator]
+
+
+# Groups the tasks by their post-processing command without the code selection, the grib table of the code, the
+# source grid, the accumulation type and the target and output frequencies. Returns the groups of at least two tasks
+# as lists of the task, its command without code selection and its code.
+def group_batch_commands(tasks):
+    groups = {}
+    for task in tasks:
+        if task.status != cmor_task.status_initialized or not any(getattr(task, cmor_task.filter_output_key, [])):
+            continue
+        if getattr(task.source, cmor_source.expression_key, None) is not None or \
+                getattr(task.source, cmor_source.mask_expression_key, None) is not None:
+            continue
+        task_copy = copy.copy(task)
+        command = create_command(task_copy)
+        if task_copy.status == cmor_task.status_failed or any([k in task_operators for k in command.operators]):
+            continue
+        codes = command.operators.get(cdoapi.cdo_command.select_code_operator, [])
+        if len(codes) != 1:
+            continue
+        command.operators.pop(cdoapi.cdo_command.select_code_operator)
+        is_accum = any([c in cmor_source.ifs_source.grib_codes_accum for c in task.source.get_root_codes()])
+        key = (command.create_command(), task.source.get_grib_code().tab_id, task.source.grid_id(), is_accum,
+               cmor_target.get_freq(task.target), getattr(task, cmor_task.output_frequency_key, 0))
+        groups.setdefault(key, []).append((task, command, codes[0]))
+    return [tasklist for tasklist in groups.values() if len(tasklist) > 1]
+
+
+# Executes the groups of tasks with identical post-processing commands up to their selected codes in a single cdo call
+# each, producing a multi-variable NetCDF file. The tasks pick their variable from this file by code. The groups are
+# executed by the mapper, e.g. the imap_unordered method of a process pool. Returns the list of produced files.
+def batch_commands(tasks, path, mapper=map):
+    global mode, cdo_threads
+    if mode != recreate or path is None:
+        return []
+    groups = group_batch_commands(tasks)
+    jobs = []
+    for i, tasklist in enumerate(groups):
+        codes = sorted(set([c for t, cmd, c in tasklist]))
+        input_files = []
+        for task, cmd, code in tasklist:
+            input_files.extend([f for f in getattr(task, cmor_task.filter_output_key) if f not in input_files])
+        command = tasklist[0][1]
+        command.add_operator(cdoapi.cdo_command.select_code_operator, *codes)
+        input_string = get_input_string(input_files)
+        comm_string = command.create_command()
+        digest = hashlib.md5(' '.join([input_string, comm_string]).encode("utf-8")).hexdigest()
+        output_path = os.path.join(path, "batch_" + digest[:16] + ".nc")
+        log.info("Post-processing targets %s from %s in a single cdo command %s" %
+                 (', '.join([t.target.variable + " in " + t.target.table for t, cmd, c in tasklist]), input_string,
+                  comm_string))
+        jobs.append((i, command, input_files, output_path))
+    succeeded = set([i for i, output_path in mapper(apply_batch_command, jobs) if output_path is not None])
+    result = []
+    for (i, command, input_files, output_path), tasklist in zip(jobs, groups):
+        comm_string = command.create_command()
+        if i not in succeeded:
+            log.warning("Batched cdo command %s failed, tasks will be post-processed separately" % comm_string)
+            continue
+        for task, cmd, code in tasklist:
+            setattr(task, "cdo_command", comm_string)
+            setattr(task, cmor_task.output_path_key, output_path)
+            task.next_state()
+            task.next_state()
+        result.append(output_path)
+    return result
+
+
+# Worker function executing a batched cdo command, returns the group index and the output file or None if it failed
+def apply_batch_command(job):
+    i, command, input_files, output_path = job
+    if apply_cached(command, input_files, output_path) is None or not os.path.isfile(output_path):
+        return i, None
+    return i, output_path
+
+
+# Groups the tasks with commands that can be computed in-process from the same input files: interpolations to pressure
+# levels by their output frequency, the other commands by their code. Returns the groups of at least two tasks as tuples
+# of the input files, the code or None for interpolations, and the list of tasks with their commands.
+def plan_fused_reductions(tasks, path):
+    global mode
+    if mode != recreate or path is None or not reduction.use_numpy_reductions():
+        return []
+    groups = {}
+    for task in tasks:
+        if task.status != cmor_task.status_initialized or not any(getattr(task, cmor_task.filter_output_key, [])):
+            continue
+        task_copy = copy.copy(task)
+        command = create_command(task_copy)
+        if task_copy.status == cmor_task.status_failed or reduction.get_stages(command) is None:
+            continue
+        input_files = tuple(getattr(task, cmor_task.filter_output_key))
+        if cdoapi.cdo_command.ml2pl_operator in command.operators:
+            key = (input_files, None, getattr(task, cmor_task.output_frequency_key, 0))
+        else:
+            key = (input_files, command.operators[cdoapi.cdo_command.select_code_operator][0], None)
+        groups.setdefault(key, []).append((task, command))
+    return [(list(key[0]), key[1], tasklist) for key, tasklist in groups.items() if len(tasklist) > 1]
+
+
+# Computes the fused groups with the map function, e.g. of the worker pool, and marks the tasks of the successful groups
+# as post-processed. Returns the list of processed tasks.
+def apply_fused_reductions(groups, path, mapper=map):
+    global log
+    jobs = [(i, input_files, code, [(command, get_output_path(task, path)) for task, command in tasklist])
+            for i, (input_files, code, tasklist) in enumerate(groups)]
+    succeeded = set([i for i, outputs in mapper(apply_fused_reduction, jobs) if outputs is not None])
+    result = []
+    for i, (input_files, code, tasklist) in enumerate(groups):
+        if i not in succeeded:
+            log.warning("Fused reductions of targets %s from %s are not supported, tasks will be post-processed "
+                        "separately" % (', '.join([t.target.variable + " in " + t.target.table for t, cmd in tasklist]),
+                                        get_input_string(input_files)))
+            continue
+        for task, command in tasklist:
+            setattr(task, "cdo_command", command.create_command())
+            setattr(task, cmor_task.output_path_key, get_output_path(task, path))
+            task.next_state()
+            task.next_state()
+        result.extend([t for t, cmd in tasklist])
+    return result
+
+
+# Worker function computing a fused group in a single pass over its input, returns the group index and the output files
+# or None if the group is not supported
+def apply_fused_reduction(job):
+    global log
+    i, input_files, code, commands = job
+    outputs = ', '.join([os.path.basename(output_path) for command, output_path in commands])
+    if code is None:
+        log.info("Interpolating %s to pressure levels from %s with shared interpolation weights" %
+                 (outputs, get_input_string(input_files)))
+        return i, reduction.apply_interpolation_commands([(command, input_files, output_path)
+                                                          for command, output_path in commands])
+    log.info("Computing %s from code %d in a single pass over %s" % (outputs, code, get_input_string(input_files)))
+    return i, reduction.apply_commands(commands, input_files)
+
+
 def get_output_path(task, tmp_path):
     return os.path.join(tmp_path, task.target.variable + "_" + task.target.table + ".nc") if tmp_path else None
 
@@ -84,20 +320,32 @@ def apply_command(command, task, output_path=None):
         log.error("Cannot execute cdo command %s for given task because it has no model "
                   "output attribute" % command.create_command())
         return None
-    if len(input_files) > 1:
-        log.warning("Task %s in table %s appears to have multiple filtered output files, taking first file %s" %
-                    (task.target.variable, task.target.table, input_files[0]))
-    input_file = input_files[0]
+    input_file = get_input_string(input_files)
     comm_string = command.create_command()
     log.info("Post-processing target %s in table %s from file %s with cdo command %s" % (
         task.target.variable, task.target.table, input_file, comm_string))
     setattr(task, "cdo_command", comm_string)
+    prefix = getattr(task, "cdo_prefix", None)
+    if prefix is not None and os.path.isfile(prefix[0]):
+        command = command.split(prefix[1])[0]
+        input_files = [prefix[0]]
+        input_file = prefix[0]
+        log.info("Applying remaining cdo command %s to shared intermediate file %s" % (command.create_command(),
+                                                                                     input_file))
     task.next_state()
     result = None
     if mode != skip:
         if mode == recreate or (mode == append and not os.path.exists(output_path)):
             merge_expr = (cdoapi.cdo_command.set_code_operator in command.operators)
-            result = command.apply(input_file, output_path, cdo_threads, grib_first=merge_expr)
+            if reduction.use_numpy_reductions() and prefix is None and reduction.get_stages(command) is not None:
+                result = reduction.apply_command(command, input_files, output_path)
+                if result is not None:
+                    log.info("Computed cdo command %s in-process for target %s in table %s" %
+                             (comm_string, task.target.variable, task.target.table))
+                    task.next_state()
+                    return result
+            result = apply_cached(command, input_files, output_path, grib_first=merge_expr,
+                                  threads=getattr(task, "cdo_threads", None))
             if not result:
                 task.set_failed()
     else:
@@ -108,6 +356,145 @@ def apply_command(command, task, output_path=None):
     return result
 
 
+# Applies the command to the input files, reusing the cached output of an identical earlier execution. The cached
+# output is looked up by the command string, the input file contents and the cdo version.
+def apply_cached(command, input_files, output_path, grib_first=False, data_type=None, threads=None):
+    global log, cdo_threads
+    input_string = get_input_string(input_files)
+    cache_path = get_cache_path(command, input_files, output_path, grib_first, data_type)
+    if cache_path is not None and os.path.isfile(cache_path):
+        log.info("Reusing cached output %s of cdo command %s" % (cache_path, command.create_command()))
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        try:
+            os.link(cache_path, output_path)
+        except OSError:
+            shutil.copyfile(cache_path, output_path)
+        return output_path
+    nthreads = cdo_threads if threads is None else acquire_threads(threads)
+    try:
+        result = command.apply(input_string, output_path, nthreads, grib_first=grib_first, data_type=data_type)
+    finally:
+        if threads is not None:
+            release_threads(nthreads)
+    if result is not None and cache_path is not None and os.path.isfile(output_path):
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = cache_path + ".%d.tmp" % os.getpid()
+        shutil.copyfile(output_path, tmp_path)
+        os.replace(tmp_path, cache_path)
+    return result
+
+
+# Returns the number of cores shared by the cdo commands of the worker pool, or None if every command uses cdo_threads
+def get_core_budget():
+    budget = os.environ.get("ECE2CMOR3_CDO_CORE_BUDGET", "")
+    if budget.lower() == "auto":
+        return multiprocessing.cpu_count()
+    return int(budget) if budget else None
+
+
+# Estimates the post-processing cost of the task from its input size and the expensive operators in its command
+def estimate_cost(task):
+    input_files = [f for f in getattr(task, cmor_task.filter_output_key, []) if os.path.isfile(f)]
+    if not any(input_files):
+        return None
+    # Commands are created for a copy, since creating a command may alter the task
+    task_copy = copy.copy(task)
+    command = create_command(task_copy)
+    if task_copy.status == cmor_task.status_failed:
+        return None
+    cost = float(max(1, sum([os.path.getsize(f) for f in input_files])))
+    for operator in command.operators:
+        cost *= costly_operators.get(operator, 1.0)
+    return cost
+
+
+# Gives the tasks a number of cdo threads in proportion to their estimated cost, relative to an equal share of the core
+# budget for every pool process. The threads are granted from the shared budget when the commands execute.
+def plan_threads(tasks, nprocs, budget):
+    global log
+    costs = {}
+    for task in tasks:
+        if task.status == cmor_task.status_initialized:
+            cost = estimate_cost(task)
+            if cost is not None:
+                costs[task] = cost
+    if not any(costs):
+        return
+    mean_cost = sum(costs.values()) / len(costs)
+    for task, cost in costs.items():
+        setattr(task, "cdo_threads", max(1, min(budget, int(round(budget * cost / (mean_cost * nprocs))))))
+    init_thread_budget(budget, nprocs, len(costs))
+    log.info("Distributing %d cores over the cdo commands of %d tasks in %d processes" % (budget, len(costs), nprocs))
+
+
+# Creates the shared core budget, before the worker pool is started
+def init_thread_budget(budget, nprocs, ntasks):
+    global core_budget, pool_size, thread_state
+    core_budget = budget
+    pool_size = nprocs
+    thread_state = multiprocessing.Array('i', [0, 0, ntasks])
+
+
+# Grants threads to a cdo command from the shared budget: the requested number if available, more if cores are left idle
+# by the pool processes without pending work
+def acquire_threads(requested):
+    global core_budget, pool_size, thread_state
+    if thread_state is None:
+        return requested
+    with thread_state.get_lock():
+        used, running, pending = thread_state[:]
+        free = max(0, core_budget - used)
+        candidates = max(1, min(pool_size - running, pending))
+        threads = max(1, min(free, max(requested, free // candidates)))
+        thread_state[0], thread_state[1], thread_state[2] = used + threads, running + 1, max(0, pending - 1)
+    return threads
+
+
+# Returns the threads of a finished cdo command to the shared budget
+def release_threads(threads):
+    global thread_state
+    if thread_state is None:
+        return
+    with thread_state.get_lock():
+        thread_state[0] = max(0, thread_state[0] - threads)
+        thread_state[1] = max(0, thread_state[1] - 1)
+
+
+# Returns the directory of the cdo output cache, or None if caching is disabled
+def get_cache_dir():
+    return os.environ.get("ECE2CMOR3_CDO_CACHE", None) or None
+
+
+# Returns the cache location of the output of the command for the input files, or None if the output is not cached
+def get_cache_path(command, input_files, output_path, grib_first=False, data_type=None):
+    cache_dir = get_cache_dir()
+    if cache_dir is None or output_path is None:
+        return None
+    try:
+        identities = [get_file_identity(f) for f in input_files]
+    except OSError:
+        return None
+    key = ' '.join([cdoapi.get_cdo_version(), str(grib_first), str(data_type), command.create_command(),
+                    get_input_string(identities)])
+    digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir, digest[:2], digest + os.path.splitext(output_path)[1])
+
+
+# Returns the identity of a cdo input file: its real path, size and modification time. Rewritten input files get a new
+# identity, without reading their contents.
+def get_file_identity(path):
+    stat = os.stat(path)
+    return ':'.join([os.path.realpath(path), str(stat.st_size), str(stat.st_mtime_ns)])
+
+
+# Returns the cdo input for the filtered output files of a task, multiple files are merged on the fly
+def get_input_string(input_files):
+    if len(input_files) == 1:
+        return input_files[0]
+    return " ".join([cdoapi.cdo_command.make_option(cdoapi.cdo_command.merge_operator, [])] + list(input_files))
+
+
 def mask_rhs(rhs, mask):
     return rhs if mask is None else '(' + rhs + ")/(" + mask + ')'
 
@@ -382,7 +769,7 @@ def add_level_operators(cdo, task):
     level_types = [grib_file.hybrid_level_code, grib_file.pressure_level_hPa_code, grib_file.height_level_code]
     input_files = getattr(task, cmor_task.filter_output_key, [])
     if any(input_files):
-        level_types = cdo.get_z_axes(input_files[0], task.source.get_root_codes()[0].var_id)
+        level_types = cdo.get_z_axes(get_input_string(input_files), task.source.get_root_codes()[0].var_id)
     name = axisinfo.get("standard_name", None)
     if name == "air_pressure":
         add_zaxis_operators(cdo, task, level_types, levels, cdoapi.cdo_command.pressure,
@@ -409,7 +796,8 @@ def add_zaxis_operators(cdo, task, lev_types, req_levs, axis_type, axis_code):
             levels = [float(s) for s in req_levs]
             input_files = getattr(task, cmor_task.filter_output_key, [])
             if any(input_files):
-                levels = cdo.get_levels(input_files[0], task.source.get_root_codes()[0].var_id, axis_type)
+                levels = cdo.get_levels(get_input_string(input_files), task.source.get_root_codes()[0].var_id,
+                                        axis_type)
             if set([float(s) for s in req_levs]) <= set(levels):
                 cdo.add_operator(cdoapi.cdo_command.select_z_operator, axis_type)
                 cdo.add_operator(cdoapi.cdo_command.select_lev_operator, *req_levs)
@@ -0,0 +1,496 @@
+import datetime
+import logging
+import os
+
+import gribapi
+import netCDF4
+import numpy
+
+from ece2cmor3 import cdoapi, grib_file, grib_index, metadata, vinterp
+
+# Log object.
+log = logging.getLogger(__name__)
+
+# Time grouping functions of the cdo statistics intervals
+time_groups = {cdoapi.cdo_command.day: lambda t: (t.year, t.month, t.day),
+               cdoapi.cdo_command.month: lambda t: (t.year, t.month),
+               cdoapi.cdo_command.year: lambda t: t.year}
+
+# Time fields of the cdo selection operators
+time_selections = {cdoapi.cdo_command.select + cdoapi.cdo_command.hour: lambda t: t.hour,
+                   cdoapi.cdo_command.select + cdoapi.cdo_command.day: lambda t: t.day,
+                   cdoapi.cdo_command.select + cdoapi.cdo_command.month: lambda t: t.month}
+
+statistics = [cdoapi.cdo_command.mean, cdoapi.cdo_command.min, cdoapi.cdo_command.max, cdoapi.cdo_command.sum]
+
+
+# Returns whether in-process reductions replace cdo for the commands they support
+def use_numpy_reductions():
+    return str(os.environ.get("ECE2CMOR3_IFS_NUMPY_REDUCE", "False")).lower() == "true"
+
+
+# Translates the command to the list of reduction stages in the order of execution, or returns None if the command
+# contains operators that need cdo
+def get_stages(command):
+    keys = command.get_ordered_keys()
+    codes = command.operators.get(cdoapi.cdo_command.select_code_operator, [])
+    if not any(keys) or keys[-1] != cdoapi.cdo_command.select_code_operator:
+        return None
+    interpolate = cdoapi.cdo_command.ml2pl_operator in command.operators
+    if interpolate:
+        zaxes = command.operators.get(cdoapi.cdo_command.select_z_operator, [])
+        if len(codes) != 2 or codes[1] != vinterp.surface_pressure_code or codes[0] == vinterp.geopotential_code or \
+                zaxes != [cdoapi.cdo_command.model_level, cdoapi.cdo_command.surf_level]:
+            return None
+    elif len(codes) != 1:
+        return None
+    stages = []
+    for key in reversed(keys[:-1]):
+        args = command.operators[key]
+        if key == cdoapi.cdo_command.gridtype_operator and args == [cdoapi.cdo_command.regular_grid_type]:
+            stages.append((key, None))
+        elif key == cdoapi.cdo_command.select_z_operator and interpolate:
+            continue
+        elif key == cdoapi.cdo_command.ml2pl_operator:
+            stages.append((key, tuple([float(a) for a in args])))
+        elif key in time_selections:
+            stages.append((key, set([int(a) for a in args])))
+        elif any([key == t + s for t in time_groups for s in statistics]) and not any(args):
+            stages.append((key, None))
+        else:
+            return None
+    return stages
+
+
+# Applies the reduction stages of the command to the input grib files and writes the result to a NetCDF file. Returns
+# the output path or None if the input is not supported, in which case nothing is written.
+def apply_command(command, input_files, output_path):
+    if cdoapi.cdo_command.ml2pl_operator in command.operators:
+        result = apply_interpolation_commands([(command, input_files, output_path)])
+    else:
+        result = apply_commands([(command, output_path)], input_files)
+    return None if result is None else result[0]
+
+
+# Applies the reduction stages of the commands, selecting the same code, in a single pass over the input grib files.
+# Stages shared by the leading parts of the commands are executed once. Returns the list of output paths or None if the
+# input is not supported, in which case nothing is written.
+def apply_commands(commands, input_files):
+    chains = [(get_stages(command), output_path) for command, output_path in commands]
+    if any([stages is None or output_path is None for stages, output_path in chains]):
+        return None
+    if any([cdoapi.cdo_command.ml2pl_operator in command.operators for command, output_path in commands]):
+        return None
+    codes = set([command.operators[cdoapi.cdo_command.select_code_operator][0] for command, path in commands])
+    if len(codes) != 1:
+        return None
+    code = codes.pop()
+    messages = get_messages(input_files, code)
+    if messages is None:
+        return None
+    writers = [netcdf_writer(output_path, code) for stages, output_path in chains]
+    try:
+        root = create_tree([(stages, writer) for (stages, path), writer in zip(chains, writers)])
+        for timestamp, field, grid in read_fields(messages):
+            if field is None:
+                for writer in writers:
+                    writer.discard()
+                return None
+            root.consume(timestamp, field, grid)
+        root.flush()
+    except Exception as e:
+        log.warning("Could not compute %s in-process, reason: %s" % (', '.join([w.path for w in writers]), str(e)))
+        for writer in writers:
+            writer.discard()
+        return None
+    return finish_writers(writers)
+
+
+# Closes the writers and returns their output paths. If any of the writers did not receive data, all outputs are
+# discarded and None is returned.
+def finish_writers(writers):
+    if any([writer.dataset is None for writer in writers]):
+        for writer in writers:
+            writer.discard()
+        return None
+    for writer in writers:
+        writer.close()
+    return [writer.path for writer in writers]
+
+
+# Applies the commands interpolating model level fields to pressure levels in a single pass over their input files. The
+# surface pressure is read once per time step, and the interpolation weights are computed once per time step and set of
+# pressure levels for all fields. Returns the list of output paths or None if the input is not supported, in which case
+# nothing is written.
+def apply_interpolation_commands(commands):
+    chains = [(get_stages(command), output_path) for command, input_files, output_path in commands]
+    if any([stages is None or output_path is None for stages, output_path in chains]):
+        return None
+    codes = [command.operators[cdoapi.cdo_command.select_code_operator][0] for command, files, path in commands]
+    ps_messages = get_messages(commands[0][1], vinterp.surface_pressure_code)
+    if not ps_messages:
+        return None
+    level_messages = []
+    for (command, input_files, output_path), code in zip(commands, codes):
+        messages = get_level_messages(input_files, code)
+        if messages is None or sorted(messages.keys()) != [(m[0], m[1]) for m in ps_messages]:
+            return None
+        level_messages.append(messages)
+    writers = [netcdf_writer(output_path, code) for (stages, output_path), code in zip(chains, codes)]
+    weights_cache = {}
+    try:
+        roots = []
+        for (stages, output_path), code, writer in zip(chains, codes, writers):
+            root = writer
+            for key, args in reversed(stages):
+                if key == cdoapi.cdo_command.ml2pl_operator:
+                    root = pressure_level_stage(args, code, weights_cache, root)
+                else:
+                    root = create_stage(key, args, root)
+            roots.append(root)
+        with message_reader() as reader:
+            for date, time, path, offset, length in ps_messages:
+                timestamp = get_timestamp(date, time)
+                ps, grid, pv = reader.read(path, offset, length)
+                if ps is None:
+                    for writer in writers:
+                        writer.discard()
+                    return None
+                weights_cache.clear()
+                for root, messages in zip(roots, level_messages):
+                    levels = [m[0] for m in messages[(date, time)]]
+                    fields = [reader.read(*m[1:]) for m in messages[(date, time)]]
+                    if any([f[0] is None for f in fields]):
+                        for writer in writers:
+                            writer.discard()
+                        return None
+                    field = numpy.stack([f[0] for f in fields])
+                    root.consume(timestamp, (field, ps, fields[0][2], levels), fields[0][1])
+        for root in roots:
+            root.flush()
+    except Exception as e:
+        log.warning("Could not compute %s in-process, reason: %s" % (', '.join([w.path for w in writers]), str(e)))
+        for writer in writers:
+            writer.discard()
+        return None
+    return finish_writers(writers)
+
+
+# Returns the messages of the code on model levels per (date, time), as lists of (level, file, offset, length) ordered
+# by level, or None if there are no model level messages of the code
+def get_level_messages(input_files, code):
+    date_col, time_col = grib_index.key_columns[grib_file.date_key], grib_index.key_columns[grib_file.time_key]
+    param_col, levtype_col = grib_index.key_columns[grib_file.param_key], grib_index.key_columns[grib_file.levtype_key]
+    level_col = grib_index.key_columns[grib_file.level_key]
+    result = {}
+    for path in input_files:
+        if metadata.get_format(path) != metadata.grib_format or grib_file.test_mode:
+            return None
+        entries = grib_index.get_index(path)
+        selection = (entries[:, param_col] == code) & (entries[:, levtype_col] == grib_file.hybrid_level_code)
+        for entry in entries[selection].tolist():
+            result.setdefault((entry[date_col], entry[time_col]), []).append(
+                (entry[level_col], path, entry[grib_index.offset_column], entry[grib_index.length_column]))
+    for messages in result.values():
+        messages.sort()
+    return result if any(result) else None
+
+
+# Creates the tree of reduction stages feeding the targets, merging the stages shared by the leading parts of the chains
+def create_tree(chains):
+    targets, groups = [], {}
+    for stages, target in chains:
+        if not any(stages):
+            targets.append(target)
+        else:
+            key, args = stages[0]
+            group_key = (key, None if args is None else tuple(sorted(args)))
+            groups.setdefault(group_key, (key, args, []))[2].append((stages[1:], target))
+    for key, args, subchains in groups.values():
+        targets.append(create_stage(key, args, create_tree(subchains)))
+    return targets[0] if len(targets) == 1 else fan_out_stage(targets)
+
+
+# Returns the list of (date, time, file, offset, length) of the messages of the code, ordered in time, or None if the
+# code has several levels or several messages per time step
+def get_messages(input_files, code):
+    date_col, time_col = grib_index.key_columns[grib_file.date_key], grib_index.key_columns[grib_file.time_key]
+    param_col = grib_index.key_columns[grib_file.param_key]
+    result = []
+    for path in input_files:
+        if metadata.get_format(path) != metadata.grib_format or grib_file.test_mode:
+            return None
+        entries = grib_index.get_index(path)
+        for entry in entries[entries[:, param_col] == code].tolist():
+            result.append((entry[date_col], entry[time_col], path, entry[grib_index.offset_column],
+                           entry[grib_index.length_column]))
+    if len(set([(m[0], m[1]) for m in result])) != len(result):
+        return None
+    return sorted(result, key=lambda m: (m[0], m[1]))
+
+
+# Reads the messages and yields the time stamp, field values and grid per message. The values are None for messages
+# with missing values.
+def read_fields(messages):
+    with message_reader() as reader:
+        for date, time, path, offset, length in messages:
+            values, grid, pv = reader.read(path, offset, length)
+            yield get_timestamp(date, time), values, grid
+            if values is None:
+                return
+
+
+def get_timestamp(date, time):
+    return datetime.datetime(date // 10000, (date % 10000) // 100, date % 100, time // 100, time % 100)
+
+
+# Reads grib messages from the files by their offset and length, keeping the files open
+class message_reader:
+
+    def __init__(self):
+        self.files = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+
+    # Returns the field values, the grid and the hybrid coefficients of the message. The values are None if the
+    # message has missing values.
+    def read(self, path, offset, length):
+        if path not in self.files:
+            self.files[path] = open(path, 'rb')
+        f = self.files[path]
+        f.seek(offset)
+        gid = gribapi.grib_new_from_message(f.read(length))
+        try:
+            if gribapi.grib_get(gid, "bitmapPresent", int) != 0:
+                return None, None, None
+            pv = None
+            if gribapi.grib_get(gid, "PVPresent", int) != 0:
+                pv = gribapi.grib_get_array(gid, "pv")
+            return gribapi.grib_get_values(gid).astype(numpy.float64), read_grid(gid), pv
+        finally:
+            gribapi.grib_release(gid)
+
+
+# Reads the gaussian grid of the message: the number of points per latitude for reduced grids, or None for regular
+# grids, the number of latitudes, the number of longitudes of the regular grid, the units and the pressure levels, which
+# are None for single-level fields
+def read_grid(gid):
+    grid_type = gribapi.grib_get(gid, "gridType")
+    ny = gribapi.grib_get(gid, "Nj", int)
+    units = gribapi.grib_get(gid, "units") if gribapi.grib_is_defined(gid, "units") else None
+    if grid_type == "reduced_gg":
+        pl = tuple(gribapi.grib_get_array(gid, "pl", int).tolist())
+        return pl, ny, max(pl), units, None
+    if grid_type == "regular_gg":
+        return None, ny, gribapi.grib_get(gid, "Ni", int), units, None
+    raise Exception("Grid type %s is not supported by numpy reductions" % grid_type)
+
+
+# Creates the reduction stage for the operator
+def create_stage(key, args, target):
+    if key == cdoapi.cdo_command.gridtype_operator:
+        return regular_grid_stage(target)
+    if key in time_selections:
+        return selection_stage(time_selections[key], args, target)
+    for t in time_groups:
+        if key.startswith(t) and key[len(t):] in statistics:
+            return statistics_stage(time_groups[t], key[len(t):], target)
+    raise Exception("Operator %s is not supported by numpy reductions" % key)
+
+
+# Interpolates a field on a reduced gaussian grid linearly along the latitude circles to the regular gaussian grid
+def reduced_to_regular(values, pl, nx):
+    if values.ndim == 2:
+        return numpy.stack([reduced_to_regular(v, pl, nx) for v in values])
+    result = numpy.empty([len(pl), nx])
+    target_lons = numpy.arange(nx) * 360. / nx
+    offset = 0
+    for j, n in enumerate(pl):
+        row = values[offset:offset + n]
+        lons = numpy.arange(n + 1) * 360. / n
+        result[j, :] = numpy.interp(target_lons, lons, numpy.append(row, row[0]))
+        offset += n
+    return result.flatten()
+
+
+# Stage converting the fields to the regular gaussian grid
+class regular_grid_stage:
+
+    def __init__(self, target):
+        self.target = target
+
+    def consume(self, timestamp, field, grid):
+        pl, ny, nx, units, plevs = grid
+        if pl is not None:
+            field = reduced_to_regular(field, pl, nx)
+        self.target.consume(timestamp, field, (None, ny, nx, units, plevs))
+
+    def flush(self):
+        self.target.flush()
+
+
+# Stage interpolating the model level fields to pressure levels. The weights are shared through the cache by all stages
+# interpolating fields at the same time step.
+class pressure_level_stage:
+
+    def __init__(self, plevs, code, weights_cache, target):
+        self.plevs = plevs
+        self.code = code
+        self.weights_cache = weights_cache
+        self.target = target
+
+    def consume(self, timestamp, field, grid):
+        values, ps, pv, levels = field
+        key = (self.plevs, tuple(levels))
+        if key not in self.weights_cache:
+            pfull = vinterp.get_full_level_pressures(pv, ps, levels)
+            self.weights_cache[key] = vinterp.pressure_weights(pfull, ps, self.plevs)
+        result = self.weights_cache[key].interpolate(values, self.code)
+        self.target.consume(timestamp, result, grid[:4] + (self.plevs,))
+
+    def flush(self):
+        self.target.flush()
+
+
+# Stage passing the fields to several stages
+class fan_out_stage:
+
+    def __init__(self, targets):
+        self.targets = targets
+
+    def consume(self, timestamp, field, grid):
+        for target in self.targets:
+            target.consume(timestamp, field, grid)
+
+    def flush(self):
+        for target in self.targets:
+            target.flush()
+
+
+# Stage passing the fields at the selected hours, days or months
+class selection_stage:
+
+    def __init__(self, time_field, values, target):
+        self.time_field = time_field
+        self.values = values
+        self.target = target
+
+    def consume(self, timestamp, field, grid):
+        if self.time_field(timestamp) in self.values:
+            self.target.consume(timestamp, field, grid)
+
+    def flush(self):
+        self.target.flush()
+
+
+# Stage computing the mean, minimum, maximum or sum of the fields over days, months or years. The result carries the
+# time stamp of the last field in the interval.
+class statistics_stage:
+
+    def __init__(self, time_group, statistic, target):
+        self.time_group = time_group
+        self.statistic = statistic
+        self.target = target
+        self.group = None
+        self.timestamp = None
+        self.grid = None
+        self.result = None
+        self.count = 0
+
+    def consume(self, timestamp, field, grid):
+        group = self.time_group(timestamp)
+        if group != self.group:
+            self.emit()
+            self.group = group
+        if self.result is None:
+            self.result = numpy.array(field, dtype=numpy.float64)
+        elif self.statistic == cdoapi.cdo_command.min:
+            numpy.minimum(self.result, field, out=self.result)
+        elif self.statistic == cdoapi.cdo_command.max:
+            numpy.maximum(self.result, field, out=self.result)
+        else:
+            self.result += field
+        self.timestamp, self.grid = timestamp, grid
+        self.count += 1
+
+    def emit(self):
+        if self.result is None:
+            return
+        if self.statistic == cdoapi.cdo_command.mean:
+            self.result /= self.count
+        self.target.consume(self.timestamp, self.result, self.grid)
+        self.result, self.count = None, 0
+
+    def flush(self):
+        self.emit()
+        self.target.flush()
+
+
+# Writes the fields to a NetCDF file with the layout of cdo output
+class netcdf_writer:
+
+    def __init__(self, path, code):
+        self.path = path
+        self.code = code
+        self.dataset = None
+        self.timevar = None
+        self.var = None
+        self.shape = None
+
+    def create(self, timestamp, grid):
+        pl, ny, nx, units, plevs = grid
+        if pl is not None:
+            raise Exception("Cannot write fields on a reduced gaussian grid to NetCDF")
+        self.shape = (ny, nx) if plevs is None else (len(plevs), ny, nx)
+        self.dataset = netCDF4.Dataset(self.path, 'w')
+        self.dataset.createDimension("time", None)
+        self.dataset.createDimension("lon", nx)
+        self.dataset.createDimension("lat", ny)
+        self.timevar = self.dataset.createVariable("time", "f8", ("time",))
+        self.timevar.standard_name = "time"
+        self.timevar.units = timestamp.strftime("hours since %Y-%m-%d 00:00:00")
+        self.timevar.calendar = "proleptic_gregorian"
+        self.timevar.axis = "T"
+        lonvar = self.dataset.createVariable("lon", "f8", ("lon",))
+        lonvar.standard_name, lonvar.units, lonvar.axis = "longitude", "degrees_east", "X"
+        lonvar[:] = numpy.arange(nx) * 360. / nx
+        latvar = self.dataset.createVariable("lat", "f8", ("lat",))
+        latvar.standard_name, latvar.units, latvar.axis = "latitude", "degrees_north", "Y"
+        latvar[:] = metadata.get_gaussian_latitudes(ny)[::-1]
+        dims = ("time", "lat", "lon")
+        if plevs is not None:
+            self.dataset.createDimension("plev", len(plevs))
+            plevvar = self.dataset.createVariable("plev", "f8", ("plev",))
+            plevvar.standard_name, plevvar.units, plevvar.positive, plevvar.axis = "air_pressure", "Pa", "down", "Z"
+            plevvar[:] = plevs
+            dims = ("time", "plev", "lat", "lon")
+        self.var = self.dataset.createVariable("var%d" % self.code, "f4", dims)
+        self.var.code = self.code
+        if units is not None:
+            self.var.units = units
+
+    def consume(self, timestamp, field, grid):
+        if self.dataset is None:
+            self.create(timestamp, grid)
+        index = len(self.timevar)
+        self.timevar[index] = netCDF4.date2num(timestamp, self.timevar.units, self.timevar.calendar)
+        self.var[index, ...] = numpy.reshape(field, self.shape)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.dataset is not None:
+            self.dataset.close()
+            self.dataset = None
+
+    def discard(self):
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
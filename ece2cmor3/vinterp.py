@@ -0,0 +1,60 @@
+import numpy
+
+# Gas constant of dry air, gravitational acceleration and standard atmosphere lapse rate
+gas_constant = 287.04
+gravity = 9.80665
+lapse_rate = 0.0065
+
+# Grib codes of temperature, geopotential and surface pressure
+temperature_code = 130
+geopotential_code = 129
+surface_pressure_code = 134
+
+
+# Computes the full level pressures of the model levels (counted from 1 at the top) from the hybrid coefficients, given
+# as the grib pv array of half-level a and b values, and the surface pressure field
+def get_full_level_pressures(pv, ps, levels):
+    nhalf = len(pv) // 2
+    a, b = numpy.array(pv[:nhalf], dtype=numpy.float64), numpy.array(pv[nhalf:], dtype=numpy.float64)
+    lev = numpy.array(levels, dtype=int)
+    half_up = a[lev - 1, numpy.newaxis] + b[lev - 1, numpy.newaxis] * ps[numpy.newaxis, :]
+    half_down = a[lev, numpy.newaxis] + b[lev, numpy.newaxis] * ps[numpy.newaxis, :]
+    return 0.5 * (half_up + half_down)
+
+
+# Bracketing level indices and linear weights in pressure for interpolating model level fields to pressure levels.
+# Computed once per time step, they apply to every field on the same model levels.
+class pressure_weights:
+
+    def __init__(self, pfull, ps, plevs):
+        nlev, npts = pfull.shape
+        if nlev < 2:
+            raise Exception("Interpolation to pressure levels requires at least two model levels")
+        self.lower = numpy.empty([len(plevs), npts], dtype=int)
+        self.weights = numpy.empty([len(plevs), npts])
+        self.below = numpy.zeros([len(plevs), npts], dtype=bool)
+        for i, p in enumerate(plevs):
+            k = numpy.count_nonzero(pfull < p, axis=0)
+            lower = numpy.clip(k - 1, 0, nlev - 2)
+            p1 = numpy.take_along_axis(pfull, lower[numpy.newaxis, :], 0)[0]
+            p2 = numpy.take_along_axis(pfull, lower[numpy.newaxis, :] + 1, 0)[0]
+            self.lower[i, :] = lower
+            self.weights[i, :] = numpy.clip((p - p1) / (p2 - p1), 0., 1.)
+            self.below[i, :] = (p > ps)
+        self.plevs = numpy.array(plevs, dtype=numpy.float64)
+        self.ps = ps
+        self.p_lowest = pfull[-1, :]
+
+    # Interpolates the model level field, extrapolating constant values above the top and below the lowest model
+    # level, except for temperature which follows the standard atmosphere lapse rate below the surface
+    def interpolate(self, field, code):
+        f1 = numpy.take_along_axis(field, self.lower, 0)
+        f2 = numpy.take_along_axis(field, self.lower + 1, 0)
+        result = f1 + self.weights * (f2 - f1)
+        if code == temperature_code and numpy.any(self.below):
+            alpha = gas_constant * lapse_rate / gravity
+            tstar = field[-1, :] * (1. + alpha * (self.ps / self.p_lowest - 1.))
+            y = alpha * numpy.log(self.plevs[:, numpy.newaxis] / self.ps[numpy.newaxis, :])
+            extrapolated = tstar[numpy.newaxis, :] * (1. + y + y ** 2 / 2. + y ** 3 / 6.)
+            result = numpy.where(self.below, extrapolated, result)
+        return result
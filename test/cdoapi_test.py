@@ -1,4 +1,5 @@
 import logging
+import pickle
 import unittest
 from ece2cmor3 import cdoapi
 
@@ -98,3 +99,16 @@ class cdoapi_tests(unittest.TestCase):
         command.add_operator(cdoapi.cdo_command.month + cdoapi.cdo_command.mean)
         commstr = command.create_command()
         assert commstr == "-expr,'var91=sq(var130)' -monmean -selcode,130"
+
+    @staticmethod
+    def test_split_command():
+        command = cdoapi.cdo_command(130)
+        command.add_operator(cdoapi.cdo_command.spectral_operator)
+        command.add_operator(cdoapi.cdo_command.month + cdoapi.cdo_command.mean)
+        command.add_operator(cdoapi.cdo_command.day + cdoapi.cdo_command.max)
+        assert command.get_chain() == ["-selcode,130", "-sp2gpl", "-daymax", "-monmean"]
+        outer, inner = command.split(3)
+        assert inner.create_command() == "-daymax -sp2gpl -selcode,130"
+        assert outer.create_command() == "-monmean"
+        assert command.create_command() == "-monmean -daymax -sp2gpl -selcode,130"
+        assert pickle.loads(pickle.dumps(inner)).create_command() == inner.create_command()
@@ -2,12 +2,14 @@ import logging
 import unittest
 import os
 import datetime
+import tracemalloc
 
 import netCDF4
 import numpy
 from dateutil.relativedelta import relativedelta
+from ece2cmor3 import cmor_utils
 from ece2cmor3.cmor_utils import make_time_intervals, find_ifs_output, get_ifs_date, find_nemo_output, get_nemo_grid, \
-    group, num2num
+    group, num2num, apply_mask, mask_buffer, get_time_chunk, parse_memory_size
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -134,3 +136,77 @@ class utils_tests(unittest.TestCase):
         new_times, new_units = num2num(nums, ref, units, calender, shift)
         assert new_times[3] == 60
         assert new_units == "days since " + str(ref)
+
+    @staticmethod
+    def test_apply_mask():
+        array = numpy.array([[[1., -999.], [3., 4.]], [[5., 6.], [-999., 8.]]], dtype=numpy.float32)
+        mask = numpy.array([[True, True], [False, True]])
+        expected = numpy.where(array == -999., 1.e+20, 2. * array + 1.).astype(numpy.float32)
+        expected[:, 1, 0] = 1.e+20
+        result = apply_mask(array, 2.0, 1.0, mask, -999., 1.e+20)
+        assert result is array
+        assert numpy.array_equal(result, expected)
+
+    @staticmethod
+    def test_apply_mask_memory():
+        array = numpy.ones((8, 256, 512), dtype=numpy.float32)
+        mask = numpy.ones((256, 512), dtype=bool)
+        scratch = mask_buffer()
+        apply_mask(array, 2.0, 1.0, mask, -999., 1.e+20, scratch)
+        tracemalloc.start()
+        apply_mask(array, 2.0, 1.0, mask, -999., 1.e+20, scratch)
+        size, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        assert peak < array.nbytes / 4
+        assert numpy.all(array == 7.)
+        assert scratch.buffer.size == array.size
+        apply_mask(array[:2], 1.0, 0.0, None, 7., 1.e+20, scratch)
+        assert scratch.buffer.size == array.size
+        assert numpy.all(array[:2] == numpy.float32(1.e+20)) and numpy.all(array[2:] == 7.)
+
+    @staticmethod
+    def test_time_chunk():
+        assert parse_memory_size("16G") == 1.6E+10
+        assert parse_memory_size("512mb") == 5.12E+8
+        path = os.path.join(os.path.dirname(__file__), "tmp", "time_chunk_test.nc")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with netCDF4.Dataset(path, 'w') as ds:
+            ds.createDimension("time", 100)
+            ds.createDimension("lat", 100)
+            ds.createDimension("lon", 100)
+            ds.createVariable("var", "f4", ("time", "lat", "lon"), chunksizes=(7, 100, 100))
+        cmor_utils.memory_budget = 4.0E+6
+        try:
+            with netCDF4.Dataset(path, 'r') as ds:
+                assert get_time_chunk(ds.variables["var"], 0, 100) == 49
+                cmor_utils.concurrent_writers = 4
+                assert get_time_chunk(ds.variables["var"], 0, 100) == 7
+                assert get_time_chunk(numpy.zeros((100, 100, 100)), 0, 100) == 6
+        finally:
+            cmor_utils.memory_budget = None
+            cmor_utils.concurrent_writers = 1
+            os.remove(path)
+
+    @staticmethod
+    def test_prefetch():
+        assert list(cmor_utils.prefetch(lambda i: i * i, list(range(10)), 2)) == [i * i for i in range(10)]
+        assert list(cmor_utils.prefetch(lambda i: -i, [1, 2], 0)) == [-1, -2]
+
+        def read(i):
+            if i == 3:
+                raise ValueError("Read error")
+            return i
+
+        try:
+            list(cmor_utils.prefetch(read, list(range(6)), 2))
+            assert False
+        except ValueError:
+            pass
+
+    @staticmethod
+    def test_match_time_bounds():
+        times = [datetime.datetime(1990, 1, 1, h) for h in [0, 6, 6, 12, 18]]
+        bounds = [(datetime.datetime(1990, 1, 1, h), datetime.datetime(1990, 1, 1, h + 4)) for h in [0, 7, 5, 12]]
+        result = cmor_utils.match_time_bounds(cmor_utils.get_epoch_seconds(times), bounds)
+        assert list(result) == [0, -1, 1, 3]
+        assert list(cmor_utils.match_time_bounds(numpy.array([], dtype=numpy.int64), bounds[:2])) == [-1, -1]
@@ -0,0 +1,139 @@
+import io
+import logging
+import os
+import unittest
+
+import gribapi
+
+from ece2cmor3 import grib_file, grib_filter
+
+logging.basicConfig(level=logging.DEBUG)
+
+tmp_path = os.path.join(os.path.dirname(__file__), "tmp")
+
+
+# Creates a GRIB1 message from the sample with the given header keys
+def make_message(date, time, levtype, level, code=130, table=128):
+    record = gribapi.grib_new_from_samples("GRIB1")
+    try:
+        for key, value in [(grib_file.date_key, date), (grib_file.time_key, time), (grib_file.param_key, code),
+                           (grib_file.table_key, table), (grib_file.levtype_key, levtype)]:
+            gribapi.grib_set(record, key, value)
+        if isinstance(level, tuple):
+            gribapi.grib_set(record, "topLevel", level[0])
+            gribapi.grib_set(record, "bottomLevel", level[1])
+        else:
+            gribapi.grib_set(record, grib_file.level_key, level)
+        return gribapi.grib_get_message(record)
+    finally:
+        gribapi.grib_release(record)
+
+
+# Decodes the header keys of the message with gribapi
+def decode_message(message):
+    record = gribapi.grib_new_from_message(message)
+    try:
+        keys = [grib_file.date_key, grib_file.time_key, grib_file.param_key, grib_file.table_key,
+                grib_file.levtype_key, grib_file.level_key]
+        return {k: gribapi.grib_get_long(record, k) for k in keys}, gribapi.grib_get_long(record, "totalLength")
+    finally:
+        gribapi.grib_release(record)
+
+
+class grib_file_test(unittest.TestCase):
+    messages = [make_message(19991231, 1800, grib_file.surface_level_code, 0),
+                make_message(20000101, 0, grib_file.pressure_level_hPa_code, 850),
+                make_message(20010101, 300, grib_file.pressure_level_hPa_code, 1000),
+                make_message(19000101, 600, grib_file.height_level_code, 2, code=167),
+                make_message(18500101, 1200, grib_file.hybrid_level_code, 300),
+                make_message(21000101, 2100, grib_file.depth_level_code, 289, code=39),
+                make_message(20500615, 900, 112, (10, 100), code=39, table=228)]
+    if not os.path.exists(tmp_path):
+        os.makedirs(tmp_path)
+
+    @staticmethod
+    def write_messages(path):
+        offsets, offset = [], 0
+        with open(path, "wb") as fout:
+            for message in grib_file_test.messages:
+                fout.write(b"padding")
+                offset += len(b"padding")
+                offsets.append(offset)
+                fout.write(message)
+                offset += len(message)
+        return offsets
+
+    @staticmethod
+    def test_mmap_decode_section1():
+        path = os.path.join(tmp_path, "mmap_decode_test.grb")
+        offsets = grib_file_test.write_messages(path)
+        with open(path, "rb") as fin:
+            reader = grib_file.mmap_grib_file(fin)
+            for message, offset in zip(grib_file_test.messages, offsets):
+                fields, length = decode_message(message)
+                assert reader.decode_section1(offset) == fields
+                assert reader.message_length(offset) == length == len(message)
+        os.remove(path)
+
+    @staticmethod
+    def test_mmap_read_next():
+        path = os.path.join(tmp_path, "mmap_read_next_test.grb")
+        offsets = grib_file_test.write_messages(path)
+        with open(path, "rb") as fin:
+            reader = grib_file.mmap_grib_file(fin)
+            for message, offset in zip(grib_file_test.messages, offsets):
+                assert reader.read_next(headers_only=True)
+                assert (reader.get_offset(), reader.get_length()) == (offset, len(message))
+                fields, length = decode_message(message)
+                assert {k: reader.get_field(k) for k in fields} == fields
+            assert not reader.read_next()
+            assert reader.eof()
+        os.remove(path)
+
+    @staticmethod
+    def test_mmap_read_at():
+        path = os.path.join(tmp_path, "mmap_read_at_test.grb")
+        offsets = grib_file_test.write_messages(path)
+        with open(path, "rb") as fin:
+            reader = grib_file.mmap_grib_file(fin)
+            for i in [6, 0, 4]:
+                message = grib_file_test.messages[i]
+                assert reader.read_at(offsets[i], len(message))
+                fields, length = decode_message(message)
+                assert {k: reader.get_field(k) for k in fields} == fields
+                assert gribapi.grib_get_long(reader.load(), grib_file.date_key) == fields[grib_file.date_key]
+            assert not reader.read_at(offsets[1] + 1, len(grib_file_test.messages[1]))
+            reader.release()
+        os.remove(path)
+
+    @staticmethod
+    def test_copy_message_pool():
+        path = os.path.join(tmp_path, "copy_message_test.grb")
+        offsets = grib_file_test.write_messages(path)
+        paths = {f: os.path.join(tmp_path, f) for f in ["copy.1", "copy.2", "copy.3"]}
+        test_mode, grib_file.test_mode = grib_file.test_mode, False
+        try:
+            pool = grib_filter.file_pool(paths, 2)
+            sizes = {f: 0 for f in paths}
+            with open(path, "rb") as fin:
+                for i, (message, offset) in enumerate(zip(grib_file_test.messages, offsets)):
+                    name = sorted(paths.keys())[i % 3]
+                    handle = pool.get(name)
+                    assert isinstance(handle, io.BufferedWriter)
+                    if i % 2 == 0:
+                        grib_file.copy_message(fin, offset, len(message), handle)
+                    else:
+                        handle.write(message)
+                    sizes[name] += len(message)
+                    assert handle.tell() == sizes[name]
+            pool.close()
+        finally:
+            grib_file.test_mode = test_mode
+        assert pool.evictions > 0
+        if hasattr(os, "copy_file_range"):
+            assert grib_file.copy_file_range_enabled
+        for j, f in enumerate(sorted(paths.keys())):
+            with open(paths[f], "rb") as fin:
+                assert fin.read() == b"".join(grib_file_test.messages[j::3])
+            os.remove(paths[f])
+        os.remove(path)
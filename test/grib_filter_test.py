@@ -1,16 +1,17 @@
 import logging
 import os
+import shutil
+import tempfile
 import unittest
 from datetime import datetime
 
 import pytest
 
-from ece2cmor3 import grib_filter, grib_file, cmor_source, ece2cmorlib, cmor_task, cmor_target
+from ece2cmor3 import grib_filter, grib_file, grib_index, cmor_source, ece2cmorlib, cmor_task, cmor_target
 
 logging.basicConfig(level=logging.DEBUG)
 
 test_data_path = os.path.join(os.path.dirname(__file__), "test_data", "ifs", "001")
-tmp_path = os.path.join(os.path.dirname(__file__), "tmp")
 
 
 class grib_filter_test(unittest.TestCase):
@@ -22,22 +23,25 @@ class grib_filter_test(unittest.TestCase):
     sh_path = {date: os.path.join(test_data_path, sh_file)}
     preceding_files = {list(gg_path.values())[0]: None, list(sh_path.values())[0]: None}
     grib_file.test_mode = test_mode
-    if not os.path.exists(tmp_path):
-        os.makedirs(tmp_path)
 
-    @staticmethod
-    def test_initialize():
+    def setUp(self):
+        self.tmp_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path)
+        grib_index.index_dir, grib_index.indices = None, {}
+
+    def test_initialize(self):
         grib_filter.initialize(grib_filter_test.gg_path, grib_filter_test.sh_path, None, None,
-                               grib_filter_test.preceding_files, tmp_path)
+                               grib_filter_test.preceding_files, self.tmp_path)
         assert grib_filter.varsfreq[(133, 128, grib_file.hybrid_level_code, 9, cmor_source.ifs_grid.point)] == 6
         assert grib_filter.varsfreq[
                    (133, 128, grib_file.pressure_level_Pa_code, 85000, cmor_source.ifs_grid.point)] == 6
         assert grib_filter.varsfreq[(164, 128, grib_file.surface_level_code, 0, cmor_source.ifs_grid.point)] == 3
 
-    @staticmethod
-    def test_validate_tasks():
+    def test_validate_tasks(self):
         grib_filter.initialize(grib_filter_test.gg_path, grib_filter_test.sh_path, None, None,
-                               grib_filter_test.preceding_files, tmp_path)
+                               grib_filter_test.preceding_files, self.tmp_path)
         ece2cmorlib.initialize()
         tgt1 = ece2cmorlib.get_cmor_target("clwvi", "CFday")
         src1 = cmor_source.ifs_source.read("79.128")
@@ -56,16 +60,15 @@ class grib_filter_test(unittest.TestCase):
         levcheck = sorted([k[3] for k in varstasks if k[0] == 131])
         assert levs == levcheck
 
-    @staticmethod
-    def test_surf_var():
+    def test_surf_var(self):
         grib_filter.initialize(grib_filter_test.gg_path, grib_filter_test.sh_path, None, None,
-                               grib_filter_test.preceding_files, tmp_path)
+                               grib_filter_test.preceding_files, self.tmp_path)
         ece2cmorlib.initialize()
         tgt = ece2cmorlib.get_cmor_target("clwvi", "CFday")
         src = cmor_source.ifs_source.read("79.128")
         tsk = cmor_task.cmor_task(src, tgt)
         grib_filter.execute([tsk])
-        filepath = os.path.join(tmp_path, "79.128.1.3")
+        filepath = os.path.join(self.tmp_path, "79.128.1.3")
         assert os.path.isfile(filepath)
         assert getattr(tsk, cmor_task.filter_output_key) == [filepath]
         with open(filepath) as fin:
@@ -83,16 +86,15 @@ class grib_filter_test(unittest.TestCase):
                 time = newtime
         os.remove(filepath)
 
-    @staticmethod
-    def test_expr_var():
+    def test_expr_var(self):
         grib_filter.initialize(grib_filter_test.gg_path, grib_filter_test.sh_path, None, None,
-                               grib_filter_test.preceding_files, tmp_path)
+                               grib_filter_test.preceding_files, self.tmp_path)
         ece2cmorlib.initialize()
         tgt = ece2cmorlib.get_cmor_target("sfcWind", "Amon")
         src = cmor_source.ifs_source.read("214.128", "sqrt(sqr(var165)+sqr(var166))")
         tsk = cmor_task.cmor_task(src, tgt)
         grib_filter.execute([tsk])
-        filepath = os.path.join(tmp_path, "165.128.105_166.128.105.3")
+        filepath = os.path.join(self.tmp_path, "165.128.105_166.128.105.3")
         assert os.path.isfile(filepath)
         assert getattr(tsk, cmor_task.filter_output_key) == [filepath]
         with open(filepath) as fin:
@@ -111,16 +113,15 @@ class grib_filter_test(unittest.TestCase):
                     time = newtime
         os.remove(filepath)
 
-    @staticmethod
-    def test_pressure_var():
+    def test_pressure_var(self):
         grib_filter.initialize(grib_filter_test.gg_path, grib_filter_test.sh_path, None, None,
-                               grib_filter_test.preceding_files, tmp_path)
+                               grib_filter_test.preceding_files, self.tmp_path)
         ece2cmorlib.initialize()
         tgt = ece2cmorlib.get_cmor_target("ua", "Amon")
         src = cmor_source.ifs_source.read("131.128")
         tsk = cmor_task.cmor_task(src, tgt)
         grib_filter.execute([tsk])
-        filepath = os.path.join(tmp_path, "131.128.210.6")
+        filepath = os.path.join(self.tmp_path, "131.128.210.6")
         assert os.path.isfile(filepath)
         assert getattr(tsk, cmor_task.filter_output_key), [filepath]
         with open(filepath) as fin:
@@ -138,3 +139,130 @@ class grib_filter_test(unittest.TestCase):
                     assert newtime == (time + 600) % 2400
                     time = newtime
         os.remove(filepath)
+
+    def test_group_output_files(self):
+        grib_filter.initialize(grib_filter_test.gg_path, grib_filter_test.sh_path, None, None,
+                               grib_filter_test.preceding_files, self.tmp_path)
+        keys2files = {(79, 128, grib_file.surface_level_code, 0, cmor_source.ifs_grid.point): {("79.128.1.3", 3)},
+                      (133, 128, grib_file.hybrid_level_code, -1, cmor_source.ifs_grid.point): {("133.128.109.6", 6)},
+                      (78, 128, grib_file.surface_level_code, 0, cmor_source.ifs_grid.point): {("78.128.1.3", 3)}}
+        groups = grib_filter.group_output_files(keys2files, 2)
+        assert groups == [["133.128.109.6"], ["78.128.1.3", "79.128.1.3"]]
+        assert grib_filter.group_output_files(keys2files, 1) == [["133.128.109.6", "78.128.1.3", "79.128.1.3"]]
+
+    def test_build_routes(self):
+        grib_filter.initialize(grib_filter_test.gg_path, grib_filter_test.sh_path, None, None,
+                               grib_filter_test.preceding_files, self.tmp_path)
+        keys2files = {(79, 128, grib_file.surface_level_code, 0, cmor_source.ifs_grid.point): {("79.128.1.3", 3)},
+                      (133, 128, grib_file.hybrid_level_code, -1, cmor_source.ifs_grid.point): {("133.128.109.6", 6)}}
+        routes = grib_filter.build_routes(keys2files)
+        key = (79, 128, grib_file.surface_level_code, 0, cmor_source.ifs_grid.point)
+        assert grib_filter.get_routes(routes, key) == (("79.128.1.3", 3),)
+        key = (133, 128, grib_file.hybrid_level_code, 9, cmor_source.ifs_grid.point)
+        assert key in routes
+        assert grib_filter.get_routes(routes, key) == (("133.128.109.6", 6),)
+        key = (133, 128, grib_file.hybrid_level_code, 999, cmor_source.ifs_grid.point)
+        assert grib_filter.get_routes(routes, key) == (("133.128.109.6", 6),)
+        key = (78, 128, grib_file.surface_level_code, 0, cmor_source.ifs_grid.point)
+        assert grib_filter.get_routes(routes, key) == ()
+
+    def test_filter_fx_keys(self):
+        grib_filter.initialize(grib_filter_test.gg_path, grib_filter_test.sh_path, None, None,
+                               grib_filter_test.preceding_files, self.tmp_path)
+        fxkeys = [(133, 128, grib_file.hybrid_level_code, 9, cmor_source.ifs_grid.point),
+                  (164, 128, grib_file.surface_level_code, 0, cmor_source.ifs_grid.point)]
+        fxfiles = {fxkeys[0]: {("133.128.109.0", 3)}, fxkeys[1]: {("164.128.1.0", 3)}}
+        routes = grib_filter.build_routes(fxfiles)
+        assert (133, 128, grib_file.hybrid_level_code, 10, cmor_source.ifs_grid.point) in routes
+        gg_path = list(grib_filter_test.gg_path.values())[0]
+        with open(gg_path) as fin:
+            keys, timestamp = grib_filter.filter_fx_variables(grib_filter.open_grib_file(fin),
+                                                              routes, cmor_source.ifs_grid.point, None, fxkeys)
+        assert keys == set([k[:4] for k in fxkeys])
+        for fname in ["133.128.109.0", "164.128.1.0"]:
+            path = os.path.join(self.tmp_path, fname)
+            assert os.path.isfile(path)
+            os.remove(path)
+
+    def test_inspection_cache(self):
+        grib_filter.initialize(grib_filter_test.gg_path, grib_filter_test.sh_path, None, None,
+                               grib_filter_test.preceding_files, self.tmp_path)
+        gg_path = list(grib_filter_test.gg_path.values())[0]
+        cache_path = grib_filter.get_inspection_cache_path(gg_path, cmor_source.ifs_grid.point, False)
+        assert os.path.isfile(cache_path)
+        freqs, records = grib_filter.load_inspection(cache_path, False)
+        assert freqs[(133, 128, grib_file.hybrid_level_code, 9, cmor_source.ifs_grid.point)] == 6
+        assert records == grib_filter.record_keys[cmor_source.ifs_grid.point]
+        assert grib_filter.get_inspection_cache_path(gg_path, cmor_source.ifs_grid.point, True) != cache_path
+        next_path = os.path.join(self.tmp_path, "ICMGGECE3+199002.csv")
+        with open(gg_path) as fin, open(next_path, 'w') as fout:
+            for line in fin:
+                fout.write(line.replace("199001", "199002", 1))
+        assert grib_filter.get_inspection_cache_path(next_path, cmor_source.ifs_grid.point, False) != cache_path
+        assert not any([f.startswith("ICMGGECE3+199002.csv.") for f in os.listdir(self.tmp_path)])
+        os.remove(next_path)
+        os.remove(cache_path)
+
+    def test_filter_daily_field(self):
+        grib_filter.initialize(grib_filter_test.gg_path, grib_filter_test.sh_path, None, None,
+                               grib_filter_test.preceding_files, self.tmp_path)
+        grid = cmor_source.ifs_grid.point
+        path = os.path.join(self.tmp_path, "ICMGGDAILY+199001.csv")
+        with open(path, 'w') as fout:
+            for day in range(1, 4):
+                for hour in range(0, 24, 6):
+                    if hour == 0:
+                        fout.write("199001%02d,0,34,1,0\n" % day)
+                    fout.write("199001%02d,%d,167,1,0\n" % (day, hour * 100))
+        routes = grib_filter.build_routes({(34, 128, grib_file.surface_level_code, 0, grid): {("34.128.1.24", 24)}})
+        with open(path) as fin:
+            grib_filter.proc_grib_file(grib_filter.open_grib_file(fin, routes, grid), routes, grid, None, set())
+        output = os.path.join(self.tmp_path, "34.128.1.24")
+        with open(output) as fin:
+            assert [line.split(',')[0] for line in fin] == ["19900101", "19900102", "19900103"]
+        os.remove(output)
+        os.remove(path)
+
+    def test_file_pool(self):
+        paths = {f: os.path.join(self.tmp_path, f) for f in ["pool.1", "pool.2", "pool.3"]}
+        pool = grib_filter.file_pool(paths, 2)
+        for i in range(3):
+            for f in sorted(paths.keys()):
+                pool.get(f).write("%s,%d\n" % (f, i))
+        assert len(pool.values()) == 2
+        assert pool.evictions == 7
+        del pool["pool.3"]
+        assert "pool.3" not in pool
+        pool.close()
+        for f, path in paths.items():
+            with open(path) as fin:
+                assert fin.readlines() == ["%s,%d\n" % (f, i) for i in range(3)]
+            os.remove(path)
+
+    @staticmethod
+    def test_shift_date_time():
+        for date, time, hours in [(19900101, 0, -3), (19900101, 300, -3), (19920301, 0, -6), (19911231, 2100, 6),
+                                  (19900215, 1230, -24), (19900131, 1800, 24)]:
+            shifttime = time + hours * 100
+            if 0 <= shifttime < 2400:
+                expected = (date, shifttime)
+            else:
+                newdate, newhours = grib_filter.fix_date_time(date, shifttime // 100)
+                expected = (newdate, 100 * newhours)
+            assert grib_filter.shift_date_time(date, time, hours) == expected
+        assert grib_filter.shift_date_time(19920301, 300, -6) == (19920229, 2100)
+
+    def test_skip_plan(self):
+        grib_filter.initialize(grib_filter_test.gg_path, grib_filter_test.sh_path, None, None,
+                               grib_filter_test.preceding_files, self.tmp_path)
+        grid = cmor_source.ifs_grid.point
+        routes = grib_filter.build_routes({(79, 128, grib_file.surface_level_code, 0, grid): {("79.128.1.3", 3)},
+                                           (142, 128, grib_file.surface_level_code, 0, grid): {("142.128.1.3", 3)}})
+        entries = grib_index.get_index(list(grib_filter_test.gg_path.values())[0])
+        selected = grib_filter.select_index_entries(entries, routes, grid)
+        assert set([e[4] for e in selected]) == {79, 142}
+        selected = grib_filter.select_index_entries(entries, routes, grid, months={1: grib_filter.instant_fields})
+        assert set([e[4] for e in selected]) == {79}
+        assert all([(e[2] % 10 ** 4) // 10 ** 2 == 1 for e in selected])
+        selected = grib_filter.select_index_entries(entries, routes, grid, months={2: grib_filter.accumulated_fields})
+        assert set([e[4] for e in selected]) == {142}
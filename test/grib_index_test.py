@@ -0,0 +1,82 @@
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from ece2cmor3 import grib_file, grib_index
+
+logging.basicConfig(level=logging.DEBUG)
+
+test_data_path = os.path.join(os.path.dirname(__file__), "test_data", "ifs", "001")
+
+
+class grib_index_test(unittest.TestCase):
+    gg_path = os.path.join(test_data_path, "ICMGGECE3+199001.csv")
+    grib_file.test_mode = True
+
+    def setUp(self):
+        self.tmp_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path)
+        grib_index.index_dir, grib_index.indices = None, {}
+
+    @staticmethod
+    def test_build_index():
+        entries = grib_index.build_index(grib_index_test.gg_path)
+        with open(grib_index_test.gg_path) as fin:
+            nlines = len(fin.readlines())
+        assert entries.shape == (nlines, grib_index.num_columns)
+        assert list(entries[0, 2:]) == [19900101, 300, 8, 128, 1, 0]
+
+    @staticmethod
+    def test_read_indexed_messages():
+        entries = grib_index.build_index(grib_index_test.gg_path).tolist()
+        with open(grib_index_test.gg_path) as fin:
+            reader = grib_index.create_indexed_grib_file(fin, entries[10:12])
+            for entry in entries[10:12]:
+                assert reader.read_next()
+                assert reader.get_field(grib_file.param_key) == entry[4]
+                assert reader.load()
+                assert reader.get_field(grib_file.level_key) == entry[7]
+            assert not reader.read_next()
+
+    def test_persist_index(self):
+        grib_index.index_dir = self.tmp_path
+        grib_index.indices = {}
+        entries = grib_index.get_index(grib_index_test.gg_path)
+        index_path = grib_index.get_index_path(os.path.realpath(grib_index_test.gg_path))
+        assert os.path.isfile(index_path)
+        grib_index.indices = {}
+        reloaded = grib_index.load_index(os.path.realpath(grib_index_test.gg_path),
+                                         grib_index.get_file_stat(grib_index_test.gg_path))
+        assert (reloaded == entries).all()
+        os.remove(index_path)
+
+    def test_rebuild_corrupt_index(self):
+        grib_index.index_dir = self.tmp_path
+        grib_index.indices = {}
+        index_path = grib_index.get_index_path(os.path.realpath(grib_index_test.gg_path))
+        with open(index_path, 'wb') as fout:
+            fout.write(b"PK\x03\x04truncated")
+        entries = grib_index.get_index(grib_index_test.gg_path)
+        assert entries.shape[0] > 0
+        grib_index.indices = {}
+        reloaded = grib_index.load_index(os.path.realpath(grib_index_test.gg_path),
+                                         grib_index.get_file_stat(grib_index_test.gg_path))
+        assert (reloaded == entries).all()
+        assert not any([f.endswith(".tmp") for f in os.listdir(self.tmp_path)])
+        os.remove(index_path)
+
+    def test_copy_unmodified_messages(self):
+        entries = grib_index.build_index(grib_index_test.gg_path).tolist()
+        outpath = os.path.join(self.tmp_path, "copy_test.csv")
+        with open(grib_index_test.gg_path) as fin, open(outpath, 'w') as fout:
+            reader = grib_index.create_indexed_grib_file(fin, entries[:3])
+            while reader.read_next():
+                reader.write(fout)
+                assert not reader.loaded
+        with open(grib_index_test.gg_path) as fin, open(outpath) as fcopy:
+            assert fcopy.readlines() == fin.readlines()[:3]
+        os.remove(outpath)
@@ -9,7 +9,7 @@ import numpy
 import os
 import unittest
 
-from ece2cmor3 import ifs2cmor, ece2cmorlib
+from ece2cmor3 import ifs2cmor, ece2cmorlib, cmor_source, cmor_target, cmor_task, grib_file, grib_index
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -201,3 +201,84 @@ class ifs2cmor_tests(unittest.TestCase):
         assert lower_bnds == [self.startdate + n * interval for n in range(0, 4 * 365)]
         assert upper_bnds == lower_bnds
         os.remove(filepath)
+
+    @staticmethod
+    def test_order_tasks():
+        tasks = [cmor_task.cmor_task(cmor_source.ifs_source.create(code, 128), cmor_target.cmor_target(var, "Amon"))
+                 for code, var in [(167, "tas"), (79, "clwvi"), (130, "ta")]]
+        task_times = {"tas in Amon": {"cost": 1.0, "duration": 2.0}, "ta in Amon": {"cost": 10.0, "duration": 50.0}}
+        ordered, costs = ifs2cmor.order_tasks(tasks, task_times)
+        assert [t.target.variable for t in ordered] == ["ta", "tas", "clwvi"]
+        path = os.path.join(tmp_path, "ifs_task_times.json")
+        if not os.path.exists(tmp_path):
+            os.makedirs(tmp_path)
+        ifs2cmor.save_task_times(path, task_times)
+        assert ifs2cmor.load_task_times(path) == task_times
+        os.remove(path)
+
+    @staticmethod
+    def test_plan_hours():
+        assert ifs2cmor.get_plan_hours([199001010300]) == 0
+        assert ifs2cmor.get_plan_hours([199001010300, 199001010600, 199001312100, 199002010000]) == 744
+
+    @staticmethod
+    def test_plan():
+        data_path = os.path.join(tmp_path, "plan_test")
+        work_path = os.path.join(tmp_path, "plan_test_work")
+        os.makedirs(data_path, exist_ok=True)
+        src_path = os.path.join(os.path.dirname(__file__), "test_data", "ifs", "001")
+        for f in ["ICMGGECE3+199001", "ICMSHECE3+199001"]:
+            shutil.copyfile(os.path.join(src_path, f + ".csv"), os.path.join(data_path, f))
+        tasks = []
+        for code, var, table, freq, dims in [(167, "tas", "Amon", "mon", "longitude latitude time height2m"),
+                                             (79, "clwvi", "Amon", "mon", "longitude latitude time"),
+                                             (130, "ta", "day", "day", "longitude latitude plev8 time")]:
+            target = cmor_target.cmor_target(var, table)
+            setattr(target, cmor_target.freq_key, freq)
+            setattr(target, cmor_target.dims_key, dims)
+            setattr(target, "time_operator", ["mean"])
+            tasks.append(cmor_task.cmor_task(cmor_source.ifs_source.create(code, 128), target))
+        test_mode, grib_file.test_mode = grib_file.test_mode, True
+        try:
+            ifs2cmor.initialize(data_path, "ECE3", tmp_path, datetime.datetime(1850, 1, 1), tempdir=work_path,
+                                keepcache=False)
+            result = ifs2cmor.plan(tasks)
+            assert [(p["variable"], p["filtered_files"], p["command"]) for p in result["tasks"]] == \
+                [("tas", ["167.128.105.3"], "-setgridtype,regular -monmean -selcode,167"),
+                 ("clwvi", ["79.128.1.3"], "-setgridtype,regular -monmean -selcode,79")]
+            assert result["unsupported"] == [{"variable": "ta", "table": "day"}]
+            assert [f["name"] for f in result["filtered_files"]] == ["167.128.105.3", "79.128.1.3"]
+            assert all([p["bytes_read"] > 0 for p in result["tasks"]])
+            entries = grib_index.get_index(os.path.join(data_path, "ICMGGECE3+199001"))
+            lengths = entries[entries[:, grib_index.key_columns[grib_file.param_key]] == 167, grib_index.length_column]
+            assert result["tasks"][0]["estimated_output_bytes"] == int(ifs2cmor.plan_output_factor * lengths.mean())
+            assert all([t.status == cmor_task.status_initialized for t in tasks])
+            assert not any([hasattr(t, cmor_task.filter_output_key) for t in tasks])
+            assert not any([hasattr(t.target, cmor_target.mask_key) for t in tasks])
+            ifs2cmor.clean_plan_data()
+            assert os.listdir(work_path) == []
+        finally:
+            grib_file.test_mode = test_mode
+            shutil.rmtree(data_path)
+            shutil.rmtree(work_path, ignore_errors=True)
+
+    @staticmethod
+    def test_batch_variables():
+        if not os.path.exists(tmp_path):
+            os.makedirs(tmp_path)
+        path = os.path.join(tmp_path, "batch_test.nc")
+        root = netCDF4.Dataset(path, "w")
+        root.createDimension("time", 2)
+        for code in [167, 168]:
+            ncvar = root.createVariable("var%d" % code, "f4", dimensions=("time",))
+            setattr(ncvar, "code", code)
+            ncvar[:] = numpy.full((2,), float(code))
+        root.close()
+        tasks = [cmor_task.cmor_task(cmor_source.ifs_source.create(code, 128), cmor_target.cmor_target(var, "day"))
+                 for code, var in [(168, "tdps"), (167, "tas")]]
+        with netCDF4.Dataset(path, 'r') as dataset:
+            for task, code in zip(tasks, [168, 167]):
+                varlist = ifs2cmor.get_code_variables(dataset.variables, task)
+                assert varlist == ["var%d" % code]
+                assert numpy.all(dataset.variables[varlist[0]][:] == float(code))
+        os.remove(path)
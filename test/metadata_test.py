@@ -0,0 +1,94 @@
+import datetime
+import logging
+import os
+import unittest
+
+import netCDF4
+import numpy
+
+from ece2cmor3 import grib_file, metadata
+
+logging.basicConfig(level=logging.DEBUG)
+
+test_data_path = os.path.join(os.path.dirname(__file__), "test_data", "ifs", "001")
+tmp_path = os.path.join(os.path.dirname(__file__), "tmp")
+
+
+class metadata_test(unittest.TestCase):
+    gg_path = os.path.join(test_data_path, "ICMGGECE3+199001.csv")
+    grib_file.test_mode = True
+    if not os.path.exists(tmp_path):
+        os.makedirs(tmp_path)
+
+    @staticmethod
+    def test_grib_metadata():
+        path = metadata_test.gg_path
+        assert set(metadata.get_z_axes(path, 133)) == {grib_file.pressure_level_hPa_code,
+                                                      grib_file.pressure_level_Pa_code, grib_file.hybrid_level_code}
+        levels = metadata.get_levels(path, 133, "pressure")
+        assert 100000. in levels and 85000. in levels
+        assert len(set(levels)) == len(levels)
+        assert metadata.get_levels(path, 133, "unknown") is None
+        codes = metadata.get_codes(path)
+        assert 79 in codes and 133 in codes
+        time_stamps = metadata.get_time_stamps(path)
+        assert time_stamps[0] == datetime.datetime(1990, 1, 1, 3)
+        assert time_stamps == sorted(time_stamps)
+        epochs = metadata.get_time_epochs(path)
+        assert epochs.dtype == numpy.int64 and len(epochs) == len(time_stamps)
+        assert epochs[0] == (time_stamps[0] - datetime.datetime(1970, 1, 1)).total_seconds()
+
+    @staticmethod
+    def test_netcdf_metadata():
+        path = os.path.join(tmp_path, "metadata_test.nc")
+        lats = metadata.get_gaussian_latitudes(8)[::-1]
+        with netCDF4.Dataset(path, 'w') as ds:
+            ds.createDimension("time", None)
+            ds.createDimension("lat", len(lats))
+            ds.createDimension("lon", 16)
+            timevar = ds.createVariable("time", "f8", ("time",))
+            timevar.units = "hours since 1990-01-01 00:00:00"
+            timevar.calendar = "proleptic_gregorian"
+            timevar.standard_name = "time"
+            timevar[:] = [3., 6., 9.]
+            latvar = ds.createVariable("lat", "f8", ("lat",))
+            latvar.standard_name = "latitude"
+            latvar[:] = lats
+            lonvar = ds.createVariable("lon", "f8", ("lon",))
+            lonvar.standard_name = "longitude"
+            lonvar[:] = numpy.arange(16) * 22.5
+        assert metadata.get_time_stamps(path) == [datetime.datetime(1990, 1, 1, h) for h in [3, 6, 9]]
+        descr = metadata.get_grid_descr(path)
+        assert descr["gridtype"] == "gaussian"
+        assert descr["np"] == 4
+        assert descr["gridsize"] == 128
+        assert numpy.allclose(descr["yvals"], lats)
+        os.remove(path)
+
+    @staticmethod
+    def test_query_cache():
+        path = os.path.join(tmp_path, "metadata_cache_test.txt")
+        with open(path, 'w') as f:
+            f.write("test")
+        calls = []
+
+        def fallback(p, code):
+            calls.append(p)
+            return [code]
+
+        metadata.cache_dir = tmp_path
+        try:
+            assert metadata.query(path, "test", (7,), lambda p, fmt, code: None, fallback) == [7]
+            assert metadata.query(path, "test", (7,), lambda p, fmt, code: None, fallback) == [7]
+            metadata.cache.clear()
+            assert metadata.query(path, "test", (7,), lambda p, fmt, code: None, fallback) == [7]
+            assert len(calls) == 1
+            with open(path, 'a') as f:
+                f.write("modified")
+            assert metadata.query(path, "test", (7,), lambda p, fmt, code: None, fallback) == [7]
+            assert len(calls) == 2
+        finally:
+            entry_path = metadata.get_entry_path((os.path.realpath(path), "test", 7))
+            metadata.cache_dir = None
+            os.remove(entry_path)
+            os.remove(path)
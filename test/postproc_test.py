@@ -3,7 +3,7 @@ import os
 import unittest
 
 import test_utils
-from ece2cmor3 import cmor_source, cmor_target, cmor_task, postproc
+from ece2cmor3 import cdoapi, cmor_source, cmor_target, cmor_task, postproc
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -139,3 +139,141 @@ class postproc_tests(unittest.TestCase):
         setattr(task, "missval", "0")
         command = postproc.create_command(task)
         assert command.create_command() == "-setmisstoc,0 -monmean -daymax -setgridtype,regular -selcode,201"
+
+    @staticmethod
+    def test_postproc_merged_input():
+        assert postproc.get_input_string(["165.128.105.3"]) == "165.128.105.3"
+        assert postproc.get_input_string(["228.128.1.3", "165.128.105.3"]) == "-merge 228.128.1.3 165.128.105.3"
+
+    @staticmethod
+    def test_postproc_cache_path():
+        tmp_path = os.path.join(os.path.dirname(__file__), "tmp")
+        if not os.path.exists(tmp_path):
+            os.makedirs(tmp_path)
+        paths = [os.path.join(tmp_path, f) for f in ["79.128.1.3", "79.128.1.3.copy", "79.128.1.6"]]
+        for path, content in zip(paths, ["a", "a", "b"]):
+            with open(path, 'w') as fout:
+                fout.write(content)
+        command = cdoapi.cdo_command(code=79)
+        command.add_operator(cdoapi.cdo_command.day + cdoapi.cdo_command.mean)
+        assert postproc.get_cache_path(command, paths[:1], "clwvi_CFday.nc") is None
+        os.environ["ECE2CMOR3_CDO_CACHE"] = os.path.join(tmp_path, "cdo_cache")
+        try:
+            cache_path = postproc.get_cache_path(command, paths[:1], "clwvi_CFday.nc")
+            assert cache_path.endswith(".nc")
+            assert postproc.get_cache_path(command, paths[:1], "clw_CFday.nc") == cache_path
+            assert postproc.get_cache_path(command, paths[1:2], "clwvi_CFday.nc") != cache_path
+            assert postproc.get_cache_path(command, paths[2:], "clwvi_CFday.nc") != cache_path
+            assert postproc.get_cache_path(command, paths[:1], "clwvi_CFday.nc", grib_first=True) != cache_path
+            assert postproc.get_cache_path(command, paths[:1], "clwvi_CFday.nc", data_type="F32") != cache_path
+            with open(paths[0], 'a') as fout:
+                fout.write("a")
+            assert postproc.get_cache_path(command, paths[:1], "clwvi_CFday.nc") != cache_path
+            cache_path = postproc.get_cache_path(command, paths[:1], "clwvi_CFday.nc")
+            command.add_operator(cdoapi.cdo_command.month + cdoapi.cdo_command.mean)
+            assert postproc.get_cache_path(command, paths[:1], "clwvi_CFday.nc") != cache_path
+        finally:
+            del os.environ["ECE2CMOR3_CDO_CACHE"]
+            for path in paths:
+                os.remove(path)
+
+    @staticmethod
+    def test_postproc_batch_groups():
+        tasks = []
+        for code, table, var, outfreq in [(167, 128, "tas", 3), (168, 128, "tdps", 3), (165, 128, "uas", 6),
+                                          (246, 228, "ua100m", 3), (247, 228, "va100m", 3), (169, 128, "rsds", 3)]:
+            target = cmor_target.cmor_target(var, "day")
+            setattr(target, cmor_target.freq_key, "day")
+            setattr(target, cmor_target.dims_key, "longitude latitude time")
+            setattr(target, "time_operator", ["mean"])
+            task = cmor_task.cmor_task(cmor_source.ifs_source.create(code, table), target)
+            setattr(task, cmor_task.filter_output_key, ["%d.%d.1.%d" % (code, table, outfreq)])
+            setattr(task, cmor_task.output_frequency_key, outfreq)
+            tasks.append(task)
+        groups = postproc.group_batch_commands(tasks)
+        assert sorted([sorted([(t.target.variable, c) for t, cmd, c in g]) for g in groups]) == \
+            [[("tas", 167), ("tdps", 168)], [("ua100m", 246), ("va100m", 247)]]
+        for group in groups:
+            assert all([cmd.create_command() == "-setgridtype,regular -daymean" for t, cmd, c in group])
+            assert all([t.status == cmor_task.status_initialized for t, cmd, c in group])
+        jobs = []
+
+        def mapper(func, items):
+            jobs.extend(items)
+            return [(i, path if i == 0 else None) for i, cmd, input_files, path in items]
+
+        outputs = postproc.batch_commands(tasks, "tmp", mapper)
+        assert len(jobs) == 2 and outputs == [jobs[0][3]]
+        assert [c.create_command().split(' ')[-1] for i, c, f, p in jobs] == \
+            ["-selcode," + ','.join(sorted(str(c) for t, cmd, c in g)) for g in groups]
+        batched = [t for t, cmd, c in groups[0]]
+        assert all([t.status == cmor_task.status_postprocessed for t in batched])
+        assert all([t.status == cmor_task.status_initialized for t in tasks if t not in batched])
+
+    @staticmethod
+    def test_postproc_fused_groups():
+        tasks = []
+        for var, operator, path in [("tas", "mean", "167.128.1.3"), ("tasmax", "maximum", "167.128.1.3"),
+                                    ("tasmin", "minimum", "167.128.1.3"), ("tas", "mean", "167.128.1.6")]:
+            target = cmor_target.cmor_target(var, "day")
+            setattr(target, cmor_target.freq_key, "day")
+            setattr(target, cmor_target.dims_key, "longitude latitude time")
+            setattr(target, "time_operator", [operator])
+            task = cmor_task.cmor_task(cmor_source.ifs_source.create(167, 128), target)
+            setattr(task, cmor_task.filter_output_key, [path])
+            tasks.append(task)
+        os.environ["ECE2CMOR3_IFS_NUMPY_REDUCE"] = "True"
+        try:
+            groups = postproc.plan_fused_reductions(tasks, "tmp")
+        finally:
+            del os.environ["ECE2CMOR3_IFS_NUMPY_REDUCE"]
+        assert len(groups) == 1
+        input_files, code, tasklist = groups[0]
+        assert (input_files, code) == (["167.128.1.3"], 167)
+        assert [t.target.variable for t, cmd in tasklist] == ["tas", "tasmax", "tasmin"]
+        jobs = []
+
+        def mapper(func, items):
+            jobs.extend(items)
+            return [(0, [path for cmd, path in items[0][3]])]
+
+        assert postproc.apply_fused_reductions(groups + [(["167.128.1.6"], 167, [(tasks[3], None)])], "tmp",
+                                               mapper) == tasks[:3]
+        outputs = [os.path.join("tmp", v + "_day.nc") for v in ["tas", "tasmax", "tasmin"]]
+        assert [[path for cmd, path in job[3]] for job in jobs] == [outputs, outputs[:1]]
+        assert [getattr(t, cmor_task.output_path_key, None) for t in tasks] == outputs + [None]
+        assert [t.status for t in tasks] == [cmor_task.status_postprocessed] * 3 + [cmor_task.status_initialized]
+
+    @staticmethod
+    def test_postproc_shared_commands():
+        tasks = [cmor_task.cmor_task(cmor_source.ifs_source.create(130, 128), cmor_target.cmor_target(v, "day"))
+                 for v in ["ta", "ta850", "ta500"]]
+        command = cdoapi.cdo_command(code=130)
+        command.add_operator(cdoapi.cdo_command.spectral_operator)
+        shared_commands = [("prefix_1.nc", command, ["130.128.105.3"], 2, tasks[:2]),
+                           ("prefix_2.nc", command, ["130.128.105.6"], 2, tasks[2:])]
+        jobs = []
+
+        def mapper(func, items):
+            jobs.extend(items)
+            return [items[0][0], None]
+
+        assert postproc.apply_shared_commands(shared_commands, mapper) == ["prefix_1.nc"]
+        assert [j[0] for j in jobs] == ["prefix_1.nc", "prefix_2.nc"]
+        assert [getattr(t, "cdo_prefix", None) for t in tasks] == [("prefix_1.nc", 2), ("prefix_1.nc", 2), None]
+
+    @staticmethod
+    def test_postproc_thread_budget():
+        postproc.init_thread_budget(8, 2, 3)
+        try:
+            first = postproc.acquire_threads(2)
+            assert first == 4
+            second = postproc.acquire_threads(6)
+            assert second == 4
+            third = postproc.acquire_threads(2)
+            assert third == 1
+            postproc.release_threads(first)
+            postproc.release_threads(second)
+            assert postproc.acquire_threads(2) == 7
+        finally:
+            postproc.thread_state = None
@@ -0,0 +1,161 @@
+import datetime
+import logging
+import os
+import unittest
+
+import gribapi
+import numpy
+
+from ece2cmor3 import cdoapi, grib_file, reduction
+
+logging.basicConfig(level=logging.DEBUG)
+
+tmp_path = os.path.join(os.path.dirname(__file__), "tmp")
+
+
+# Writes a grib file with constant fields on the regular gaussian grid of the sample, for the messages given as tuples
+# of the sample, code, date, hour, level type and level
+def write_grib_file(path, messages):
+    with open(path, "wb") as fout:
+        for sample, code, date, hour, levtype, level in messages:
+            record = gribapi.grib_new_from_samples(sample)
+            try:
+                for key, value in [(grib_file.param_key, code), (grib_file.date_key, date),
+                                   (grib_file.time_key, hour * 100), (grib_file.levtype_key, levtype),
+                                   (grib_file.level_key, level)]:
+                    gribapi.grib_set(record, key, value)
+                value = 100000. if code == 134 else 200. + level + hour
+                gribapi.grib_set_values(record, numpy.full(gribapi.grib_get_size(record, "values"), value))
+                fout.write(gribapi.grib_get_message(record))
+            finally:
+                gribapi.grib_release(record)
+
+
+class collector:
+
+    def __init__(self):
+        self.fields = []
+
+    def consume(self, timestamp, field, grid):
+        self.fields.append((timestamp, numpy.array(field)))
+
+    def flush(self):
+        pass
+
+
+class reduction_test(unittest.TestCase):
+
+    @staticmethod
+    def test_get_stages():
+        command = cdoapi.cdo_command(code=201)
+        command.add_operator(cdoapi.cdo_command.gridtype_operator, cdoapi.cdo_command.regular_grid_type)
+        command.add_operator(cdoapi.cdo_command.day + cdoapi.cdo_command.max)
+        command.add_operator(cdoapi.cdo_command.month + cdoapi.cdo_command.mean)
+        assert reduction.get_stages(command) == [("setgridtype", None), ("daymax", None), ("monmean", None)]
+        command.add_operator(cdoapi.cdo_command.field + cdoapi.cdo_command.mean)
+        assert reduction.get_stages(command) is None
+        command = cdoapi.cdo_command(code=167)
+        command.add_operator(cdoapi.cdo_command.select + cdoapi.cdo_command.hour, 0, 6, 12, 18)
+        assert reduction.get_stages(command) == [("selhour", {0, 6, 12, 18})]
+
+    @staticmethod
+    def test_reduced_to_regular():
+        values = numpy.array([0., 1., 2., 3., 0., 2.])
+        result = reduction.reduced_to_regular(values, (4, 2), 4)
+        assert numpy.allclose(result, [0., 1., 2., 3., 0., 1., 2., 1.])
+
+    @staticmethod
+    def test_statistics_chain():
+        target = collector()
+        stage = reduction.create_stage("daymax", None, reduction.create_stage("monmean", None, target))
+        start = datetime.datetime(1990, 1, 31, 6)
+        for i in range(12):
+            stage.consume(start + datetime.timedelta(hours=6 * i), numpy.array([float(i), -float(i)]), None)
+        stage.flush()
+        assert [t for t, f in target.fields] == [datetime.datetime(1990, 1, 31, 18), datetime.datetime(1990, 2, 3, 0)]
+        assert numpy.allclose(target.fields[0][1], [2., 0.])
+        assert numpy.allclose(target.fields[1][1], [(6. + 10. + 11.) / 3, -(3. + 7. + 11.) / 3])
+
+    @staticmethod
+    def test_reduction_tree():
+        targets = [collector(), collector(), collector()]
+        chains = [([("setgridtype", None), ("daymean", None)], targets[0]),
+                  ([("setgridtype", None), ("daymax", None)], targets[1]),
+                  ([("setgridtype", None), ("daymax", None), ("monmean", None)], targets[2])]
+        root = reduction.create_tree(chains)
+        assert isinstance(root, reduction.regular_grid_stage)
+        assert isinstance(root.target, reduction.fan_out_stage)
+        assert len(root.target.targets) == 2
+        start = datetime.datetime(1990, 1, 1, 6)
+        for i in range(8):
+            root.consume(start + datetime.timedelta(hours=6 * i), numpy.array([float(i), 1., 2.]),
+                         ((2, 1), 2, 2, None, None))
+        root.flush()
+        assert len(targets[0].fields) == 3 and len(targets[1].fields) == 3 and len(targets[2].fields) == 1
+        assert numpy.allclose(targets[0].fields[0][1], [1., 1., 2., 2.])
+        assert numpy.allclose(targets[1].fields[1][1], [6., 1., 2., 2.])
+        assert numpy.allclose(targets[2].fields[0][1], [(2. + 6. + 7.) / 3, 1., 2., 2.])
+
+    @staticmethod
+    def test_discard_partial_outputs():
+        if not os.path.exists(tmp_path):
+            os.makedirs(tmp_path)
+        path = os.path.join(tmp_path, "reduction_test.grb")
+        write_grib_file(path, [("regular_gg_sfc_grib1", 167, 19900101, h, grib_file.surface_level_code, 0)
+                               for h in [0, 6, 12, 18]])
+        outputs = [os.path.join(tmp_path, f) for f in ["tas_day_test.nc", "tas_3hr_test.nc"]]
+        daymean = cdoapi.cdo_command(code=167)
+        daymean.add_operator(cdoapi.cdo_command.day + cdoapi.cdo_command.mean)
+        selhour = cdoapi.cdo_command(code=167)
+        selhour.add_operator(cdoapi.cdo_command.select + cdoapi.cdo_command.hour, 3)
+        test_mode, grib_file.test_mode = grib_file.test_mode, False
+        try:
+            assert reduction.apply_commands([(daymean, outputs[0]), (selhour, outputs[1])], [path]) is None
+            assert not any([os.path.exists(f) for f in outputs])
+            assert reduction.apply_commands([(daymean, outputs[0])], [path]) == outputs[:1]
+            assert os.path.isfile(outputs[0])
+            os.remove(outputs[0])
+            write_grib_file(path, [("regular_ll_sfc_grib1", 167, 19900101, h, grib_file.surface_level_code, 0)
+                                   for h in [0, 6, 12, 18]])
+            assert reduction.apply_commands([(daymean, outputs[0])], [path]) is None
+            assert not os.path.exists(outputs[0])
+        finally:
+            grib_file.test_mode = test_mode
+            os.remove(path)
+
+    @staticmethod
+    def test_discard_partial_interpolations():
+        if not os.path.exists(tmp_path):
+            os.makedirs(tmp_path)
+        path = os.path.join(tmp_path, "interpolation_test.grb")
+        messages = []
+        for hour in [0, 6]:
+            messages.append(("regular_gg_sfc_grib1", 134, 19900101, hour, grib_file.surface_level_code, 0))
+            messages.extend([("regular_gg_ml_grib1", 130, 19900101, hour, grib_file.hybrid_level_code, level)
+                             for level in range(1, 92)])
+        write_grib_file(path, messages)
+        outputs = [os.path.join(tmp_path, f) for f in ["ta_6hr_test.nc", "ta_3hr_test.nc"]]
+        commands = []
+        for hours in [[], [3]]:
+            command = cdoapi.cdo_command(code=130)
+            command.add_operator(cdoapi.cdo_command.select_code_operator, 134)
+            command.add_operator(cdoapi.cdo_command.select_z_operator, cdoapi.cdo_command.model_level,
+                                 cdoapi.cdo_command.surf_level)
+            command.add_operator(cdoapi.cdo_command.ml2pl_operator, 85000)
+            if any(hours):
+                command.add_operator(cdoapi.cdo_command.select + cdoapi.cdo_command.hour, *hours)
+            commands.append(command)
+        test_mode, grib_file.test_mode = grib_file.test_mode, False
+        try:
+            assert reduction.apply_interpolation_commands([(c, [path], f) for c, f in zip(commands, outputs)]) is None
+            assert not any([os.path.exists(f) for f in outputs])
+            assert reduction.apply_interpolation_commands([(commands[0], [path], outputs[0])]) == outputs[:1]
+            assert os.path.isfile(outputs[0])
+            os.remove(outputs[0])
+            messages[0] = ("regular_ll_sfc_grib1",) + messages[0][1:]
+            write_grib_file(path, messages)
+            assert reduction.apply_interpolation_commands([(commands[0], [path], outputs[0])]) is None
+            assert not os.path.exists(outputs[0])
+        finally:
+            grib_file.test_mode = test_mode
+            os.remove(path)
@@ -0,0 +1,32 @@
+import logging
+import unittest
+
+import numpy
+
+from ece2cmor3 import vinterp
+
+logging.basicConfig(level=logging.DEBUG)
+
+
+class vinterp_test(unittest.TestCase):
+    # Hybrid coefficients of three model levels with half-level pressures 0, 40000, 20000 + 0.4 * ps and ps
+    pv = [0., 40000., 20000., 0., 0., 0., 0.4, 1.]
+
+    @staticmethod
+    def test_full_level_pressures():
+        ps = numpy.array([100000., 90000.])
+        pfull = vinterp.get_full_level_pressures(vinterp_test.pv, ps, [1, 2, 3])
+        assert numpy.allclose(pfull, [[20000., 20000.], [50000., 48000.], [80000., 73000.]])
+
+    @staticmethod
+    def test_pressure_weights():
+        ps = numpy.array([100000., 90000.])
+        pfull = vinterp.get_full_level_pressures(vinterp_test.pv, ps, [1, 2, 3])
+        weights = vinterp.pressure_weights(pfull, ps, [10000., 35000., 65000., 95000.])
+        field = numpy.array([[1., 1.], [2., 2.], [3., 3.]])
+        result = weights.interpolate(field, 133)
+        assert numpy.allclose(result[:, 0], [1., 1.5, 2.5, 3.])
+        assert numpy.allclose(result[[0, 3], 1], [1., 3.])
+        temperature = weights.interpolate(numpy.array([[220., 220.], [270., 270.], [280., 280.]]), 130)
+        assert numpy.allclose(temperature[:, 0], [220., 245., 275., 280.])
+        assert temperature[3, 1] > 280.